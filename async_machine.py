@@ -0,0 +1,140 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+
+from logging_config import *
+from gmachine import GMachine
+from gcode import GCodeRunner
+
+
+class MachineJob(object):
+    """ Command waiting for machine thread or running in it.
+    """
+    def __init__(self, function, args, runner=None):
+        """ Create object.
+        :param function: function which runs in machine thread.
+        :param args: tuple of function arguments.
+        :param runner: GCodeRunner object if job is a program.
+        """
+        self.function = function
+        self.args = args
+        self.runner = runner
+        self.cancelled = False
+
+
+class AsyncGMachine(object):
+    """ asyncio interface of GMachine. Commands run one by one in a single
+        machine thread, so one event loop can drive machine, UI and order
+        intake at once. Each submitted command gives asyncio future which
+        is done when movements of the command are finished, cancelling the
+        future stops the machine.
+    """
+    def __init__(self, machine=None):
+        """ Create object.
+        :param machine: GMachine object, new one if None.
+        """
+        self.machine = machine or GMachine()
+        self._thread = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='gmachine')
+        self._lock = threading.Lock()
+        self._current = None
+        self._futures = set()
+
+    def submit(self, c, position, velocity, params=None):
+        """ Queue command, see GMachine.do_command(). Should be called from
+            event loop.
+        :return: asyncio.Future with do_command() result.
+        """
+        job = MachineJob(self.machine.do_command, (c, position, velocity, params))
+        return self._submit(job)
+
+    def submit_program(self, source):
+        """ Queue G-code program, see GCodeRunner.run(). Movements of the
+            whole program are planned together. Should be called from event
+            loop.
+        :param source: file name or iterable of lines.
+        :return: asyncio.Future with number of executed commands.
+        """
+        runner = GCodeRunner(self.machine)
+        return self._submit(MachineJob(runner.run, (source,), runner))
+
+    def _submit(self, job):
+        loop = asyncio.get_running_loop()
+        future = asyncio.wrap_future(self._thread.submit(self._run, job), loop=loop)
+        self._futures.add(future)
+        future.add_done_callback(lambda f: self._done(job, f))
+        return future
+
+    def _done(self, job, future):
+        self._futures.discard(future)
+        if future.cancelled():
+            self._cancel(job)
+
+    def _cancel(self, job):
+        """ Mark job as cancelled, machine is stopped if job is running.
+            Runs in event loop thread, so planner is not touched here,
+            GMachine.stop() only requests machine thread to drop it.
+        """
+        with self._lock:
+            job.cancelled = True
+            if self._current is not job:
+                return
+        if job.runner is not None:
+            job.runner.stop()
+        self.machine.stop()
+
+    def _run(self, job):
+        """ Run job in machine thread.
+        """
+        with self._lock:
+            if job.cancelled:
+                return None
+            self._current = job
+        try:
+            result = job.function(*job.args)
+            if not job.cancelled:
+                self.machine.flush()
+                self.machine.join()
+            return result
+        finally:
+            with self._lock:
+                self._current = None
+            if job.cancelled:
+                # command could queue movements after stop
+                self.machine.stop()
+                self.machine.sync_position()
+                logging.warning("command cancelled, machine stopped at {}".format(
+                    self.machine._local))
+
+    def cancel(self):
+        """ Cancel all queued commands and stop the running one.
+        """
+        for future in list(self._futures):
+            future.cancel()
+
+    def busy(self):
+        """ Check if any command is queued or running.
+        """
+        return bool(self._futures) or self._current is not None
+
+    async def progress(self, interval=ASYNC_PROGRESS_INTERVAL_S):
+        """ Report progress until machine is idle, the last report is made
+            after all commands are finished.
+        :param interval: time between reports in seconds.
+        :return: async iterator of dicts with axis name as key and number of
+                 steps made since the call as value.
+        """
+        start = self.machine.steps_done()
+        while True:
+            busy = self.busy()
+            now = self.machine.steps_done()
+            yield dict((axis, n - start.get(axis, 0)) for axis, n in now.items())
+            if not busy:
+                return
+            await asyncio.sleep(interval)
+
+    def close(self):
+        """ Stop machine thread after queued commands.
+        """
+        self._thread.shutdown(wait=False)
@@ -0,0 +1,289 @@
+""" Planning of queued orders in worker processes. Pulses of each order
+    are planned by GMachine in the same way as for direct run, but into
+    JobRecorder, so planning runs on the other cores while machine makes
+    the previous orders. Plans are given to machine in order of the queue.
+"""
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import threading
+
+from logging_config import *
+from gcode import GCodeRunner
+from gmachine import GMachine
+from decoration import DecorationPlan
+from job_cache import JobRecorder
+from machine_profile import MachineProfile, get_profile
+
+
+class _NullSink(object):
+    """ Pulse sink which drops movements, used to find where an order ends
+        without making pulses.
+    """
+    def add_task(self, gen):
+        pass
+
+    def join(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def emergency_stop(self):
+        pass
+
+    def reset_emergency_stop(self):
+        pass
+
+    def positions(self):
+        return [0, 0, 0, 0]
+
+
+class _NullPlanner(object):
+    """ Planner which drops movements, position of GMachine is counted
+        before planning, so junction planning can be skipped.
+    """
+    def add(self, delta, velocity, steps=None):
+        pass
+
+    def flush(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def cancel(self):
+        pass
+
+    def pending(self):
+        return 0
+
+
+def _run_program(machine, program):
+    """ Give order to machine.
+    :param program: file name or list of G-code lines, or list of
+                    (command, position, velocity, params) tuples for
+                    GMachine.do_command(), i.e. Icing, Filling, Decoration.
+    """
+    if isinstance(program, str) or (program and isinstance(program[0], str)):
+        GCodeRunner(machine).run(program)
+        return
+    for command in program:
+        machine.do_command(*command)
+    machine.flush()
+
+
+def end_steps(program, start_steps, profile):
+    """ Get machine position after order, pulses are not made.
+    :param program: order, see _run_program().
+    :param start_steps: machine position in steps before order.
+    :param profile: MachineProfile object.
+    :return: tuple of four integers.
+    """
+    machine = GMachine(profile, step_process=_NullSink())
+    machine._planner = _NullPlanner()
+    machine._set_steps(start_steps)
+    _run_program(machine, program)
+    return tuple(int(round(s)) for s in machine._steps)
+
+
+def plan_program(program, start_steps, profile):
+    """ Plan order into recorded pulses.
+    :param program: order, see _run_program().
+    :param start_steps: machine position in steps before order.
+    :param profile: MachineProfile object.
+    :return: JobRecorder object with start_steps and delta_steps.
+    """
+    recorder = JobRecorder(start_steps)
+    machine = GMachine(profile, step_process=recorder)
+    machine._set_steps(start_steps)
+    _run_program(machine, program)
+    recorder.delta_steps = tuple(int(round(a - b)) for a, b in zip(machine._steps, start_steps))
+    return recorder
+
+
+def order_program(program, profile):
+    """ Find drawing order of Decoration commands. Order does not depend
+        on machine position, so it can be found before the previous orders
+        are planned. Order is found only once, position pass and planning
+        use the same one, so time budget of optimization can not make them
+        differ.
+    :param program: order, see _run_program().
+    :param profile: MachineProfile object.
+    :return: the same order, Decoration commands have features in drawing
+             order and 'ordered' parameter, so they are not optimized again.
+    """
+    if isinstance(program, str) or (program and isinstance(program[0], str)):
+        return program
+    result = []
+    for c, position, velocity, params in program:
+        if c == 'Decoration' and params and not params.get('ordered'):
+            params = GMachine._params(c, params, 'features')
+            plan = DecorationPlan(params['features'],
+                                  time_budget_s=params.get('time_budget_s', DECORATION_TIME_BUDGET_S),
+                                  max_passes=params.get('max_passes', DECORATION_MAX_PASSES),
+                                  velocity=min(velocity.x, velocity.y), profile=profile)
+            params = dict(params, features=list(plan), ordered=True)
+        result.append((c, position, velocity, params))
+    return result
+
+
+def _order_chunk(programs, profile_data):
+    """ Find drawing order of consecutive orders in worker process.
+    """
+    profile = MachineProfile.from_dict(profile_data)
+    return [order_program(program, profile) for program in programs]
+
+
+def _chunk_end(programs, start_steps, profile_data):
+    """ Get machine position after consecutive orders in worker process.
+    """
+    profile = MachineProfile.from_dict(profile_data)
+    for program in programs:
+        start_steps = end_steps(program, start_steps, profile)
+    return start_steps
+
+
+def _plan_chunk(programs, start_steps, profile_data):
+    """ Plan consecutive orders in worker process, each order starts where
+        the previous one ends.
+    :param profile_data: MachineProfile.to_dict(), profile itself can not
+                         be pickled.
+    :return: list of JobRecorder objects.
+    """
+    profile = MachineProfile.from_dict(profile_data)
+    result = []
+    for program in programs:
+        recorder = plan_program(program, start_steps, profile)
+        start_steps = tuple(a + b for a, b in zip(recorder.start_steps, recorder.delta_steps))
+        result.append(recorder)
+    return result
+
+
+class BatchPlanner(object):
+    """ Plan queue of orders in process pool. Orders are sent to workers in
+        chunks. Decoration order of chunks is optimized ahead in parallel,
+        it does not depend on machine position. Start position of each
+        chunk is then found by fast pass over the previous ordered chunks
+        without pulses, it also runs in worker, so machine thread does not
+        share the interpreter with planning. Only max_pending chunks are
+        optimized, planned or wait for machine at once, so memory does not
+        grow with the queue.
+    """
+    def __init__(self, profile=None, workers=BATCH_PLANNER_WORKERS,
+                 chunk_size=BATCH_PLANNER_CHUNK_SIZE, max_pending=BATCH_PLANNER_MAX_PENDING):
+        """ Create object.
+        :param profile: MachineProfile object, default profile if None.
+        :param workers: number of processes, CPU count if None.
+        :param chunk_size: number of orders in one worker task.
+        :param max_pending: maximum number of chunks which are planned or
+                            wait for machine, twice the workers if None.
+        """
+        self._profile = profile or get_profile()
+        self._workers = workers or os.cpu_count() or 1
+        self._chunk_size = max(1, chunk_size)
+        self._max_pending = max(1, max_pending or 2 * self._workers)
+        # 子行程不繼承機台的執行緒
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            self._workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def plan(self, programs, start_steps=(0, 0, 0, 0)):
+        """ Plan orders. Chunks are sent to workers by feeder thread, so
+            caller only waits for finished plans.
+        :param programs: iterable of orders, see _run_program().
+        :param start_steps: machine position in steps before the first order.
+        :return: generator of (program, JobRecorder) tuples in order of
+                 programs, program is given with Decoration order, see
+                 order_program().
+        """
+        # 佇列長度限制送出的批次數，機台跟不上時餵入執行緒就等待
+        pending = queue.Queue(maxsize=self._max_pending)
+        stop = threading.Event()
+        feeder = threading.Thread(target=self._feed, name='batch-planner',
+                                  args=(iter(programs), tuple(start_steps), pending, stop))
+        feeder.daemon = True
+        feeder.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is None:
+                    return
+                chunk, future = item
+                for pair in zip(chunk, future.result()):
+                    yield pair
+        finally:
+            stop.set()
+            while feeder.is_alive():
+                try:
+                    item = pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is not None and item[1] is not None:
+                    item[1].cancel()
+
+    def _feed(self, programs, start, pending, stop):
+        """ Send chunks of orders to process pool. Only the fast pass of
+            the previous chunk is waited for, optimization of the next
+            chunks already runs.
+        """
+        profile_data = self._profile.to_dict()
+        ordering = collections.deque()
+        try:
+            while not stop.is_set():
+                while len(ordering) < self._max_pending:
+                    chunk = []
+                    for program in programs:
+                        chunk.append(program)
+                        if len(chunk) == self._chunk_size:
+                            break
+                    if not chunk:
+                        break
+                    ordering.append(self._pool.submit(_order_chunk, chunk, profile_data))
+                if not ordering:
+                    break
+                chunk = ordering.popleft().result()
+                future = self._pool.submit(_plan_chunk, chunk, start, profile_data)
+                pending.put((chunk, future))
+                start = self._pool.submit(_chunk_end, chunk, start, profile_data).result()
+        except BaseException as e:
+            # error is raised when caller gets to this chunk
+            future = concurrent.futures.Future()
+            future.set_exception(e)
+            pending.put(([], future))
+        finally:
+            for future in ordering:
+                future.cancel()
+        pending.put(None)
+
+    def run(self, machine, programs):
+        """ Run orders on machine, each order runs as soon as it is planned
+            and the previous one is given to machine. Position pass and
+            planning use the same Decoration order, so each plan starts
+            where the previous one ends,
+            GMachineException is raised by run_compiled() if machine was
+            moved by something else meanwhile.
+        :param machine: GMachine object.
+        :param programs: iterable of orders, see _run_program().
+        :return: number of orders.
+        """
+        count = 0
+        plans = self.plan(programs, tuple(int(round(s)) for s in machine._steps))
+        try:
+            for program, plan in plans:
+                machine.run_compiled(plan)
+                count += 1
+        finally:
+            plans.close()
+        machine.join()
+        return count
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
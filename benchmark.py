@@ -0,0 +1,371 @@
+""" Headless benchmark of the step pipeline. Every scenario runs against
+    simulated GPIO, so no hardware is needed, and reports:
+        steps/s       - full steps made by all axises per second of wall
+                        time, rising edges of step pins are counted by
+                        simulated GPIO, microsteps as part of full step
+        planning      - wall time which machine thread spends to plan one
+                        linear movement, i.e. junction planning, pulse
+                        generator and its timeline, percentiles in us
+        peak memory   - tracemalloc peak of the scenario in KiB, pin trace
+                        of simulated GPIO is included
+    Hot paths of planning are also measured alone by micro benchmarks, in
+    ns per call. Results can be saved as baseline and later runs are
+    compared with it. With --stop-latency emergency stop latency is
+    measured instead.
+
+    python benchmark.py [--scale 1.0] [--save] [--baseline FILE] [--no-memory] [--no-micro]
+    python benchmark.py --stop-latency [--runs 200]
+"""
+import argparse
+import json
+import os
+import random
+import time
+import tracemalloc
+
+from logging_config import *
+from coordinates import *
+import hal
+from hal_backend import SimulatedBackend, StopBackend
+from pulse import PulseGenerator, PulseGeneratorLinear
+from executor import MergedStepExecutor
+from gmachine import GMachine
+from gcode import GCodeRunner
+
+BASELINE_FILE = 'benchmark_baseline.json'
+PERCENTILES = (50, 90, 99)
+MICRO_REPEAT = 5
+
+
+class TimedGMachine(GMachine):
+    """ GMachine which records wall time of planning of each linear
+        movement. Planner releases one movement for each new one when its
+        look ahead queue is full, so time of _move_steps() is planning of
+        one movement.
+    """
+    def __init__(self, *args, **kwargs):
+        self.planning_ns = []
+        super(TimedGMachine, self).__init__(*args, **kwargs)
+
+    def _move_steps(self, steps, velocity):
+        t = time.perf_counter_ns()
+        super(TimedGMachine, self)._move_steps(steps, velocity)
+        self.planning_ns.append(time.perf_counter_ns() - t)
+
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def _install_backend():
+    """ Restart axis workers on new SimulatedBackend, motors keep backend
+        which was active when they were created.
+    """
+    hal.configure_drivers()
+    # 只量吞吐量，不記錄每個腳位變化
+    backend = SimulatedBackend(trace_limit=0)
+    hal.use_simulation(backend)
+    return backend
+
+
+def long_move(scale):
+    """ One long diagonal movement on merged executor.
+    """
+    n = int(20000 * scale)
+    gen = PulseGeneratorLinear(Coordinates(n, n // 2, 0, 0), Coordinates(1000, 1000, 1000, 1000))
+    MergedStepExecutor().run(iter(gen))
+    return []
+
+
+def long_move_threads(scale):
+    """ The same movement on axis worker threads.
+    """
+    n = int(20000 * scale)
+    hal.add_task(PulseGeneratorLinear(Coordinates(n, n // 2, 0, 0), Coordinates(1000, 1000, 1000, 1000)))
+    hal.join()
+    return []
+
+
+def segments(scale):
+    """ G-code program of 10k short segments.
+    """
+    n = int(10000 * scale)
+    lines = ["G21", "G90"]
+    lines.extend("G1 X%d Y%d Z%d F%d" % (10 + i % 30, 10 + i % 11, 5 + i % 7, 100 + i % 50)
+                 for i in range(n))
+    lines.append("G28")
+    m = TimedGMachine()
+    GCodeRunner(m).run(lines)
+    return m.planning_ns
+
+
+def spiral(scale):
+    """ Filling spiral.
+    """
+    m = TimedGMachine()
+    m.filling(Coordinates(30, 30, 5, 0), 25 * min(scale, 1.0), 2, 0.5, Coordinates(300, 300, 300, 300))
+    m.flush()
+    hal.join()
+    return m.planning_ns
+
+
+def decoration(scale):
+    """ Decoration with random dots and strokes.
+    """
+    rnd = random.Random(1)
+    features = []
+    for i in range(int(500 * scale)):
+        x, y = rnd.uniform(0, 50), rnd.uniform(0, 50)
+        if i % 3:
+            features.append([(x, y)])
+        else:
+            features.append([(x, y), (x + rnd.uniform(-5, 5), y + rnd.uniform(-5, 5))])
+    m = TimedGMachine()
+    m.decoration(Coordinates(5, 5, 5, 0), features, Coordinates(300, 300, 300, 300),
+                 extrusion_per_mm=1.0, dot_extrusion=1.0, time_budget_s=0.5)
+    m.flush()
+    hal.join()
+    return m.planning_ns
+
+
+SCENARIOS = (('long_move', long_move),
+             ('long_move_threads', long_move_threads),
+             ('segments', segments),
+             ('spiral', spiral),
+             ('decoration', decoration))
+
+
+def run_scenario(function, scale, memory=True):
+    """ Run one scenario.
+    :param function: scenario function, it gets scale and returns list of
+                     planning times in ns, empty if scenario runs pulse
+                     generator directly.
+    :param scale: size of scenario, 1.0 is the default size.
+    :param memory: run scenario once more under tracemalloc.
+    :return: dict with results.
+    """
+    backend = _install_backend()
+    t = time.perf_counter()
+    planning = sorted(function(scale))
+    wall = time.perf_counter() - t
+    steps = sum(backend.steps().values())
+    result = {'steps': steps,
+              'wall_s': wall,
+              'machine_s': backend.elapsed_s(),
+              'steps_per_s': steps / wall if wall else 0.0,
+              'plans': len(planning)}
+    for p in PERCENTILES:
+        result['planning_p{}_us'.format(p)] = _percentile(planning, p) / 1e3
+    result['planning_max_us'] = (planning[-1] / 1e3) if planning else 0.0
+    if memory:
+        _install_backend()
+        tracemalloc.start()
+        function(scale)
+        result['peak_memory_kib'] = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+    return result
+
+
+def _best_ns(function, calls):
+    """ Get the best time of MICRO_REPEAT runs in ns per call.
+    :param function: function which makes calls and returns time in ns
+                     which they took.
+    :param calls: number of calls made by function.
+    """
+    return min(function() for _ in range(MICRO_REPEAT)) / float(calls)
+
+
+def micro(scale=1.0):
+    """ Measure hot paths of planning alone.
+    :param scale: number of calls, 1.0 is the default.
+    :return: dict with name as key and dict with ns per call as value.
+    """
+    n = max(1, int(20000 * scale))
+    velocity = Coordinates(1000, 1000, 1000, 1000)
+    delta = Coordinates(n, n // 2, n // 3, 0)
+    a = Coordinates(1.5, 2.5, 3.5, 4.5)
+    b = Coordinates(0.5, 1.5, 2.5, 3.5)
+    # base class time of accelerated movement, sub classes give ramp times
+    # themselves
+    accelerated = PulseGenerator(delta)
+    accelerated._2Vmax_per_a = 2.0 * 1000 / 5000
+    accelerated._acceleration_time_s = 0.2
+    accelerated._linear_time_s = 1.0
+    total = 2 * accelerated._acceleration_time_s + accelerated._linear_time_s
+    times = [total * i / n for i in range(n)]
+
+    def generator_next():
+        gen = iter(PulseGeneratorLinear(delta, velocity))
+        t = time.perf_counter_ns()
+        for _ in gen:
+            pass
+        return time.perf_counter_ns() - t
+
+    def generator_init():
+        t = time.perf_counter_ns()
+        for _ in range(100):
+            PulseGeneratorLinear(Coordinates(300, 200, 100, 0), velocity)
+        return time.perf_counter_ns() - t
+
+    def arithmetic():
+        t = time.perf_counter_ns()
+        for _ in range(n):
+            abs((a + b) * b - b / a).length()
+        return time.perf_counter_ns() - t
+
+    def accelerated_time():
+        f = accelerated._to_accelerated_time
+        t = time.perf_counter_ns()
+        for pt in times:
+            f(pt)
+        return time.perf_counter_ns() - t
+
+    gen = PulseGeneratorLinear(delta, velocity)
+    pulses = sum(1 for _ in gen) + 1
+    return {'PulseGenerator.next': {'ns_per_call': _best_ns(generator_next, pulses)},
+            'PulseGeneratorLinear.__init__': {'ns_per_call': _best_ns(generator_init, 100)},
+            'Coordinates arithmetic': {'ns_per_call': _best_ns(arithmetic, 6 * n)},
+            '_to_accelerated_time': {'ns_per_call': _best_ns(accelerated_time, n)}}
+
+
+def run(scale=1.0, memory=True, names=None):
+    """ Run benchmark suite.
+    :param scale: size of scenarios.
+    :param memory: measure peak memory.
+    :param names: list of scenario names, all if None.
+    :return: dict with scenario name as key and results as value.
+    """
+    results = {}
+    for name, function in SCENARIOS:
+        if names is None or name in names:
+            results[name] = run_scenario(function, scale, memory)
+    hal.shutdown()
+    return results
+
+
+def stop_latency(runs=200, seed=1):
+    """ Measure emergency stop latency against simulated clock. Stop comes
+        at random time of a movement, latency is machine time from stop to
+        the end of step loop. Axis worker loop is measured with movement of
+        X axis only, so only one worker thread runs, merged executor with
+        movement of X and Y.
+    :param runs: number of stops for each step loop.
+    :param seed: random seed.
+    :return: dict with step loop name as key and dict with latency
+             percentiles in us as value. Number of pulses made after stop
+             and number of runs where reached steps did not match simulated
+             position are also reported, both should be 0.
+    """
+    rnd = random.Random(seed)
+    velocity = Coordinates(300, 300, 300, 300)
+    results = {}
+    for name in ('worker', 'merged'):
+        latencies = []
+        late_pulses = 0
+        mismatches = 0
+        for _ in range(runs):
+            if name == 'worker':
+                gen = PulseGeneratorLinear(Coordinates(40, 0, 0, 0), velocity)
+            else:
+                gen = PulseGeneratorLinear(Coordinates(40, 25, 0, 0), velocity)
+            backend = StopBackend(rnd.uniform(0.05, 0.95) * gen.total_time_s(), hal.emergency_stop)
+            hal.configure_drivers()
+            hal.use_simulation(backend)
+            hal.reset_emergency_stop()
+            if name == 'worker':
+                hal.add_task(gen)
+                hal.join()
+                reached = hal.positions()
+            else:
+                executor = MergedStepExecutor()
+                executor.run(iter(gen))
+                reached = dict(zip(hal.AXES, executor.position))
+            if not backend.triggered:
+                continue
+            stop_s = hal.get_emergency_stop().time_ns / 1e9
+            latencies.append((backend.elapsed_s() - stop_s) * 1e6)
+            step_pins = set(d.step_pin for d in hal.drivers().values())
+            late_pulses += sum(1 for t, pin, level in backend.edges()
+                               if level and pin in step_pins and t > stop_s)
+            simulated = backend.positions()
+            if any(abs(reached.get(axis, 0) - simulated.get(axis, 0)) > 1e-9 for axis in simulated):
+                mismatches += 1
+        latencies.sort()
+        r = {'runs': len(latencies), 'late_pulses': late_pulses, 'mismatches': mismatches}
+        for p in PERCENTILES:
+            r['latency_p{}_us'.format(p)] = _percentile(latencies, p)
+        r['latency_max_us'] = latencies[-1] if latencies else 0.0
+        results[name] = r
+    hal.reset_emergency_stop()
+    hal.shutdown()
+    return results
+
+
+def report(results, micro_results=None, baseline=None):
+    """ Print results, with change against baseline if it is given.
+    :param results: results of run().
+    :param micro_results: results of micro(), not printed if None.
+    :param baseline: saved dict with 'scenarios' and 'micro' keys.
+    """
+    baseline = baseline or {}
+    base = baseline.get('scenarios', {})
+    print("{:<18} {:>9} {:>11} {:>6} {:>10} {:>10} {:>10} {:>10} {:>9}".format(
+        'scenario', 'steps', 'steps/s', 'plans', 'plan p50', 'plan p99', 'plan max',
+        'peak KiB', 'vs base'))
+    for name, r in results.items():
+        change = ''
+        if base.get(name, {}).get('steps_per_s'):
+            change = '{:+.1f}%'.format(100.0 * (r['steps_per_s'] / base[name]['steps_per_s'] - 1.0))
+        print("{:<18} {:>9.0f} {:>11.0f} {:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.0f} {:>9}".format(
+            name, r['steps'], r['steps_per_s'], r['plans'], r['planning_p50_us'],
+            r['planning_p99_us'], r['planning_max_us'], r.get('peak_memory_kib', 0.0), change))
+    if not micro_results:
+        return
+    base = baseline.get('micro', {})
+    print()
+    print("{:<30} {:>12} {:>9}".format('micro benchmark', 'ns/call', 'vs base'))
+    for name, r in micro_results.items():
+        change = ''
+        if base.get(name, {}).get('ns_per_call'):
+            change = '{:+.1f}%'.format(100.0 * (r['ns_per_call'] / base[name]['ns_per_call'] - 1.0))
+        print("{:<30} {:>12.0f} {:>9}".format(name, r['ns_per_call'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless step pipeline benchmark.')
+    parser.add_argument('--scale', type=float, default=1.0, help='size of scenarios')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline file')
+    parser.add_argument('--save', action='store_true', help='save results as baseline')
+    parser.add_argument('--no-memory', action='store_true', help='skip peak memory pass')
+    parser.add_argument('--no-micro', action='store_true', help='skip micro benchmarks')
+    parser.add_argument('--stop-latency', action='store_true',
+                        help='measure emergency stop latency')
+    parser.add_argument('--runs', type=int, default=200, help='emergency stops for each loop')
+    parser.add_argument('scenario', nargs='*', help='scenarios to run, all if empty')
+    args = parser.parse_args()
+    if args.stop_latency:
+        for name, r in stop_latency(args.runs).items():
+            print("{:<8} runs {} p50 {:.1f} us p99 {:.1f} us max {:.1f} us, "
+                  "pulses after stop {}, position errors {}".format(
+                      name, r['runs'], r['latency_p50_us'], r['latency_p99_us'],
+                      r['latency_max_us'], r['late_pulses'], r['mismatches']))
+        return
+    results = run(args.scale, not args.no_memory, args.scenario or None)
+    micro_results = None if args.no_micro else micro(args.scale)
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, micro_results, baseline)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'scenarios': results, 'micro': micro_results or {}}, f,
+                      indent=2, sort_keys=True)
+        print("baseline saved to {}".format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
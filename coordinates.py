@@ -1,21 +1,35 @@
 #from __future__ import division
 import math
+import numpy as np
 from logging_config import *
 
 class Coordinates(object):
     """ This object represent machine coordinates.
         Machine supports 3 axis, so there are X, Y and Z.
+        Object is immutable and hashable, operators return new objects.
     """
+    __slots__ = ('x', 'y', 'z', 'e')
+
     def __init__(self, x, y, z, e):
         """ Create object.
         :param x: x coordinated.
         :param y: y coordinated.
         :param z: z coordinated.
         """
-        self.x = round(x, 10)
-        self.y = round(y, 10)
-        self.z = round(z, 10)
-        self.e = round(e, 10)
+        _set = object.__setattr__
+        _set(self, 'x', round(x, 10))
+        _set(self, 'y', round(y, 10))
+        _set(self, 'z', round(z, 10))
+        _set(self, 'e', round(e, 10))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Coordinates object is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Coordinates object is immutable")
+
+    def __reduce__(self):
+        return Coordinates, (self.x, self.y, self.z, self.e)
 
     def coordinates(self, x,y,z,e): 
         """ Get X, Y and Z values as Coord object.
@@ -91,7 +105,21 @@ class Coordinates(object):
 #        return Coordinates(self.x / v, self.y / v, self.z / v, self.e / v)
 
     def __eq__(self, other):
-        return self.x == other.x, self.y == other.y, self.z == other.z, self.e == other.e
+        if not isinstance(other, Coordinates):
+            return NotImplemented
+        return (self.x == other.x and self.y == other.y
+                and self.z == other.z and self.e == other.e)
+
+    def __ne__(self, other):
+        if not isinstance(other, Coordinates):
+            return NotImplemented
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.x, self.y, self.z, self.e))
+
+    def __repr__(self):
+        return 'Coordinates' + str(self)
 
     def __str__(self):
         return '(' + str(self.x) + ', ' + str(self.y) + ', ' + str(self.z) + ', ' + str(self.e) + ')'
@@ -106,8 +134,134 @@ class Coordinates(object):
         return Coordinates(math.floor(self.x), math.floor(self.y), math.floor(self.z),  math.floor(self.e))
     
     def __gt__(self, other):
-        return self.x > other.x, self.y > other.y, self.z > other.z, self.e > other.e
+        """ True if all axises are greater. """
+        return (self.x > other.x and self.y > other.y
+                and self.z > other.z and self.e > other.e)
 
     def __lt__(self, other):
-        return self.x < other.x, self.y < other.y, self.z < other.z, self.e < other.e
-    
+        """ True if all axises are less. """
+        return (self.x < other.x and self.y < other.y
+                and self.z < other.z and self.e < other.e)
+
+
+class CoordinateArray(object):
+    """ Many points at once, i.e. whole path. Values are stored in NumPy
+        array of shape (N, 4) with X, Y, Z, E columns, so operations are
+        done for all points without creating Coordinates for each of them.
+        Operands may be CoordinateArray of the same length, Coordinates or
+        scalar value.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        """ Create object.
+        :param data: array-like of shape (N, 4).
+        """
+        data = np.asarray(data, dtype=np.float64)
+        if data.ndim != 2 or data.shape[1] != 4:
+            raise ValueError("CoordinateArray requires shape (N, 4)")
+        self.data = data
+
+    @classmethod
+    def from_coordinates(cls, points):
+        """ Create object from Coordinates objects.
+        :param points: iterable of Coordinates.
+        :return: CoordinateArray object.
+        """
+        return cls(np.array([(p.x, p.y, p.z, p.e) for p in points],
+                            dtype=np.float64).reshape(-1, 4))
+
+    @classmethod
+    def from_axes(cls, x, y, z, e):
+        """ Create object from separate axis arrays, scalars are broadcast.
+        :return: CoordinateArray object.
+        """
+        x, y, z, e = np.broadcast_arrays(x, y, z, e)
+        return cls(np.stack((x, y, z, e), axis=1))
+
+    @property
+    def x(self):
+        return self.data[:, 0]
+
+    @property
+    def y(self):
+        return self.data[:, 1]
+
+    @property
+    def z(self):
+        return self.data[:, 2]
+
+    @property
+    def e(self):
+        return self.data[:, 3]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return Coordinates(*self.data[index].tolist())
+        return CoordinateArray(self.data[index])
+
+    def __iter__(self):
+        for row in self.data.tolist():
+            yield Coordinates(*row)
+
+    @staticmethod
+    def _operand(other):
+        if isinstance(other, CoordinateArray):
+            return other.data
+        if isinstance(other, Coordinates):
+            return np.array((other.x, other.y, other.z, other.e))
+        return other
+
+    def __add__(self, other):
+        return CoordinateArray(self.data + self._operand(other))
+
+    def __sub__(self, other):
+        return CoordinateArray(self.data - self._operand(other))
+
+    def __mul__(self, other):
+        return CoordinateArray(self.data * self._operand(other))
+
+    def __truediv__(self, other):
+        return CoordinateArray(self.data / self._operand(other))
+
+    def __abs__(self):
+        return CoordinateArray(np.abs(self.data))
+
+    def round(self, base_x, base_y, base_z, base_e):
+        """ Round values to specified base, see Coordinates.round().
+        :return: New rounded object.
+        """
+        base = np.array((base_x, base_y, base_z, base_e))
+        return CoordinateArray(np.round(self.data / base) * base)
+
+    def length(self):
+        """ Calculate the length of each vector.
+        :return: array of lengths.
+        """
+        return np.sqrt(np.einsum('ij,ij->i', self.data, self.data))
+
+    def is_in_aabb(self, p1, p2):
+        """ Check each point is in aabb, see Coordinates.is_in_aabb().
+        :param p1: First point in Coord object.
+        :param p2: Second point in Coord object.
+        :return: boolean array.
+        """
+        a = self._operand(p1)[:3]
+        b = self._operand(p2)[:3]
+        xyz = self.data[:, :3]
+        return np.all((xyz >= np.minimum(a, b)) & (xyz <= np.maximum(a, b)),
+                      axis=1)
+
+    def diff(self):
+        """ Get deltas between consecutive points.
+        :return: CoordinateArray with one point less.
+        """
+        return CoordinateArray(np.diff(self.data, axis=0))
+
+    def to_list(self):
+        """ Convert to list of Coordinates.
+        """
+        return list(self)
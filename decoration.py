@@ -0,0 +1,340 @@
+import logging
+import math
+import time
+
+import numpy as np
+
+from logging_config import *
+from coordinates import *
+from pulse import delaytime_from_velocity, ramp_time_s
+from machine_profile import get_profile
+
+
+class DecorationFeature(object):
+    """ Dot or stroke of decoration. Dot has one point, stroke is polyline
+        which can be drawn from either end, unless it is not reversible.
+    """
+    def __init__(self, points, reversible=True):
+        """ Create object.
+        :param points: list of (x, y) tuples or Coordinates in mm.
+        :param reversible: stroke may be drawn from the last point.
+        """
+        self.points = [(p.x, p.y) if isinstance(p, Coordinates) else (p[0], p[1])
+                       for p in points]
+        if not self.points:
+            raise ValueError("decoration feature without points")
+        self.reversible = reversible or len(self.points) == 1
+
+    def is_dot(self):
+        return len(self.points) == 1
+
+    def oriented(self, reverse):
+        """ Get points in drawing order.
+        :param reverse: draw from the last point.
+        """
+        return self.points[::-1] if reverse else self.points
+
+    def length(self):
+        """ Get stroke length in mm.
+        """
+        return sum(math.hypot(b[0] - a[0], b[1] - a[1])
+                   for a, b in zip(self.points, self.points[1:]))
+
+
+def _cost(a, b):
+    """ Travel cost between two points. X and Y move at the same time,
+        so the longer axis distance decides.
+    """
+    if b is None or a is None:
+        return 0.0
+    return max(abs(a[0] - b[0]), abs(a[1] - b[1]))
+
+
+def travel_time_s(a, b, velocity=None, profile=None):
+    """ Estimate travel time between two XY points the same way as
+        PulseGeneratorLinear.total_time_s() does: each axis accelerates
+        from stop and brakes to stop, axises run in parallel.
+    :param a: start point (x, y).
+    :param b: end point (x, y).
+    :param velocity: travel velocity in mm/min, top speed if None.
+    :param profile: MachineProfile object, default profile if None.
+    :return: time in seconds.
+    """
+    t = 0.0
+    profile = profile or get_profile()
+    for i, d in enumerate((abs(b[0] - a[0]), abs(b[1] - a[1]))):
+        mm = profile.mm_per_step[i]
+        start = profile.delaytime_start[i]
+        add = profile.stepdelay_add[i]
+        fastest = profile.max_velocity_delaytime[i]
+        target = fastest
+        if velocity is not None:
+            target = max(fastest, delaytime_from_velocity(mm, velocity))
+        t = max(t, ramp_time_s(int(round(d / mm)), start, start, add, target))
+    return t
+
+
+class _GridIndex(object):
+    """ Uniform grid of feature endpoints for nearest neighbour search.
+    """
+    def __init__(self, features, cell):
+        self._cell = cell
+        self._cells = {}
+        self._points = {}
+        for fid, f in enumerate(features):
+            ends = [(f.points[0], False)]
+            if f.reversible and not f.is_dot():
+                ends.append((f.points[-1], True))
+            self._points[fid] = ends
+            for p, _ in ends:
+                self._cells.setdefault(self._key(p), set()).add(fid)
+        keys = list(self._cells.keys()) or [(0, 0)]
+        self._span = max(max(abs(k[0]) for k in keys), max(abs(k[1]) for k in keys)) + 1
+
+    def _key(self, p):
+        return int(math.floor(p[0] / self._cell)), int(math.floor(p[1] / self._cell))
+
+    def remove(self, fid):
+        for p, _ in self._points.pop(fid):
+            cell = self._cells.get(self._key(p))
+            if cell is not None:
+                cell.discard(fid)
+
+    def nearest(self, p):
+        """ Find nearest endpoint.
+        :return: tuple (feature id, reversed) or None if index is empty.
+        """
+        cx, cy = self._key(p)
+        best = None
+        r = 0
+        limit = self._span + max(abs(cx), abs(cy)) + 1
+        while r <= limit:
+            if best is not None and (r - 1) * self._cell > best[0]:
+                break
+            for kx in range(cx - r, cx + r + 1):
+                # only cells on the ring border
+                if abs(kx - cx) == r:
+                    ky_range = range(cy - r, cy + r + 1)
+                else:
+                    ky_range = (cy - r, cy + r)
+                for ky in ky_range:
+                    for fid in self._cells.get((kx, ky), ()):
+                        for q, rev in self._points[fid]:
+                            d = _cost(p, q)
+                            if best is None or d < best[0]:
+                                best = (d, fid, rev)
+            r += 1
+        if best is None:
+            return None
+        return best[1], best[2]
+
+
+class DecorationPlan(object):
+    """ Order of decoration features which minimizes travel between them.
+        Order is built by nearest neighbour search over grid index and
+        improved by 2-opt and Or-opt passes until time budget is over, no
+        move helps or max_passes is reached. 2-opt reverses part of the
+        order, so strokes inside it are drawn from the other end.
+    """
+    def __init__(self, features, origin=(0.0, 0.0), time_budget_s=DECORATION_TIME_BUDGET_S,
+                 neighbours=DECORATION_NEIGHBOURS, velocity=None, profile=None,
+                 max_passes=DECORATION_MAX_PASSES, ordered=False):
+        """ Create plan.
+        :param features: list of DecorationFeature objects or point lists.
+        :param origin: (x, y) position where the order starts.
+        :param time_budget_s: time for improvement of order.
+        :param neighbours: number of candidate neighbours for each feature.
+        :param velocity: travel velocity in mm/min for time estimation.
+        :param profile: MachineProfile object, default profile if None.
+        :param max_passes: maximum number of 2-opt and Or-opt passes.
+        :param ordered: features are already in drawing order and
+                        direction, i.e. points of other plan, they are not
+                        reordered.
+        """
+        self.features = [f if isinstance(f, DecorationFeature) else DecorationFeature(f)
+                         for f in features]
+        self._profile = profile or get_profile()
+        self.origin = (origin[0], origin[1])
+        self._velocity = velocity
+        n = len(self.features)
+        self.order = []
+        self.reversed = []
+        self.original_travel_time_s = self._travel_time(list(range(n)), [False] * n)
+        if n and ordered:
+            self.order = list(range(n))
+            self.reversed = [False] * n
+        elif n:
+            deadline = time.perf_counter() + time_budget_s
+            self._nearest_neighbour()
+            self._neighbours = self._neighbour_lists(neighbours)
+            passes = 0
+            while passes < max_passes and time.perf_counter() < deadline:
+                passes += 1
+                improved = self._two_opt(deadline)
+                improved = self._or_opt(deadline) or improved
+                if not improved:
+                    break
+            logging.info("decoration plan: {} features, {} passes".format(n, passes))
+        self.travel_time_s = self._travel_time(self.order, self.reversed)
+
+    def saved_s(self):
+        """ Get estimated travel time saved against the input order.
+        """
+        return self.original_travel_time_s - self.travel_time_s
+
+    def __iter__(self):
+        """ Iterate features in drawing order.
+        :return: generator of lists of (x, y) points in drawing direction.
+        """
+        for fid, rev in zip(self.order, self.reversed):
+            yield self.features[fid].oriented(rev)
+
+    def _travel_time(self, order, rev):
+        t = 0.0
+        p = self.origin
+        for fid, r in zip(order, rev):
+            pts = self.features[fid].oriented(r)
+            t += travel_time_s(p, pts[0], self._velocity, self._profile)
+            p = pts[-1]
+        return t
+
+    def _start(self, pos):
+        if pos < 0:
+            return self.origin
+        if pos >= len(self.order):
+            return None
+        f = self.features[self.order[pos]]
+        return f.points[-1] if self.reversed[pos] else f.points[0]
+
+    def _end(self, pos):
+        if pos < 0:
+            return self.origin
+        if pos >= len(self.order):
+            return None
+        f = self.features[self.order[pos]]
+        return f.points[0] if self.reversed[pos] else f.points[-1]
+
+    def _nearest_neighbour(self):
+        pts = [p for f in self.features for p in (f.points[0], f.points[-1])]
+        xs = [p[0] for p in pts]
+        ys = [p[1] for p in pts]
+        area = max(max(xs) - min(xs), 1e-3) * max(max(ys) - min(ys), 1e-3)
+        index = _GridIndex(self.features, math.sqrt(area / len(self.features)) * 2.0)
+        p = self.origin
+        for _ in range(len(self.features)):
+            fid, rev = index.nearest(p)
+            index.remove(fid)
+            self.order.append(fid)
+            self.reversed.append(rev)
+            p = self.features[fid].oriented(rev)[-1]
+
+    def _neighbour_lists(self, k):
+        """ Nearest features of each feature by endpoint distance.
+        """
+        n = len(self.features)
+        k = min(k, n - 1)
+        if k <= 0:
+            return [[] for _ in range(n)]
+        ends = np.array([f.points[0] + f.points[-1] for f in self.features])
+        result = []
+        for lo in range(0, n, 256):
+            block = ends[lo:lo + 256]
+            d = None
+            for a in ((0, 1), (2, 3)):
+                for b in ((0, 1), (2, 3)):
+                    c = np.maximum(np.abs(block[:, None, a[0]] - ends[None, :, b[0]]),
+                                   np.abs(block[:, None, a[1]] - ends[None, :, b[1]]))
+                    d = c if d is None else np.minimum(d, c)
+            d[np.arange(len(block)), np.arange(lo, lo + len(block))] = np.inf
+            near = np.argpartition(d, k - 1, axis=1)[:, :k]
+            result.extend(near.tolist())
+        return result
+
+    def _reverse(self, lo, hi):
+        """ Reverse positions lo..hi, strokes are flipped too.
+        """
+        self.order[lo:hi + 1] = self.order[lo:hi + 1][::-1]
+        self.reversed[lo:hi + 1] = [not r for r in self.reversed[lo:hi + 1][::-1]]
+        for p in range(lo, hi + 1):
+            self._pos[self.order[p]] = p
+
+    def _two_opt(self, deadline):
+        n = len(self.order)
+        self._pos = [0] * n
+        for p, fid in enumerate(self.order):
+            self._pos[fid] = p
+        fixed = [not f.reversible for f in self.features]
+        any_fixed = any(fixed)
+        improved = False
+        for i in range(-1, n - 1):
+            if time.perf_counter() > deadline:
+                break
+            candidates = self._neighbours[self.order[i + 1]] if i < 0 else self._neighbours[self.order[i]]
+            for g in candidates:
+                j = self._pos[g]
+                for lo, hi in ((min(i, j), max(i, j)), (min(i, j - 1), max(i, j - 1))):
+                    if hi < lo + 1:
+                        continue
+                    delta = (_cost(self._end(lo), self._end(hi))
+                             + _cost(self._start(lo + 1), self._start(hi + 1))
+                             - _cost(self._end(lo), self._start(lo + 1))
+                             - _cost(self._end(hi), self._start(hi + 1)))
+                    if delta < -1e-9:
+                        if any_fixed and any(fixed[f] for f in self.order[lo + 1:hi + 1]):
+                            continue
+                        self._reverse(lo + 1, hi)
+                        improved = True
+                        break
+        return improved
+
+    def _or_opt(self, deadline):
+        improved = False
+        n = len(self.order)
+        for length in (1, 2, 3):
+            i = 0
+            while i + length <= n:
+                if time.perf_counter() > deadline:
+                    return improved
+                if self._move_segment(i, length):
+                    improved = True
+                i += 1
+        return improved
+
+    def _move_segment(self, i, length):
+        """ Try to move positions i..i+length-1 to better place.
+        :return: True if segment was moved.
+        """
+        last = i + length - 1
+        seg = self.order[i:last + 1]
+        seg_s, seg_e = self._start(i), self._end(last)
+        remove = (_cost(self._end(i - 1), seg_s) + _cost(seg_e, self._start(last + 1))
+                  - _cost(self._end(i - 1), self._start(last + 1)))
+        can_flip = all(self.features[f].reversible for f in seg)
+        best = None
+        for g in set(h for f in seg for h in self._neighbours[f]):
+            pg = self._pos[g]
+            for j in (pg - 1, pg):
+                if i - 1 <= j <= last:
+                    continue
+                a, b = self._end(j), self._start(j + 1)
+                base = _cost(a, b)
+                for flip in ((False, True) if can_flip else (False,)):
+                    s, e = (seg_e, seg_s) if flip else (seg_s, seg_e)
+                    gain = remove - (_cost(a, s) + _cost(e, b) - base)
+                    if gain > 1e-9 and (best is None or gain > best[0]):
+                        best = (gain, j, flip)
+        if best is None:
+            return False
+        _, j, flip = best
+        rev = self.reversed[i:last + 1]
+        if flip:
+            seg = seg[::-1]
+            rev = [not r for r in rev[::-1]]
+        del self.order[i:last + 1]
+        del self.reversed[i:last + 1]
+        at = j + 1 if j < i else j + 1 - length
+        self.order[at:at] = seg
+        self.reversed[at:at] = rev
+        for p, fid in enumerate(self.order):
+            self._pos[fid] = p
+        return True
@@ -0,0 +1,199 @@
+import array
+import logging
+import time
+
+from logging_config import *
+import hal
+from steptrace import get_trace
+
+
+AXES = ('x', 'y', 'z', 'e')
+
+class ExecutorStopInterrupt(Exception):
+    """ Executor was stopped during movement.
+    """
+    pass
+
+
+class MergedStepExecutor(object):
+    """ Run all axises from one thread. Pulses come as one time ordered
+        stream, as PulseGenerator.next() produces them, and all axises
+        which are due at the same time are pulsed by one GPIO write, so
+        axises can not drift relative to each other.
+        Every pulse is one full step, STEPPER_STEPTYPE Auto microstepping
+        is done only by motor_go of axis workers. Mode pins are set to full
+        step at the start of each run, motor_go in Auto mode leaves driver
+        in the mode of its last step.
+    """
+    def __init__(self, pin_map=None, backend=None,
+                 spin_threshold_ns=STEP_SPIN_THRESHOLD_NS,
+                 pulse_width_ns=STEP_PULSE_WIDTH_NS, mode_pins=None):
+        """ Create object.
+        :param pin_map: dict with axis name ('x', 'y', 'z', 'e') as key
+                        and tuple (step_pin, direction_pin, enable_pin) as
+                        value. Axises without pins are ignored. Pins
+                        of hal driver registry if None.
+        :param backend: HALBackend object, hal backend if None.
+        :param spin_threshold_ns: busy-wait this last part of waiting.
+        :param pulse_width_ns: time step pin is held high.
+        :param mode_pins: microstep mode pins of A4988 drivers, mode pins of
+                          hal driver registry if None and pin_map is None.
+        """
+        if pin_map is None:
+            pin_map = hal.pin_map()
+            if mode_pins is None:
+                mode_pins = hal.mode_pins()
+        self.mode_pins = list(mode_pins or ())
+        self.pin_map = dict(pin_map)
+        self.gpio = backend or hal.get_backend()
+        self.spin_threshold_ns = spin_threshold_ns
+        self.pulse_width_ns = pulse_width_ns
+        self.position = [0, 0, 0, 0]
+        # pulses made on each axis since creation, direction is ignored
+        self.steps_done = [0, 0, 0, 0]
+        self.lateness_ns = array.array('q')
+        self._stop = False
+        self._step_pins = [None, None, None, None]
+        self._direction_pins = [None, None, None, None]
+        for i, axis in enumerate(AXES):
+            if axis in self.pin_map:
+                step_pin, direction_pin, enable_pin = self.pin_map[axis]
+                self._step_pins[i] = step_pin
+                self._direction_pins[i] = direction_pin
+                self.gpio.setup((step_pin, direction_pin, enable_pin),
+                                self.gpio.OUT)
+                self.gpio.output(step_pin, False)
+        if self.mode_pins:
+            self.gpio.setup(self.mode_pins, self.gpio.OUT)
+
+    def stop(self):
+        """ Stop running movement at the next pulse.
+        """
+        self._stop = True
+
+    def run(self, pulses):
+        """ Execute movement. Emergency stop of hal is checked before each
+            pulse, position has only pulses which were made.
+        :param pulses: iterable of tuples in PulseGenerator.next() format,
+                       i.e. PulseGenerator or PulseTimeline.iter_pulses().
+        :return: number of pulses made on all axises.
+        """
+        self._stop = False
+        estop = hal.get_emergency_stop()
+        if estop.active:
+            return 0
+        self.lateness_ns = array.array('q')
+        gpio = self.gpio
+        spin = self.spin_threshold_ns
+        width = self.pulse_width_ns
+        step_pins = self._step_pins
+        steps_done = self.steps_done
+        direction = [1, 1, 1, 1]
+        enable_pins = [p[2] for p in self.pin_map.values()]
+        if self.mode_pins:
+            # 全步: A4988 細分腳位全部為低
+            gpio.output(self.mode_pins, [False] * len(self.mode_pins))
+        gpio.output(enable_pins, False)
+        count = 0
+        trace = get_trace()
+        planned = [None, None, None, None]
+        actual = [None, None, None, None]
+        t0 = gpio.now_ns()
+        try:
+            for pulse in pulses:
+                if self._stop:
+                    raise ExecutorStopInterrupt
+                if pulse[0]:
+                    pins, levels = [], []
+                    for i in range(4):
+                        direction[i] = 1 if pulse[i + 1] > 0 else -1
+                        if self._direction_pins[i] is not None:
+                            pins.append(self._direction_pins[i])
+                            levels.append(direction[i] > 0)
+                    gpio.output(pins, levels)
+                    continue
+                pins = []
+                t = None
+                for i in range(4):
+                    ti = pulse[i + 1]
+                    if ti is None:
+                        continue
+                    t = ti
+                    count += 1
+                    self.position[i] += direction[i]
+                    steps_done[i] += 1
+                    if step_pins[i] is not None:
+                        pins.append(step_pins[i])
+                deadline = t0 + int(round(t * 1e9))
+                late = hal.wait_or_stop(gpio, deadline, spin, estop)
+                if late is None:
+                    # pulse was counted, but it is not made
+                    for i in range(4):
+                        if pulse[i + 1] is not None:
+                            count -= 1
+                            self.position[i] -= direction[i]
+                            steps_done[i] -= 1
+                    gpio.output(enable_pins, True)
+                    raise ExecutorStopInterrupt
+                self.lateness_ns.append(late)
+                gpio.output(pins, True)
+                if trace.enabled:
+                    edge = deadline + late
+                    for i in range(4):
+                        if pulse[i + 1] is not None:
+                            trace.record(i, edge,
+                                         deadline - planned[i] if planned[i] is not None else 0,
+                                         edge - actual[i] if actual[i] is not None else 0)
+                            planned[i] = deadline
+                            actual[i] = edge
+                gpio.wait_until_ns(deadline + width, spin)
+                gpio.output(pins, False)
+        except ExecutorStopInterrupt:
+            logging.info("merged executor stopped")
+        finally:
+            gpio.output([p for p in step_pins if p is not None], False)
+        gpio.sync()
+        return count
+
+    def run_timeline(self, timeline):
+        """ Execute compiled movement.
+        :param timeline: PulseTimeline object.
+        :return: number of pulses made on all axises.
+        """
+        return self.run(timeline.iter_pulses())
+
+
+def benchmark(gen, backend):
+    """ Compare Python overhead of the merged executor and of thread per
+        axis hal.add_task for the same movement.
+    :param gen: PulseGeneratorLinear object.
+    :param backend: SimulatedBackend object, rising edges are counted from
+                    its trace. It becomes hal backend, so it should be
+                    created before the first hal.add_task.
+    :return: dict with 'merged' and 'threads' keys, values are tuples of
+             (rising edges, wall time in seconds, pulses per second).
+    """
+    def rising_edges():
+        return sum(1 for _, pin, level in backend.trace
+                   if level and pin in step_pins)
+
+    step_pins = set(p[0] for p in hal.pin_map().values())
+    hal.set_backend(backend)
+    result = {}
+
+    executor = MergedStepExecutor(backend=backend)
+    before = rising_edges()
+    t = time.perf_counter()
+    executor.run(iter(gen))
+    t = time.perf_counter() - t
+    n = rising_edges() - before
+    result['merged'] = (n, t, n / t if t else 0.0)
+
+    before = rising_edges()
+    t = time.perf_counter()
+    hal.add_task(gen)
+    hal.join()
+    t = time.perf_counter() - t
+    n = rising_edges() - before
+    result['threads'] = (n, t, n / t if t else 0.0)
+    return result
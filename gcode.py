@@ -0,0 +1,217 @@
+import logging
+import threading
+import queue
+
+from logging_config import *
+from coordinates import *
+
+
+class GCodeException(Exception):
+    """ Exceptions while parsing gcode line.
+    """
+    pass
+
+
+class GCode(object):
+    """ One parsed gcode line.
+    """
+    def __init__(self, command, params, line_number=None):
+        """ Create object.
+        :param command: command, i.e. 'G0'.
+        :param params: dict with letter as key and float as value.
+        :param line_number: number of line in source, for error messages.
+        """
+        self.command = command
+        self.params = params
+        self.line_number = line_number
+
+    def get(self, letter, default=None):
+        """ Get parameter value.
+        :param letter: parameter letter, i.e. 'X'.
+        :param default: value if parameter is not specified.
+        """
+        return self.params.get(letter, default)
+
+    def has(self, letter):
+        return letter in self.params
+
+    def __str__(self):
+        return self.command + ''.join(' {}{}'.format(k, v) for k, v in sorted(self.params.items()))
+
+
+def parse_line(line, line_number=None):
+    """ Parse gcode line. Comments in brackets and after ';' are removed.
+    :param line: string.
+    :param line_number: number of line in source, for error messages.
+    :return: GCode object or None for empty line.
+    """
+    i = line.find(';')
+    if i >= 0:
+        line = line[:i]
+    while '(' in line:
+        a = line.find('(')
+        b = line.find(')', a)
+        if b < 0:
+            raise GCodeException("unclosed comment, line {}".format(line_number))
+        line = line[:a] + ' ' + line[b + 1:]
+    line = line.strip().upper()
+    if not line:
+        return None
+    command = None
+    params = {}
+    words = line.replace(' ', '').replace('\t', '')
+    n = 0
+    while n < len(words):
+        letter = words[n]
+        if not letter.isalpha():
+            raise GCodeException("bad word '{}', line {}".format(words[n:], line_number))
+        m = n + 1
+        while m < len(words) and not words[m].isalpha():
+            m += 1
+        try:
+            value = float(words[n + 1:m])
+        except ValueError:
+            raise GCodeException("bad value of {}, line {}".format(letter, line_number))
+        if letter in 'GM' and command is None:
+            command = letter + ('%g' % value)
+        elif letter == 'N':
+            pass
+        else:
+            params[letter] = value
+        n = m
+    return GCode(command, params, line_number)
+
+
+def iter_gcode(lines):
+    """ Parse lines lazily.
+    :param lines: iterable of strings, i.e. opened file.
+    :return: generator of GCode objects.
+    """
+    for n, line in enumerate(lines, 1):
+        gcode = parse_line(line, n)
+        if gcode is not None:
+            yield gcode
+
+
+class GCodeRunner(object):
+    """ Run gcode program on GMachine. Program is read and parsed by reader
+        thread into bounded queue, so big files start to move immediately
+        and use constant memory, while machine plans and runs movements.
+    """
+    def __init__(self, machine, read_ahead=GCODE_READ_AHEAD):
+        """ Create object.
+        :param machine: GMachine object.
+        :param read_ahead: maximum number of parsed lines waiting in queue.
+        """
+        self._machine = machine
+        self._read_ahead = read_ahead
+        self._absolute = True
+        self._feed = GCODE_DEFAULT_FEED_MM_PER_MIN
+        self._position = None
+        self._stop = False
+        self.count = 0
+
+    def stop(self):
+        """ Stop program before the next command, commands which were
+            already given to machine are not stopped.
+        """
+        self._stop = True
+
+    def _reader(self, lines, q, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for gcode in iter_gcode(lines):
+                if not put(gcode):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    def run(self, source):
+        """ Run program.
+        :param source: file name or iterable of lines.
+        :return: number of executed commands.
+        """
+        if isinstance(source, str):
+            with open(source) as f:
+                return self._run(f)
+        return self._run(source)
+
+    def _run(self, lines):
+        self._stop = False
+        self._position = self._machine._local
+        q = queue.Queue(maxsize=self._read_ahead)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._reader, args=(lines, q, stop))
+        reader.daemon = True
+        reader.start()
+        try:
+            while not self._stop:
+                gcode = q.get()
+                if gcode is None:
+                    break
+                if isinstance(gcode, Exception):
+                    raise gcode
+                self.execute(gcode)
+        finally:
+            stop.set()
+            reader.join()
+        if not self._stop:
+            self._machine.flush()
+        self._machine.join()
+        return self.count
+
+    def execute(self, gcode):
+        """ Execute one gcode command.
+        :param gcode: GCode object.
+        """
+        if gcode.has('F'):
+            self._feed = gcode.get('F')
+        c = gcode.command
+        if c is None:
+            return
+        p = self._position
+        if c in ('G0', 'G1', 'G2', 'G3'):
+            if self._absolute:
+                target = Coordinates(gcode.get('X', p.x), gcode.get('Y', p.y),
+                                     gcode.get('Z', p.z), gcode.get('E', p.e))
+            else:
+                target = p + Coordinates(gcode.get('X', 0.0), gcode.get('Y', 0.0),
+                                         gcode.get('Z', 0.0), gcode.get('E', 0.0))
+            if c in ('G2', 'G3'):
+                self._do(c, target, {'I': gcode.get('I', 0.0), 'J': gcode.get('J', 0.0)})
+            else:
+                self._do(c, target)
+        elif c == 'G28':
+            # axises without words are all homed
+            if not any(gcode.has(a) for a in 'XYZE'):
+                target = Coordinates(0.0, 0.0, 0.0, p.e)
+            else:
+                target = Coordinates(0.0 if gcode.has('X') else p.x,
+                                     0.0 if gcode.has('Y') else p.y,
+                                     0.0 if gcode.has('Z') else p.z,
+                                     0.0 if gcode.has('E') else p.e)
+            self._do(c, target)
+        elif c == 'G90':
+            self._absolute = True
+        elif c == 'G91':
+            self._absolute = False
+        elif c == 'G21':
+            pass
+        else:
+            logging.warning("unsupported gcode '{}', line {}".format(gcode, gcode.line_number))
+
+    def _do(self, command, target, params=None):
+        f = self._feed
+        self._machine.do_command(command, target, Coordinates(f, f, f, f), params)
+        self._position = target
+        self.count += 1
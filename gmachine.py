@@ -1,10 +1,18 @@
 from __future__ import division
 import logging
+import math
+
+import numpy as np
 
 from logging_config import *
 import hal
 from pulse import *
 from coordinates import *
+from planner import MotionPlanner
+from spiral import SpiralPath
+from executor import MergedStepExecutor
+from decoration import DecorationPlan
+from machine_profile import get_profile
 
 class GMachineException(Exception):
     """ Exceptions while processing gcode line.
@@ -13,15 +21,28 @@ class GMachineException(Exception):
 
 class GMachine(object):
     
-    def __init__(self):
+    def __init__(self, profile=None, step_process=None):
         """ Initialization.
+        :param profile: MachineProfile object, default profile if None.
+                        Pulses go to drivers of hal.configure_drivers(),
+                        which are shared by all machines of the process.
+        :param step_process: StepProcess object, pulses are made by it
+                             instead of hal axis workers and arc executor.
         """
+        self._profile = profile or get_profile()
         self._position = Coordinates(0.0, 0.0, 0.0, 0.0)
         # init variables
         self._velocity = 2
-        self._local = Coordinates(0.0, 0.0, 0.0, 0.0)
+        # 各軸步數換算係數，只在 API 邊界轉換 mm <-> step
+        self._mm_per_step = self._profile.mm_per_step
+        self._steps_per_mm = self._profile.steps_per_mm
+        self._steps = [0, 0, 0, 0]
         self._convertCoordinates = 0   #單位換算
         self._absoluteCoordinates = 0
+        self._step_process = step_process
+        execute = hal.add_task if step_process is None else step_process.add_task
+        self._planner = MotionPlanner(execute, profile=self._profile)
+        self._executor = None
         self.reset()
         
          
@@ -30,48 +51,304 @@ class GMachine(object):
         """ Reinitialize all program configurable thing.
         """
         
-        self._local = Coordinates(0.0, 0.0, 0.0, 0.0)
+        self._steps = [0, 0, 0, 0]
+        # position and steps really made by axises at the same moment, see
+        # sync_position()
+        self._mark = (list(self._steps), self._made_steps())
         #self._convertCoordinates = 1.0
         self._absoluteCoordinates = True
 
     def __check_delta(self, delta):  ###限制要再修改
         pos = self._position + delta
-        if not pos.is_in_aabb(Coordinates(0.0, 0.0, 0.0, 0.0), Coordinates(TABLE_SIZE_X_MM, TABLE_SIZE_Y_MM,TABLE_SIZE_Z_MM, 0)):
+        if not pos.is_in_aabb(Coordinates(0.0, 0.0, 0.0, 0.0), self._profile.table_size_vector):
             raise GMachineException("out of effective area")
             
     def __check_velocity(self,max_velocity):
-        if max_velocity.x > (1/(400 * MAX_VELOCITY_DELAYTIME_X + 0.036)*200*mm_per_step_x) \
-                or max_velocity.y > (1/(400 * MAX_VELOCITY_DELAYTIME_Y + 0.036)*200*mm_per_step_y) \
-                or max_velocity.z > (1/(400 * MAX_VELOCITY_DELAYTIME_Z + 0.036)*200*mm_per_step_z) \
-                or max_velocity.e > (1/(400 * MAX_VELOCITY_DELAYTIME_E + 0.036)*200*mm_per_step_e):
+        # 速度上下限在 profile 建立時已算好
+        v = (max_velocity.x, max_velocity.y, max_velocity.z, max_velocity.e)
+        if any(a > b for a, b in zip(v, self._profile.max_velocity)):
             raise GMachineException("out of maximum speed")
-        elif max_velocity.x < (1/(400 * delaytime_start_x + 0.036)*200*mm_per_step_x) \
-                or max_velocity.y < (1/(400 * delaytime_start_y + 0.036)*200*mm_per_step_y) \
-                or max_velocity.z < (1/(400 * delaytime_start_z + 0.036)*200*mm_per_step_z) \
-                or max_velocity.e < (1/(400 * delaytime_start_e + 0.036)*200*mm_per_step_e):
+        elif any(a < b for a, b in zip(v, self._profile.min_velocity)):
             raise GMachineException("out of minimum speed")
             
             
+    @property
+    def _local(self):
+        """ Current position in mm, converted from step counts. It is a
+            plain read, after stop position is updated by sync_position().
+        """
+        return self._to_mm(self._steps)
+
+    def _check_emergency_stop(self):
+        """ Refuse movement during emergency stop. Position is set where
+            axises stopped, it runs in the thread which gives movements, so
+            planner is not touched from other threads.
+        """
+        if hal.emergency_stopped():
+            self.sync_position()
+            raise GMachineException("emergency stop")
+
+    def _to_steps(self, coordinates):
+        """ Convert Coordinates in mm to nearest integer steps.
+        :return: list of four integers.
+        """
+        k = self._steps_per_mm
+        return [int(round(coordinates.x * k[0])), int(round(coordinates.y * k[1])),
+                int(round(coordinates.z * k[2])), int(round(coordinates.e * k[3]))]
+
+    def _to_mm(self, steps):
+        """ Convert step counts to Coordinates in mm.
+        """
+        m = self._mm_per_step
+        return Coordinates(steps[0] * m[0], steps[1] * m[1],
+                           steps[2] * m[2], steps[3] * m[3])
+
     def _move_linear(self, delta, velocity):
-        delta = delta.round(mm_per_step_x,\
-                            mm_per_step_y,\
-                            mm_per_step_z,\
-                            mm_per_step_e)
-        print('_move_linear')
-        if delta.is_zero():
-            print(delta.x,delta.y,delta.z,delta.e)
-            print('delta.is_zero')
+        self._move_steps(self._to_steps(delta), velocity)
+
+    def _move_steps(self, steps, velocity):
+        """ Move by integer number of steps on each axis. Position is kept
+            in steps, so it does not drift after many movements.
+        :param steps: list of four integers.
+        :param velocity: velocity for each axis, Coordinates object.
+        """
+        if not any(steps):
             return
+        self._check_emergency_stop()
+        delta = self._to_mm(steps)
         #self.__check_delta(delta)
 
         logging.info("Moving linearly {}".format(delta))
-        gen = PulseGeneratorLinear(delta, velocity)
-        #self.__check_velocity(gen.max_velocity())
-        
-        hal.add_task(gen)
+        # 規劃器往前看，決定轉角速度後才送到 hal
+        self._planner.add(delta, velocity, steps)
         # save position
-        self._local += delta
-        print('self._local:',self._local)
+        for i in range(4):
+            self._steps[i] += steps[i]
+
+    def _move_arc(self, steps, center, clockwise, velocity):
+        """ Move by arc in XY plane, Z and E move linearly along it.
+        :param steps: list of four integers, movement in steps.
+        :param center: arc center relative to current position (I, J) in mm.
+        :param clockwise: True for G2, False for G3.
+        :param velocity: velocity, slower of X and Y is tangential velocity.
+        """
+        self._check_emergency_stop()
+        delta = self._to_mm(steps)
+        logging.info("Moving circularly {} around {}".format(delta, center))
+        try:
+            gen = PulseGeneratorCircular(delta, center, clockwise, min(velocity.x, velocity.y),
+                                         self._profile, steps)
+        except ValueError as e:
+            raise GMachineException(str(e))
+        if self._step_process is not None:
+            # 圓弧接在直線移動後寫入同一個環形緩衝
+            self.flush()
+            self._step_process.add_task(gen)
+            for i in range(4):
+                self._steps[i] += steps[i]
+            return
+        # 圓弧由單執行緒合併執行器執行，需先等前面的直線移動完成
+        self.flush()
+        hal.join()
+        if self._executor is None:
+            self._executor = MergedStepExecutor()
+        self._executor.run(gen)
+        for i in range(4):
+            self._steps[i] += steps[i]
+
+    def icing(self, center, radius, extrusion_rate, velocity, layers=1, layer_height=0.0, clockwise=True):
+        """ Ice side of round cake, one full circle for each layer.
+        :param center: Coordinates of cake center, Z is height of the first
+                       layer.
+        :param radius: icing radius in mm.
+        :param extrusion_rate: extruder velocity in mm per second.
+        :param velocity: velocity, slower of X and Y is tangential velocity.
+        :param layers: number of circles.
+        :param layer_height: Z rise between circles in mm.
+        :param clockwise: circle direction.
+        """
+        tangential = min(velocity.x, velocity.y)
+        e_mm = extrusion_rate * SECONDS_IN_MINUTE * 2.0 * math.pi * radius / tangential
+        e_steps = int(round(e_mm * self._steps_per_mm[3]))
+        z_steps = int(round(layer_height * self._steps_per_mm[2]))
+        start = self._to_steps(Coordinates(center.x + radius, center.y, center.z, 0))
+        self._move_steps([start[0] - self._steps[0], start[1] - self._steps[1],
+                          start[2] - self._steps[2], 0], velocity)
+        for layer in range(layers):
+            if layer and z_steps:
+                self._move_steps([0, 0, z_steps, 0], velocity)
+            self._move_arc([0, 0, 0, e_steps], Coordinates(-radius, 0, 0, 0), clockwise, velocity)
+
+    def decoration(self, origin, features, velocity, extrusion_per_mm=0.0, dot_extrusion=0.0,
+                   time_budget_s=DECORATION_TIME_BUDGET_S, max_passes=DECORATION_MAX_PASSES,
+                   ordered=False):
+        """ Draw dots and strokes in order with the shortest travel. Order
+            starts at design origin, not at head position, so it is the
+            same wherever machine is, see batch_planner.
+        :param origin: Coordinates of design origin, Z is drawing height.
+        :param features: list of DecorationFeature objects or point lists,
+                         in mm relative to origin.
+        :param velocity: velocity for travel and drawing.
+        :param extrusion_per_mm: E movement per mm of stroke.
+        :param dot_extrusion: E movement for each dot.
+        :param time_budget_s: time for order optimization.
+        :param max_passes: maximum number of order optimization passes.
+        :param ordered: features are already in drawing order, i.e. points
+                        of DecorationPlan, they are drawn as given.
+        :return: DecorationPlan object.
+        """
+        plan = DecorationPlan(features, time_budget_s=time_budget_s,
+                              velocity=min(velocity.x, velocity.y), profile=self._profile,
+                              max_passes=max_passes, ordered=ordered)
+        logging.info("decoration travel {:.1f}s, saved {:.1f}s".format(
+            plan.travel_time_s, plan.saved_s()))
+        z = self._to_steps(origin)[2]
+        for points in plan:
+            for n, p in enumerate(points):
+                target = self._to_steps(Coordinates(origin.x + p[0], origin.y + p[1], 0, 0))
+                e = 0
+                if n:
+                    prev = points[n - 1]
+                    e = int(round(math.hypot(p[0] - prev[0], p[1] - prev[1])
+                                  * extrusion_per_mm * self._steps_per_mm[3]))
+                self._move_steps([target[0] - self._steps[0], target[1] - self._steps[1],
+                                  z - self._steps[2], e], velocity)
+            if len(points) == 1 and dot_extrusion:
+                self._move_steps([0, 0, 0, int(round(dot_extrusion * self._steps_per_mm[3]))],
+                                 velocity)
+        return plan
+
+    def _set_steps(self, steps):
+        """ Set position in steps without movement, machine is considered
+            to be already there.
+        :param steps: list of four integers.
+        """
+        self._steps = list(steps)
+        self._mark = (list(self._steps), self._made_steps())
+
+    def run_compiled(self, job):
+        """ Run job which was planned before, see job_cache. Recorded
+            pulses are replayed, nothing is planned.
+        :param job: CompiledJob or JobRecorder object, it should start at
+                    current position.
+        """
+        self._check_emergency_stop()
+        self.flush()
+        if [int(round(s)) for s in self._steps] != list(job.start_steps):
+            raise GMachineException("job starts at {}, machine is at {}".format(
+                list(job.start_steps), self._steps))
+        if self._step_process is not None:
+            self._step_process.add_task(job.iter_pulses())
+        else:
+            hal.join()
+            if self._executor is None:
+                self._executor = MergedStepExecutor()
+            self._executor.run(job.iter_pulses())
+        for i in range(4):
+            self._steps[i] += job.delta_steps[i]
+
+    def flush(self):
+        """ Run all movements which wait in planner, machine stops after
+            the last one.
+        """
+        self._planner.flush()
+
+    def join(self):
+        """ Wait until all movements given to axises are made, see flush().
+        """
+        hal.join()
+        if self._step_process is not None:
+            self._step_process.join()
+
+    def stop(self):
+        """ Stop machine: running movements of all axises are stopped with
+            A4988Nema.motor_stop(), queued and planned movements are
+            dropped. Use sync_position() to get position where machine
+            stopped. Can be called from any thread, planned movements are
+            dropped by the thread which runs commands before its next
+            movement.
+        """
+        self._planner.cancel()
+        hal.stop()
+        if self._executor is not None:
+            self._executor.stop()
+        if self._step_process is not None:
+            self._step_process.stop()
+
+    def emergency_stop(self):
+        """ Stop all axises at once, see hal.emergency_stop(). Machine
+            refuses movements until reset_emergency_stop(). Can be called
+            from any thread.
+        """
+        hal.emergency_stop()
+        if self._step_process is not None:
+            self._step_process.emergency_stop()
+
+    def reset_emergency_stop(self):
+        """ Allow movements after emergency stop, position is set where
+            axises stopped.
+        """
+        self.sync_position()
+        hal.reset_emergency_stop()
+        if self._step_process is not None:
+            self._step_process.reset_emergency_stop()
+
+    def _made_steps(self):
+        """ Get steps really made by axis workers and arc executor since
+            start, in machine direction.
+        :return: list of four numbers.
+        """
+        made = hal.positions()
+        result = [made.get(axis, 0) for axis in hal.AXES]
+        if self._executor is not None:
+            result = [a + b for a, b in zip(result, self._executor.position)]
+        if self._step_process is not None:
+            result = [a + b for a, b in zip(result, self._step_process.positions())]
+        return [-n if inverted else n for n, inverted in zip(result, self._profile.inverted)]
+
+    def sync_position(self):
+        """ Wait until axises are stopped and set position to steps which
+            were really made, i.e. after stop() or emergency stop. Planned
+            movements which were not run are dropped. Position is a float
+            number of steps if axis stopped inside full step.
+        """
+        self._planner.clear()
+        self.join()
+        made = self._made_steps()
+        steps, mark = self._mark
+        self._steps = [s + n - m for s, n, m in zip(steps, made, mark)]
+        self._mark = (list(self._steps), made)
+
+    def steps_done(self):
+        """ Get number of steps made by each axis since start, axis workers
+            and arc executor together, direction is ignored.
+        :return: dict with axis name as key and number of steps as value.
+        """
+        result = hal.steps_done()
+        if self._executor is not None:
+            for axis, n in zip(hal.AXES, self._executor.steps_done):
+                result[axis] = result.get(axis, 0) + n
+        return result
+
+    def filling(self, center, radius, pitch, extrusion_rate, velocity, surface_speed=None):
+        """ Fill cake with spiral from center to radius.
+        :param center: Coordinates of cake center, Z is nozzle height.
+        :param radius: cake radius in mm.
+        :param pitch: distance between spiral turns in mm.
+        :param extrusion_rate: extruder velocity in mm per second.
+        :param velocity: velocity for moving to the center.
+        :param surface_speed: nozzle speed in mm/min, top speed if None.
+        """
+        e = self._local.e
+        path = SpiralPath(Coordinates(center.x, center.y, center.z, e),
+                          radius, pitch, extrusion_rate, surface_speed,
+                          profile=self._profile)
+        target = self._to_steps(path.points[0])
+        self._move_steps([target[i] - self._steps[i] for i in range(4)], velocity)
+        # 整條路徑一次換算成步數
+        steps = np.rint(path.points.data * np.array(self._steps_per_mm)).astype(np.int64)
+        for delta, feed in zip(np.diff(steps, axis=0).tolist(), path.feeds.tolist()):
+            self._move_steps(delta, Coordinates(*feed))
 
     def safe_zero(self, x=True, y=True, z=True):
         """ Move head to zero position safely.
@@ -79,48 +356,80 @@ class GMachine(object):
         :param y: boolean, move Y axis to zero
         :param z: boolean, move Z axis to zero
         """
+        vx, vy, vz, _ = self._profile.max_velocity_mm_per_min
+        p = self._local
         if not x and z:
-            self._move_linear(Coordinates(-self._position.x, 0, 0, 0), MAX_VELOCITY_MM_PER_MIN_X)
+            self._move_linear(Coordinates(-p.x, 0, 0, 0), Coordinates(vx, vx, vx, vx))
         elif not z and x:
-            d = Coordinates(0, 0, -self._position.z, 0)
-            self._move_linear(d, MAX_VELOCITY_MM_PER_MIN_Z)
+            d = Coordinates(0, 0, -p.z, 0)
+            self._move_linear(d, Coordinates(vz, vz, vz, vz))
 
         elif not x and not z:
-            d = Coordinates(-self._position.x, 0, -self._position.z, 0)
-            self._move_linear(d, min(MAX_VELOCITY_MM_PER_MIN_X, MAX_VELOCITY_MM_PER_MIN_Z))
+            d = Coordinates(-p.x, 0, -p.z, 0)
+            v = min(vx, vz)
+            self._move_linear(d, Coordinates(v, v, v, v))
         if not y: 
-            self._move_linear(Coordinates(0, -self._position.y, 0, 0), MAX_VELOCITY_MM_PER_MIN_Y)
+            self._move_linear(Coordinates(0, -p.y, 0, 0), Coordinates(vy, vy, vy, vy))
+
+    @staticmethod
+    def _params(c, params, *required):
+        """ Check cake parameters of command.
+        :param c: command name for error message.
+        :param params: dict with parameters or None.
+        :param required: names of parameters which must be given.
+        :return: dict with parameters.
+        """
+        params = params or {}
+        missing = [name for name in required if name not in params]
+        if missing:
+            raise GMachineException("{} needs parameter {}".format(c, ', '.join(missing)))
+        return params
 
-    def do_command(self, c, _position, _velocity):  ## 應該列入蛋糕尺寸、奶油種類等參數
+    def do_command(self, c, _position, _velocity, params=None):  ## 應該列入蛋糕尺寸、奶油種類等參數
         """ Perform action.
         :param gcode: GCode object which represent one gcode line
+        :param params: dict with cake parameters for Filling etc.
         :return String if any answer require, None otherwise.
         """
-        print('do_command')
         logging.debug("got command " + str(c)) #logger依輕到嚴重分成5個等級DEBUG INFO WARNING ERROR CRITICAL，依照目前設定LOGGER等級，打印出程度以上的資訊，做為紀錄用。
         # read parameters
-        delta = _position-self._local  #目標位置position -目前local
+        target = self._to_steps(_position)
+        delta = [target[i] - self._steps[i] for i in range(4)]  #目標位置position -目前local (steps)
         self.__check_velocity(_velocity)
-        
-        print('delta',delta.x,delta.y,delta.z,delta.e)
+
         # select command and run it
-        if c == 'G0':  # rapid move
-            self._move_linear(delta, _velocity)
-            print('G0')
+        if c == 'G0' or c == 'G1':  # rapid move, linear move
+            self._move_steps(delta, _velocity)
 
         
-        elif c == 'G28':  # home
-            axises = self._local.is_zero()
-            self.safe_zero(*axises)
-            #hal.join()
-            if not hal.calibrate(*axises):
-                raise GMachineException("failed to calibrate")
+        elif c == 'G28':  # home, _position has zero for homed axises
+            self._move_steps(delta, _velocity)
+            self.flush()
+            self.join()
+        elif c == 'G2' or c == 'G3':  # arc, params has center offset I, J
+            params = params or {}
+            center = Coordinates(params.get('I', 0.0), params.get('J', 0.0), 0, 0)
+            self._move_arc(delta, center, c == 'G2', _velocity)
         elif c =='Icing':
-            pass
+            # 繞蛋糕側面整圈抹面，每層一圈
+            params = self._params(c, params, 'radius', 'extrusion_rate')
+            self.icing(_position, params['radius'], params['extrusion_rate'],
+                       _velocity, params.get('layers', 1),
+                       params.get('layer_height', 0.0))
         elif c =='Scraching':
             pass
         elif c =='Filling':
-            pass
-            # 螺旋走法: x從0走到R，擠料速度Ve，線徑長(R*2)*pi，Vr應該跟當前r成正比，
+            # 螺旋走法: 由中心 _position 走到 R，等表面速度，擠料量與路徑長成正比
+            params = self._params(c, params, 'radius', 'pitch', 'extrusion_rate')
+            self.filling(_position, params['radius'], params['pitch'],
+                         params['extrusion_rate'], _velocity,
+                         params.get('surface_speed'))
         elif c == 'Decoration':
-            pass
+            # 點與線條重新排序，減少空跑
+            params = self._params(c, params, 'features')
+            self.decoration(_position, params['features'], _velocity,
+                            params.get('extrusion_per_mm', 0.0),
+                            params.get('dot_extrusion', 0.0),
+                            params.get('time_budget_s', DECORATION_TIME_BUDGET_S),
+                            params.get('max_passes', DECORATION_MAX_PASSES),
+                            params.get('ordered', False))
@@ -1,29 +1,430 @@
-import RPi.GPIO as GPIO
+import array
+import atexit
+import logging
+import queue
 import threading
 import sys
-import time
 from logging_config import *
+from hal_backend import RPiBackend, SimulatedBackend, A4988_MICROSTEPS
+from ramp_cache import ramp_table
+from steptrace import get_trace
+from machine_profile import get_profile
 
+_backend = None
+
+
+def set_backend(backend):
+    """ Select GPIO backend, i.e. SimulatedBackend to run without hardware.
+        Should be called before motors are created.
+    :param backend: HALBackend object.
+    """
+    global _backend
+    _backend = backend
+
+
+def get_backend():
+    """ Get GPIO backend, RPi.GPIO is used if nothing was selected.
+    :return: HALBackend object.
+    """
+    global _backend
+    if _backend is None:
+        _backend = RPiBackend()
+    return _backend
+
+
+def use_simulation(backend=None):
+    """ Switch hal to SimulatedBackend with machine axises attached, so jobs
+        run without hardware and faster then real time.
+    :param backend: SimulatedBackend object to use, new one if None.
+    :return: SimulatedBackend object with pulse trace and axis positions.
+    """
+    if backend is None:
+        backend = SimulatedBackend()
+    for axis, driver in drivers().items():
+        backend.attach_axis(axis, driver.step_pin, driver.direction_pin, driver.inverted,
+                            driver.mode_pins)
+    set_backend(backend)
+    return backend
+
+
+AXES = ('x', 'y', 'z', 'e')
+
+
+class AxisDriver(object):
+    """ Driver settings of one axis in driver registry.
+    """
+    def __init__(self, axis, direction_pin, step_pin, mode_pins, enable_pin,
+                 motor_type="A4988", inverted=False):
+        """ Create object.
+        :param axis: axis name, 'x', 'y', 'z' or 'e'.
+        :param direction_pin: direction pin, high level means forward.
+        :param step_pin: step pin.
+        :param mode_pins: tuple of microstep resolution pins.
+        :param enable_pin: ENABLE pin, low level enables driver.
+        :param motor_type: driver type, i.e. "A4988".
+        :param inverted: reverse axis direction.
+        """
+        if axis not in AXES:
+            raise ValueError("unknown axis '{}'".format(axis))
+        self.axis = axis
+        self.direction_pin = direction_pin
+        self.step_pin = step_pin
+        self.mode_pins = mode_pins
+        self.enable_pin = enable_pin
+        self.motor_type = motor_type
+        self.inverted = inverted
+
+    def create_motor(self):
+        """ Create motor driver object for this axis.
+        :return: A4988Nema object.
+        """
+        motor = A4988Nema(self.direction_pin, self.step_pin, self.mode_pins,
+                          self.enable_pin, self.motor_type)
+        motor.axis_id = AXES.index(self.axis)
+        return motor
+
+
+_drivers = {}
+
+
+def configure_drivers(profile=None):
+    """ Fill driver registry from machine profile. Running axis workers are
+        stopped, new ones are started for the new drivers on first use.
+        Registry and backend are global for the process, so GMachine with
+        other profile plans by its own profile but runs on these drivers.
+    :param profile: MachineProfile object, default profile if None.
+    """
+    if profile is None:
+        profile = get_profile()
+    inverted = dict(zip(AXES, profile.inverted))
+    registry = {}
+    for axis, (direction_pin, step_pin, mode_pins, enable_pin, motor_type) in profile.drivers:
+        registry[axis] = AxisDriver(axis, direction_pin, step_pin, mode_pins,
+                                    enable_pin, motor_type, inverted.get(axis, False))
+    shutdown()
+    with _workers_lock:
+        _drivers.clear()
+        _drivers.update(registry)
+
+
+def drivers():
+    """ Get driver registry, it is configured from default machine profile
+        on first use.
+    :return: dict with axis name as key and AxisDriver as value.
+    """
+    if not _drivers:
+        configure_drivers()
+    return dict(_drivers)
+
+
+def pin_map():
+    """ Get pins of registered axises in MergedStepExecutor format.
+    :return: dict with axis name as key and tuple (step_pin, direction_pin,
+             enable_pin) as value.
+    """
+    return dict((axis, (d.step_pin, d.direction_pin, d.enable_pin))
+                for axis, d in drivers().items())
+
+
+def mode_pins():
+    """ Get microstep mode pins of registered drivers, MergedStepExecutor
+        sets them to full step.
+    :return: list of pins.
+    """
+    return [pin for d in drivers().values() if d.motor_type == "A4988"
+            for pin in d.mode_pins]
+
+
+class AxisWorker(threading.Thread):
+    """ Long-lived thread which owns motor driver of one axis and executes
+        queued movements one by one, so drivers and threads are not created
+        for each movement.
+    """
+    def __init__(self, name, motor):
+        """ Create object.
+        :param name: axis name.
+        :param motor: A4988Nema object with configured pins.
+        """
+        super(AxisWorker, self).__init__(name='axis-' + name)
+        self.daemon = True
+        self.axis = name
+        self.motor = motor
+        self.queue = queue.Queue()
+        self._steps = 0
+        self._position = 0
+        self._running = False
+        self._steps_lock = threading.Lock()
+
+    def steps_done(self):
+        """ Get number of full steps made by this axis since start,
+            including running movement.
+        """
+        with self._steps_lock:
+            if self._running:
+                return self._steps + self.motor.steps_done
+            return self._steps
+
+    def position(self):
+        """ Get steps made by this axis since start, forward steps are
+            positive. Running movement is not included.
+        """
+        with self._steps_lock:
+            return self._position
+
+    def run(self):
+        while True:
+            barrier, args = self.queue.get()
+            try:
+                if barrier is None:
+                    return
+                generation, args = args
+                # 所有軸同時開始同一個移動
+                try:
+                    barrier.wait()
+                except threading.BrokenBarrierError:
+                    # movement was dropped by stop()
+                    continue
+                if args is None:
+                    continue
+                with _stop_lock:
+                    if generation != _generation or _estop.active:
+                        continue
+                    self.motor.stop_motor = False
+                    with self._steps_lock:
+                        self._running = True
+                try:
+                    self.motor.motor_go(*args)
+                finally:
+                    with self._steps_lock:
+                        self._steps += self.motor.steps_done
+                        self._position += self.motor.steps_done if args[0] else -self.motor.steps_done
+                        self._running = False
+            finally:
+                self.queue.task_done()
+
+
+_workers = {}
+_workers_lock = threading.Lock()
+# stop() increments generation, movements queued before it are skipped
+_generation = 0
+_stop_lock = threading.Lock()
+
+
+def _get_workers():
+    """ Start axis workers for registered drivers on first use.
+    :return: dict with axis name as key and AxisWorker as value.
+    """
+    registry = drivers()
+    with _workers_lock:
+        if not _workers:
+            for axis, driver in registry.items():
+                _workers[axis] = AxisWorker(axis, driver.create_motor())
+            for worker in _workers.values():
+                worker.start()
+        return _workers
+
+
+def add_task(gen):
+    """ Queue movement to axis workers and return immediately, use join()
+        to wait for the end of movement. Every registered axis with steps
+        in movement runs, the others wait. Movement is compiled to
+        PulseTimeline and each axis runs its step delays, so axises make
+        pulses at the same times as PulseGenerator iteration gives them.
+    :param gen: PulseGenerator object, i.e. PulseGeneratorLinear, axis can
+                not change direction inside movement.
+    """
+    if _estop.active:
+        logging.warning("emergency stop is active, movement is dropped")
+        return
+    workers = _get_workers()
+    timeline = gen.timeline()
+    moves = {}
+    for i, axis in enumerate(AXES):
+        if axis not in workers or not len(timeline.times[i]):
+            continue
+        directions = timeline.directions[i]
+        if (directions != directions[0]).any():
+            # 軸工作執行緒一次只設定一個方向，圓弧要用 MergedStepExecutor
+            raise ValueError("axis {} changes direction inside movement".format(axis))
+        # timeline directions already include inverted axises
+        delays = timeline.delays[i]
+        moves[axis] = (bool(directions[0] > 0), STEPPER_STEPTYPE, len(delays), float(delays[0]),
+                       False, float(timeline.times[i][0]), 0, 0, None, delays.tolist())
+    # 每個移動都排入所有軸，閒置軸也要到 barrier，才能同時控制多個馬達
+    barrier = threading.Barrier(len(workers), action=get_backend().sync)
+    generation = _generation
+    for name, worker in workers.items():
+        worker.queue.put((barrier, (generation, moves.get(name))))
+
+
+def join():
+    """ Wait until all queued movements are finished.
+    """
+    for worker in list(_workers.values()):
+        worker.queue.join()
+    if _backend is not None:
+        _backend.sync()
+
+
+def stop():
+    """ Stop running movement of all axises with A4988Nema.motor_stop() and
+        drop queued movements. Returns immediately, use join() to wait
+        until axises are stopped.
+    """
+    global _generation
+    with _stop_lock:
+        _generation += 1
+        workers = list(_workers.values())
+        barriers = set()
+        for worker in workers:
+            while True:
+                try:
+                    barrier, _ = worker.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if barrier is None:
+                    # keep shutdown request
+                    worker.queue.put((None, None))
+                    break
+                barriers.add(barrier)
+                worker.queue.task_done()
+        # axises which already wait for dropped movement are released
+        for barrier in barriers:
+            barrier.abort()
+        for worker in workers:
+            worker.motor.motor_stop()
+
+
+class EmergencyStop(object):
+    """ Machine-wide stop flag. Every step loop reads `active` before each
+        pulse, so it costs one attribute read per pulse.
+    """
+    def __init__(self):
+        self.active = False
+        # backend time of the last emergency stop
+        self.time_ns = None
+
+
+_estop = EmergencyStop()
+
+
+def get_emergency_stop():
+    """ Get emergency stop flag shared by all step loops.
+    """
+    return _estop
+
+
+def emergency_stop():
+    """ Stop the whole machine at once. ENABLE pins of all drivers are
+        disabled from the calling thread, every step loop stops before its
+        next pulse and queued movements are dropped. Stop is latched, new
+        movements are dropped until reset_emergency_stop(). Can be called
+        from any thread.
+    """
+    gpio = get_backend()
+    _estop.time_ns = gpio.now_ns()
+    _estop.active = True
+    enable_pins = sorted(set(d.enable_pin for d in drivers().values()))
+    gpio.output(enable_pins, True)
+    stop()
+    logging.warning("emergency stop")
+
+
+def emergency_stopped():
+    """ Check if emergency stop is active.
+    """
+    return _estop.active
+
+
+def wait_or_stop(gpio, deadline_ns, spin_threshold_ns, estop):
+    """ Wait for deadline like HALBackend.wait_until_ns(), long waits are
+        split so emergency stop is checked at least every ESTOP_POLL_NS,
+        if backend has estop_poll set.
+    :param gpio: HALBackend object.
+    :param deadline_ns: deadline in terms of gpio.now_ns().
+    :param spin_threshold_ns: busy-wait this last part of waiting.
+    :param estop: EmergencyStop object.
+    :return: how late the deadline was reached in nanoseconds, None if
+             emergency stop is active.
+    """
+    # stop could come while step pin was high
+    if estop.active:
+        return None
+    if gpio.estop_poll:
+        now = gpio.now_ns()
+        while deadline_ns - now > ESTOP_POLL_NS:
+            now += ESTOP_POLL_NS
+            gpio.wait_until_ns(now, spin_threshold_ns)
+            if estop.active:
+                return None
+    late = gpio.wait_until_ns(deadline_ns, spin_threshold_ns)
+    if estop.active:
+        return None
+    return late
+
+
+def reset_emergency_stop():
+    """ Allow movements after emergency stop. Drivers are enabled by the
+        next movement.
+    """
+    _estop.active = False
+
+
+def positions():
+    """ Get steps made by each axis worker since start, forward steps are
+        positive. Should be called when axises are stopped, i.e. after
+        join().
+    :return: dict with axis name as key and number of steps as value, steps
+             are float if axis stopped inside full step.
+    """
+    return dict((axis, worker.position()) for axis, worker in list(_workers.items()))
+
+
+def steps_done():
+    """ Get number of full steps made by each axis worker since start.
+    :return: dict with axis name as key and number of steps as value.
+    """
+    return dict((axis, worker.steps_done()) for axis, worker in list(_workers.items()))
+
+
+def shutdown():
+    """ Finish queued movements and stop axis workers.
+    """
+    join()
+    with _workers_lock:
+        for worker in _workers.values():
+            worker.queue.put((None, None))
+        for worker in _workers.values():
+            worker.join()
+        _workers.clear()
+
+
+atexit.register(shutdown)
+
+
+# A4988 細分模式 -> 細分腳位 (MS1, MS2, MS3)
+A4988_RESOLUTION = {'Full': (0, 0, 0),
+                    'Half': (1, 0, 0),
+                    '1/4': (0, 1, 0),
+                    '1/8': (1, 1, 0),
+                    '1/16': (1, 1, 1)}
+
+
+def microstep_mode(stepdelay, modes=MICROSTEP_MODES, min_delay=MICROSTEP_MIN_DELAY):
+    """ Choose the finest microstep mode whose pulse delay is not shorter
+        then min_delay, so slow steps are smooth and fast steps do not
+        need more pulses then the step loop can make.
+    :param stepdelay: delay of one full step.
+    :param modes: allowed modes from the finest to the coarsest.
+    :param min_delay: the shortest delay of one pulse.
+    :return: Tuple of mode name and pulses per full step.
+    """
+    for mode in modes:
+        n = A4988_MICROSTEPS[A4988_RESOLUTION[mode]]
+        if stepdelay / n >= min_delay:
+            return mode, n
+    return 'Full', 1
 
-def add_task(gen):    ##傳遞上需要傳 1.Target 2.Args(list) 3.是否要join (0,1)
-    print('add_task')
-    Motor_X = A4988Nema(direction, step, GPIO_pins, ENABLE, "A4988")
-    Motor_Z = A4988Nema(direction_2, step_2, GPIO_pins_2, ENABLE_2, "A4988")
-    
-    missions=[] 
-    for i,j in enumerate(gen.acc_steps==Coordinates(0,0,0,0)):
-        if not i and i==0:
-            missions.append(threading.Thread(target=Motor_X.motor_go, args=(False,"Full", gen.acc_steps.x, gen.delaytime_start.x, False, 0, stepdelay_add_x, gen.max_velocity_delaytime.x,)))
-        if not i and i==1:
-            pass
-        if not i and i==2:
-            missions.append(threading.Thread(target=Motor_Z.motor_go, args=(False,"Full", gen.acc_steps.z, gen.delaytime_start.z, False, 0, stepdelay_add_z, gen.max_velocity_delaytime.z,)))
-        if not i and i==3:
-            pass
-    for i in range(len(missions)):
-        missions[i].start()
-    for i in range(len(missions)):  # 必須將start跟join分開，否則無法同時控制多個馬達
-        missions[i].join()
 
 class StopMotorInterrupt(Exception):
     """ Stop the motor """
@@ -31,75 +432,152 @@ class StopMotorInterrupt(Exception):
 
 class A4988Nema(object):
     
-    def __init__(self, direction_pin, step_pin, mode_pins,ENABLE_pin, motor_type="A4988"):
+    def __init__(self, direction_pin, step_pin, mode_pins,ENABLE_pin, motor_type="A4988", spin_threshold_ns=STEP_SPIN_THRESHOLD_NS):
         self.motor_type = motor_type
+        self.spin_threshold_ns = spin_threshold_ns
+        self.lateness_ns = array.array('q')
         self.direction_pin = direction_pin
         self.step_pin = step_pin
         self.ENABLE_pin =  ENABLE_pin
         self.mode_pins = mode_pins
         self.stop_motor = False
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(ENABLE,GPIO.OUT)
-        GPIO.setwarnings(False)
+        self.steps_done = 0
+        self.axis_id = -1
+        self.gpio = get_backend()
+        self.gpio.setmode(self.gpio.BCM)
+        self.gpio.setwarnings(False)
+        # pins are configured once, motor_go only writes them
+        self.gpio.setup(self.direction_pin, self.gpio.OUT)
+        self.gpio.setup(self.step_pin, self.gpio.OUT)
+        self.gpio.setup(self.ENABLE_pin,self.gpio.OUT)
+        self.gpio.setup(self.mode_pins, self.gpio.OUT)
 
     def motor_stop(self):
         """ Stop the motor """
-        GPIO.output(self.ENABLE_pin, True)
+        self.gpio.output(self.ENABLE_pin, True)
         self.stop_motor = True
 
+    def _emergency_stopped(self, step, pulse, pulses):
+        """ End movement after emergency stop.
+        :param step: number of finished full steps.
+        :param pulse: number of pulses made in current full step.
+        :param pulses: pulses per full step.
+        """
+        # driver could be enabled after emergency_stop()
+        self.gpio.output(self.ENABLE_pin, True)
+        self.steps_done = step + pulse / pulses if pulse % pulses else step + pulse // pulses
+        raise StopMotorInterrupt
+
     def resolution_set(self, steptype):
         """ method to calculate step resolution
-        based on motor type and steptype"""
+        based on motor type and steptype, mode pins are written"""
         if self.motor_type == "A4988":
-            resolution = {'Full': (0, 0, 0),
-                          'Half': (1, 0, 0),
-                          '1/4': (0, 1, 0),
-                          '1/8': (1, 1, 0),
-                          '1/16': (1, 1, 1)}
+            resolution = A4988_RESOLUTION
         if steptype in resolution:
-            pass
+            self.gpio.output(self.mode_pins, resolution[steptype])
         else:
             print("Error invalid steptype: {}".format(steptype))
             quit()
 
-    def motor_go(self, clockwise=False, steptype="Full", steps=200, stepdelay=.001, verbose=False, initdelay=0, stepdelay_add=0, target_stepdelay=.03):
-        self.stop_motor = False
-        # setup GPIO
-        GPIO.setup(self.direction_pin, GPIO.OUT)
-        GPIO.setup(self.step_pin, GPIO.OUT)
-        GPIO.setup(self.ENABLE_pin,GPIO.OUT)
-        GPIO.output(self.direction_pin, clockwise)
-        GPIO.output(self.ENABLE_pin, False)
-        GPIO.setup(self.mode_pins, GPIO.OUT)
+    def motor_go(self, clockwise=False, steptype="Full", steps=200, stepdelay=.001, verbose=False, initdelay=0, stepdelay_add=0, target_stepdelay=.03, end_stepdelay=None, delays=None):
+        """ Run steps. Pulse edges are scheduled on absolute deadlines, so
+            sleep overshoot and loop overhead do not accumulate. Lateness of
+            each pulse is saved to self.lateness_ns. If end_stepdelay is
+            given, motor brakes to it at the end like
+            PulseGeneratorLinear.step_delay() does.
+            If delays is given, it is a list with delay of each step, i.e.
+            from PulseTimeline, and ramp parameters are not used.
+            With steptype "Auto" steps and delays are full steps, each full
+            step is made by microstep_mode() pulses of delay / pulses, so
+            resolution changes only between full steps and position stays
+            exact.
+            Number of finished full steps is kept in self.steps_done. Stop
+            flag is cleared when it stops the movement, so motor_stop()
+            called just before motor_go() is not lost.
+            Emergency stop is checked before each pulse, if it stops the
+            movement inside full step, steps_done has the made part of it.
+        """
+        self.steps_done = 0
+        estop = _estop
+        if estop.active:
+            return
+        self.lateness_ns = array.array('q')
+        self.gpio.output(self.direction_pin, clockwise)
+        self.gpio.output(self.ENABLE_pin, False)
 
         try:
             # dict resolution
-            GPIO.output(self.ENABLE_pin, False)
-            self.resolution_set(steptype)
-            time.sleep(initdelay)
-            print('target_stepdelay',target_stepdelay)
-            print(steps)
+            self.gpio.output(self.ENABLE_pin, False)
+            auto = steptype == "Auto"
+            mode = None
+            pulses = 1
+            if not auto:
+                self.resolution_set(steptype)
+            spin = self.spin_threshold_ns
+            ramp = None
+            brake = None
+            if delays is None:
+                ramp = ramp_table(stepdelay, stepdelay_add, target_stepdelay)
+                if end_stepdelay is not None:
+                    brake = ramp_table(end_stepdelay, stepdelay_add, target_stepdelay)
+            else:
+                steps = len(delays)
+            deadline = self.gpio.now_ns() + int(round(initdelay * 1e9))
+            trace = get_trace()
+            last_edge = None
             for i in range(steps):
                 if self.stop_motor:
                     raise StopMotorInterrupt
                 else:
-                    print(stepdelay)
-                    GPIO.output(self.step_pin, True)
-                    time.sleep(stepdelay)
-                    GPIO.output(self.step_pin, False)
-                    time.sleep(stepdelay)
-                    stepdelay -= stepdelay_add
-                    if stepdelay<target_stepdelay:  
-                        stepdelay= target_stepdelay
-                    
+                    if ramp is None:
+                        stepdelay = delays[i]
+                    else:
+                        stepdelay = ramp.delay(i)
+                    if brake is not None and brake.delay(steps - 1 - i) > stepdelay:
+                        stepdelay = brake.delay(steps - 1 - i)
+                    if auto:
+                        m, pulses = microstep_mode(stepdelay)
+                        if m != mode:
+                            # 只在全步之間切換細分，等待時也檢查緊急停止
+                            if wait_or_stop(self.gpio, deadline, spin, estop) is None:
+                                self._emergency_stopped(i, 0, pulses)
+                            self.resolution_set(m)
+                            mode = m
+                    delay_ns = int(round(stepdelay / pulses * 1e9))
+                    for k in range(pulses):
+                        late = wait_or_stop(self.gpio, deadline, spin, estop)
+                        if late is None:
+                            self._emergency_stopped(i, k, pulses)
+                        self.lateness_ns.append(late)
+                        self.gpio.output(self.step_pin, True)
+                        if trace.enabled:
+                            edge = deadline + late
+                            trace.record(self.axis_id, edge, 2 * delay_ns,
+                                         edge - last_edge if last_edge is not None else 2 * delay_ns)
+                            last_edge = edge
+                        deadline += delay_ns
+                        if wait_or_stop(self.gpio, deadline, spin, estop) is None:
+                            self._emergency_stopped(i, k + 1, pulses)
+                        self.gpio.output(self.step_pin, False)
+                        deadline += delay_ns
+                    self.steps_done = i + 1
+
                     if verbose:
                         print("Steps count {}".format(i+1), end="\r", flush=True)
-            #GPIO.output(self.ENABLE_pin, 1)
-            print('acc_steps:',steps,'target_stepdelay:',target_stepdelay,'stepdelay:',stepdelay)
+            # last pulse period is a part of the move too
+            self.gpio.wait_until_ns(deadline, spin)
+            #self.gpio.output(self.ENABLE_pin, 1)
+            logging.debug("motor_go steps {} target_stepdelay {} stepdelay {}".format(
+                steps, target_stepdelay, stepdelay))
+            if self.lateness_ns:
+                logging.info("pulse lateness mean {:.0f} ns, max {} ns".format(
+                    sum(self.lateness_ns) / len(self.lateness_ns),
+                    max(self.lateness_ns)))
             
         except KeyboardInterrupt:
             print("User Keyboard Interrupt : RpiMotorLib:")
         except StopMotorInterrupt:
+            self.stop_motor = False
             print("Stop Motor Interrupt : RpiMotorLib: ")
         except Exception as motor_error:
             print(sys.exc_info()[0])
@@ -108,9 +586,8 @@ class A4988Nema(object):
                 
         finally:        
             # cleanup
-            GPIO.output(self.step_pin, False)
-            for pin in self.mode_pins:
-                GPIO.output(pin, False)
+            self.gpio.output(self.step_pin, False)
+            self.gpio.output(self.mode_pins, (0,) * len(self.mode_pins))
 
         '''def degree_calc(steps, steptype):
             """ calculate and returns size of turn in degree, passed number of steps and steptype"""
@@ -0,0 +1,307 @@
+import collections
+import threading
+import time
+
+
+class HALBackend(object):
+    """ GPIO and clock interface used by hal. Methods follow RPi.GPIO names,
+        so driver code looks the same for any backend. Pins may be given as
+        a single channel or as a list/tuple of channels.
+    """
+    BCM = 11
+    OUT = 0
+    IN = 1
+    HIGH = 1
+    LOW = 0
+    # long waits are split to check emergency stop, see hal.wait_or_stop()
+    estop_poll = True
+
+    def setmode(self, mode):
+        raise NotImplementedError
+
+    def setwarnings(self, flag):
+        raise NotImplementedError
+
+    def setup(self, pins, mode):
+        raise NotImplementedError
+
+    def output(self, pins, value):
+        raise NotImplementedError
+
+    def cleanup(self):
+        raise NotImplementedError
+
+    def sleep(self, seconds):
+        """ Wait for specified time.
+        :param seconds: time in seconds.
+        """
+        raise NotImplementedError
+
+    def now(self):
+        """ Get current time.
+        :return: time in seconds.
+        """
+        raise NotImplementedError
+
+    def now_ns(self):
+        """ Get current time.
+        :return: time in nanoseconds.
+        """
+        raise NotImplementedError
+
+    def wait_until_ns(self, deadline_ns, spin_threshold_ns=0):
+        """ Wait for absolute deadline. Sleep while deadline is further then
+            spin_threshold_ns, then busy-wait, since sleep overshoots.
+        :param deadline_ns: deadline in terms of now_ns().
+        :param spin_threshold_ns: busy-wait this last part of waiting.
+        :return: how late the deadline was reached, in nanoseconds.
+        """
+        remaining = deadline_ns - self.now_ns()
+        if remaining > spin_threshold_ns:
+            self.sleep((remaining - spin_threshold_ns) / 1e9)
+        now = self.now_ns()
+        while now < deadline_ns:
+            now = self.now_ns()
+        return now - deadline_ns
+
+    def sync(self):
+        """ Called by hal when all motors of movement are joined.
+        """
+        pass
+
+
+class RPiBackend(HALBackend):
+    """ Real hardware, RPi.GPIO and wall clock.
+    """
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self._gpio = GPIO
+        self.BCM = GPIO.BCM
+        self.OUT = GPIO.OUT
+        self.IN = GPIO.IN
+        self.HIGH = GPIO.HIGH
+        self.LOW = GPIO.LOW
+
+    def setmode(self, mode):
+        self._gpio.setmode(mode)
+
+    def setwarnings(self, flag):
+        self._gpio.setwarnings(flag)
+
+    def setup(self, pins, mode):
+        self._gpio.setup(pins, mode)
+
+    def output(self, pins, value):
+        self._gpio.output(pins, value)
+
+    def cleanup(self):
+        self._gpio.cleanup()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def now(self):
+        return time.perf_counter()
+
+    def now_ns(self):
+        return time.perf_counter_ns()
+
+
+# A4988 細分腳位 (MS1, MS2, MS3) -> 每個全步的脈衝數
+A4988_MICROSTEPS = {(0, 0, 0): 1, (1, 0, 0): 2, (0, 1, 0): 4, (1, 1, 0): 8, (1, 1, 1): 16}
+
+
+class SimulatedBackend(HALBackend):
+    """ GPIO simulation with virtual clock. sleep() only moves clock forward,
+        so whole jobs run much faster then real time. Every pin level change
+        is recorded with virtual time, and steps are counted for attached
+        axises. Axis with mode pins counts microsteps by A4988 resolution,
+        position is reported in full steps.
+        Each motor thread has own clock, because motors run in parallel.
+        Thread clock starts from machine time, sync() moves machine time to
+        the latest thread time, i.e. to the end of movement.
+        Waits are not split for emergency stop, virtual wait takes no real
+        time, so stop from other thread is seen at once.
+        Trace grows with every edge, throughput runs can keep only the last
+        edges or no trace, steps and positions are counted anyway.
+    """
+    estop_poll = False
+
+    def __init__(self, trace_limit=None):
+        """ Create object.
+        :param trace_limit: number of the latest pin changes kept in trace,
+                            all if None, trace is disabled if 0.
+        """
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._time = 0.0
+        self._latest = 0.0
+        self._epoch = 0
+        self._levels = {}
+        self._modes = {}
+        self._axises = {}
+        self._positions = {}
+        self._travel = {}
+        self._tracing = trace_limit != 0
+        self.trace = [] if trace_limit is None else collections.deque(maxlen=trace_limit)
+
+    def attach_axis(self, name, step_pin, direction_pin, inverted=False, mode_pins=None):
+        """ Count steps of axis.
+        :param name: axis name.
+        :param step_pin: step pin of axis driver.
+        :param direction_pin: direction pin, high level means forward.
+        :param inverted: reverse axis direction.
+        :param mode_pins: tuple of MS1, MS2, MS3 pins, full steps are
+                          counted if None.
+        """
+        with self._lock:
+            self._axises[step_pin] = (name, direction_pin, inverted, mode_pins)
+            self._positions.setdefault(name, 0)
+            self._travel.setdefault(name, 0)
+
+    def positions(self):
+        """ Get steps counted for each attached axis.
+        :return: dict with axis name as key and position in full steps as
+                 value, float if axis stopped between full steps.
+        """
+        with self._lock:
+            return dict((name, m // 16 if m % 16 == 0 else m / 16.0)
+                        for name, m in self._positions.items())
+
+    def steps(self):
+        """ Get steps made by each attached axis in both directions, i.e.
+            rising edges of step pin, microsteps are counted as part of
+            full step.
+        :return: dict with axis name as key and number of full steps as
+                 value.
+        """
+        with self._lock:
+            return dict((name, m / 16.0) for name, m in self._travel.items())
+
+    def edges(self):
+        """ Get pin trace ordered by time.
+        :return: list of tuples (time_s, pin, level).
+        """
+        with self._lock:
+            return sorted(self.trace, key=lambda e: e[0])
+
+    def level(self, pin):
+        """ Get current pin level.
+        :return: pin level or None if pin was never written.
+        """
+        return self._levels.get(pin)
+
+    def _clock(self):
+        local = self._local
+        if getattr(local, 'epoch', None) != self._epoch:
+            local.epoch = self._epoch
+            local.time = self._time
+        return local
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pins, mode):
+        if not isinstance(pins, (list, tuple)):
+            pins = (pins,)
+        with self._lock:
+            for pin in pins:
+                self._modes[pin] = mode
+
+    def output(self, pins, value):
+        if not isinstance(pins, (list, tuple)):
+            pins = (pins,)
+        if not isinstance(value, (list, tuple)):
+            value = (value,) * len(pins)
+        t = self._clock().time
+        with self._lock:
+            for pin, v in zip(pins, value):
+                v = 1 if v else 0
+                if self._levels.get(pin) == v:
+                    continue
+                self._levels[pin] = v
+                if self._tracing:
+                    self.trace.append((t, pin, v))
+                if v and pin in self._axises:
+                    name, direction_pin, inverted, mode_pins = self._axises[pin]
+                    # position is kept in 1/16 steps
+                    n = 16
+                    if mode_pins is not None:
+                        mode = tuple(self._levels.get(p, 0) for p in mode_pins)
+                        n = 16 // A4988_MICROSTEPS.get(mode, 1)
+                    self._travel[name] += n
+                    forward = bool(self._levels.get(direction_pin))
+                    if forward != inverted:
+                        self._positions[name] += n
+                    else:
+                        self._positions[name] -= n
+
+    def cleanup(self):
+        with self._lock:
+            self._levels.clear()
+            self._modes.clear()
+
+    def sleep(self, seconds):
+        local = self._clock()
+        local.time += seconds
+        with self._lock:
+            if local.time > self._latest:
+                self._latest = local.time
+
+    def now(self):
+        return self._clock().time
+
+    def now_ns(self):
+        return int(round(self._clock().time * 1e9))
+
+    def wait_until_ns(self, deadline_ns, spin_threshold_ns=0):
+        # virtual clock jumps exactly to deadline, there is nothing to spin
+        now = self.now_ns()
+        if deadline_ns > now:
+            self.sleep((deadline_ns - now) / 1e9)
+            return 0
+        return now - deadline_ns
+
+    def sync(self):
+        with self._lock:
+            self._time = max(self._time, self._latest)
+            self._epoch += 1
+
+    def elapsed_s(self):
+        """ Get machine time.
+        :return: virtual time in seconds since backend creation.
+        """
+        with self._lock:
+            return max(self._time, self._latest)
+
+
+class StopBackend(SimulatedBackend):
+    """ SimulatedBackend for stop tests, it calls stop function when virtual
+        clock of a thread passes stop_at_s, in the middle of its sleep, like
+        real stop button pressed while step loop waits for the next pulse.
+        Waits are split like on hardware.
+    """
+    estop_poll = True
+
+    def __init__(self, stop_at_s, stop, trace_limit=None):
+        """ Create object.
+        :param stop_at_s: virtual time of stop in seconds.
+        :param stop: function which is called once, i.e. hal.emergency_stop.
+        :param trace_limit: see SimulatedBackend.
+        """
+        super(StopBackend, self).__init__(trace_limit)
+        self.stop_at_s = stop_at_s
+        self._stop = stop
+        self.triggered = False
+
+    def sleep(self, seconds):
+        t = self.now()
+        if not self.triggered and t + seconds >= self.stop_at_s:
+            self.triggered = True
+            super(StopBackend, self).sleep(self.stop_at_s - t)
+            self._stop()
+            seconds -= self.stop_at_s - t
+        super(StopBackend, self).sleep(seconds)
@@ -0,0 +1,416 @@
+""" Cache of fully planned jobs on disk. G-code program is planned once,
+    pulses of all movements are saved as compact records, and the next run
+    of the same program replays them from memory mapped file without
+    planning. Records have the same format as step_process ring: int64 time
+    in ns from job start and flag byte, low four bits are axises which step
+    or, for direction record, axises which move forward. So per axis step
+    timelines and directions are kept in one time ordered stream.
+    Cache key is hash of program, start position, machine profile and
+    logging_config constants, so any change of machine settings makes new
+    job. Replay runs on MergedStepExecutor, so every recorded pulse is one
+    full step and Auto microstepping is not used.
+"""
+import array
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+
+import logging_config
+from logging_config import *
+from gcode import GCodeRunner
+from gmachine import GMachine
+from machine_profile import get_profile
+from step_process import RECORD_DIRECTION
+
+JOB_MAGIC = b'CJOB'
+JOB_VERSION = 1
+JOB_SUFFIX = '.job'
+# magic, version, segments, records, total time ns, start steps, delta steps
+_HEADER = struct.Struct('<4sIQQq4q4q')
+# first record and time offset in ns of each segment
+_SEGMENT = struct.Struct('<qq')
+
+
+class JobRecorder(object):
+    """ Pulse sink for GMachine which records pulses instead of running
+        them, it has the same interface as StepProcess. Each movement is
+        one segment, segments continue one after another in time.
+    """
+    def __init__(self, start_steps=(0, 0, 0, 0)):
+        """ Create object.
+        :param start_steps: machine position in steps before the first
+                            movement.
+        """
+        self.start_steps = tuple(start_steps)
+        self.delta_steps = (0, 0, 0, 0)
+        self.times = array.array('q')
+        self.flags = array.array('B')
+        self.segments = []
+        self._offset_ns = 0
+        self._direction = None
+        self._position = [0, 0, 0, 0]
+        self._forward = [True, True, True, True]
+
+    def add_task(self, gen):
+        """ Record movement.
+        :param gen: PulseGenerator object or iterable of pulses. Next
+                    movement starts after total_time_s() of generator, as
+                    on axis workers, or after the last pulse of iterable.
+        """
+        self.segments.append((len(self.times), self._offset_ns))
+        times = self.times
+        flags = self.flags
+        offset = self._offset_ns
+        position = self._position
+        forward = self._forward
+        last = 0
+        for pulse in gen:
+            if pulse[0]:
+                f = RECORD_DIRECTION
+                for i in range(4):
+                    forward[i] = pulse[i + 1] > 0
+                    if forward[i]:
+                        f |= 1 << i
+                if f != self._direction:
+                    self._direction = f
+                    times.append(0)
+                    flags.append(f)
+                continue
+            f = 0
+            for i in range(4):
+                t = pulse[i + 1]
+                if t is not None:
+                    f |= 1 << i
+                    last = t
+                    position[i] += 1 if forward[i] else -1
+            times.append(offset + int(round(last * 1e9)))
+            flags.append(f)
+        # live movement also waits the last step period and next one starts
+        # when all axises are finished
+        end = gen.total_time_s() if hasattr(gen, 'total_time_s') else last
+        self._offset_ns = offset + int(round(max(end, last) * 1e9))
+
+    def join(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def emergency_stop(self):
+        pass
+
+    def reset_emergency_stop(self):
+        pass
+
+    def positions(self):
+        """ Get recorded steps, as StepProcess.positions().
+        """
+        return list(self._position)
+
+    def total_ns(self):
+        return self._offset_ns
+
+    def __len__(self):
+        return len(self.flags)
+
+    def iter_pulses(self, start=0):
+        """ Iterate recorded pulses, see CompiledJob.iter_pulses().
+        """
+        return iter_records(self.times, self.flags, start)
+
+
+def iter_records(times, flags, start=0):
+    """ Convert records to pulses in PulseGenerator.next() format.
+    :param times: sequence of int64 times in ns.
+    :param flags: sequence of flag bytes.
+    :param start: the first record.
+    :return: generator of tuples.
+    """
+    for i in range(start, len(flags)):
+        f = flags[i]
+        if f & RECORD_DIRECTION:
+            yield (True, 1 if f & 1 else -1, 1 if f & 2 else -1,
+                   1 if f & 4 else -1, 1 if f & 8 else -1)
+        else:
+            t = times[i] / 1e9
+            yield (False, t if f & 1 else None, t if f & 2 else None,
+                   t if f & 4 else None, t if f & 8 else None)
+
+
+def _machine_constants():
+    """ Get logging_config constants which can change planned pulses.
+    """
+    result = {}
+    for name, value in vars(logging_config).items():
+        if name.startswith('_'):
+            continue
+        if isinstance(value, (bool, int, float, str, tuple, list, dict)) or value is None:
+            result[name] = value
+    return result
+
+
+def job_key(lines, start_steps=(0, 0, 0, 0), profile=None):
+    """ Get cache key of program.
+    :param lines: list of G-code lines.
+    :param start_steps: machine position in steps before program.
+    :param profile: MachineProfile object, default profile if None.
+    :return: hex string.
+    """
+    profile = profile or get_profile()
+    h = hashlib.sha256()
+    h.update(json.dumps({'version': JOB_VERSION, 'byteorder': sys.byteorder,
+                         'start': list(start_steps), 'profile': profile.to_dict(),
+                         'constants': _machine_constants()},
+                        sort_keys=True, default=repr).encode())
+    for line in lines:
+        h.update(line.strip().encode())
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+def compile_job(lines, start_steps=(0, 0, 0, 0), profile=None):
+    """ Plan program without running it.
+    :param lines: list of G-code lines.
+    :param start_steps: machine position in steps before program.
+    :param profile: MachineProfile object, default profile if None.
+    :return: Tuple of JobRecorder with pulses and list of four integers,
+             movement in steps.
+    """
+    recorder = JobRecorder(start_steps)
+    machine = GMachine(profile, step_process=recorder)
+    machine._set_steps(start_steps)
+    GCodeRunner(machine).run(lines)
+    recorder.delta_steps = tuple(a - b for a, b in zip(machine._steps, start_steps))
+    return recorder, list(recorder.delta_steps)
+
+
+def write_job(path, recorder, start_steps, delta_steps):
+    """ Write recorded job to file, file is replaced atomically.
+    :return: file size.
+    """
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(JOB_MAGIC, JOB_VERSION, len(recorder.segments),
+                             len(recorder.times), recorder.total_ns(),
+                             *(list(start_steps) + list(delta_steps))))
+        for segment in recorder.segments:
+            f.write(_SEGMENT.pack(*segment))
+        recorder.times.tofile(f)
+        recorder.flags.tofile(f)
+        size = f.tell()
+        # data is on disk before file gets its name
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return size
+
+
+class CompiledJob(object):
+    """ Job file mapped to memory. Records are read directly from the
+        mapping by memoryview, nothing is copied or parsed on open.
+    """
+    def __init__(self, path):
+        """ Open job file.
+        :param path: file name.
+        """
+        self.path = path
+        self.times = self.flags = None
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, n_segments, n_records, self.total_ns,
+             *steps) = _HEADER.unpack_from(self._mmap, 0)
+            if magic != JOB_MAGIC or version != JOB_VERSION:
+                raise ValueError("not a compiled job file: {}".format(path))
+            size = _HEADER.size + n_segments * _SEGMENT.size + 9 * n_records
+            if len(self._mmap) != size:
+                raise ValueError("job file {} has {} bytes, {} expected".format(
+                    path, len(self._mmap), size))
+            self.records = n_records
+            self.start_steps = tuple(steps[:4])
+            self.delta_steps = tuple(steps[4:])
+            offset = _HEADER.size
+            self.segments = [_SEGMENT.unpack_from(self._mmap, offset + i * _SEGMENT.size)
+                             for i in range(n_segments)]
+            offset += n_segments * _SEGMENT.size
+            view = memoryview(self._mmap)
+            try:
+                self.times = view[offset:offset + 8 * n_records].cast('q')
+                offset += 8 * n_records
+                self.flags = view[offset:offset + n_records]
+            finally:
+                view.release()
+        except Exception:
+            self.close()
+            raise
+
+    def __len__(self):
+        return self.records
+
+    def iter_pulses(self, start=0):
+        """ Iterate pulses in PulseGenerator.next() format, so job can be
+            given to MergedStepExecutor.run() or StepProcess.add_task().
+        :param start: the first record.
+        :return: generator of tuples.
+        """
+        return iter_records(self.times, self.flags, start)
+
+    def close(self):
+        # views have to be released before mapping is closed
+        for view in (self.times, self.flags):
+            if view is not None:
+                view.release()
+        self.times = self.flags = None
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class JobCache(object):
+    """ Directory of compiled jobs. When total size is over the limit, the
+        least recently used jobs are removed.
+    """
+    def __init__(self, directory=JOB_CACHE_DIR, max_bytes=JOB_CACHE_MAX_BYTES):
+        """ Create object.
+        :param directory: cache directory, created when needed.
+        :param max_bytes: maximum total size of job files.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + JOB_SUFFIX)
+
+    def get(self, key):
+        """ Open cached job.
+        :param key: key from job_key().
+        :return: CompiledJob object or None if job is not cached or can not
+                 be read, so broken file is compiled again.
+        """
+        path = self._path(key)
+        try:
+            job = CompiledJob(path)
+        except Exception as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning("job cache: {} is not used: {}".format(path, e))
+            return None
+        # mtime is the last use for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return job
+
+    def put(self, key, recorder, start_steps, delta_steps):
+        """ Save recorded job and remove old jobs over size limit.
+        :return: CompiledJob object.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        write_job(path, recorder, start_steps, delta_steps)
+        self.evict(keep=path)
+        return CompiledJob(path)
+
+    def load(self, lines, start_steps=(0, 0, 0, 0), profile=None):
+        """ Get compiled job of program, program is planned only if it is
+            not cached.
+        :param lines: file name or iterable of G-code lines.
+        :param start_steps: machine position in steps before program.
+        :param profile: MachineProfile object, default profile if None.
+        :return: CompiledJob object, it should be closed after use.
+        """
+        if isinstance(lines, str):
+            with open(lines) as f:
+                lines = f.read().splitlines()
+        else:
+            lines = list(lines)
+        key = job_key(lines, start_steps, profile)
+        job = self.get(key)
+        if job is not None:
+            self.hits += 1
+            return job
+        self.misses += 1
+        recorder, delta = compile_job(lines, start_steps, profile)
+        logging.info("job compiled: {} records, {:.1f} s".format(
+            len(recorder.times), recorder.total_ns() / 1e9))
+        return self.put(key, recorder, start_steps, delta)
+
+    def size(self):
+        """ Get total size of job files in bytes.
+        """
+        return sum(size for _, size, _ in self._files())
+
+    def _files(self):
+        result = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return result
+        for name in names:
+            if not name.endswith(JOB_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            result.append((st.st_mtime, st.st_size, path))
+        return result
+
+    def evict(self, keep=None):
+        """ Remove the least recently used jobs until cache fits the limit.
+        :param keep: file which is never removed.
+        :return: number of removed jobs.
+        """
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        for _, _, path in self._files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def run_job(machine, lines, cache=None):
+    """ Run program on machine from job cache, program is compiled on the
+        first run. Replayed pulses have the times of live run: recorder
+        spaces movements by total time of their pulse generators, which is
+        the schedule axis workers run, see hal.add_task(). Live run also
+        waits the last step period after the last pulse, so replay ends
+        earlier by it.
+    :param machine: GMachine object.
+    :param lines: file name or iterable of G-code lines.
+    :param cache: JobCache object, default cache directory if None.
+    :return: CompiledJob object which was run, already closed.
+    """
+    cache = cache or JobCache()
+    job = cache.load(lines, machine._to_steps(machine._local), machine._profile)
+    with job:
+        machine.run_compiled(job)
+        machine.join()
+    return job
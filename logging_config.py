@@ -12,6 +12,16 @@ direction_2 = 23
 step_2 = 24
 ENABLE_2 = 12
 
+GPIO_pins_3 = (5, 6, 13)
+direction_3 = 19
+step_3 = 26
+ENABLE_3 = 25
+
+GPIO_pins_4 = (2, 3, 4)
+direction_4 = 9
+step_4 = 10
+ENABLE_4 = 11
+
 
 '''速度加速度限制 & 馬達減速比設定'''
 MAX_VELOCITY_DELAYTIME_X=0.00035
@@ -19,6 +29,7 @@ MAX_VELOCITY_DELAYTIME_Y=0.00035
 MAX_VELOCITY_DELAYTIME_Z=0.00035
 MAX_VELOCITY_DELAYTIME_E=0.00035
 
+## 各軸速度上限(mm/min)，0 使用 MAX_VELOCITY_DELAYTIME 的速度
 MAX_VELOCITY_MM_PER_MIN_X=0
 MAX_VELOCITY_MM_PER_MIN_Y=0
 MAX_VELOCITY_MM_PER_MIN_Z=0
@@ -31,6 +42,53 @@ STEPPER_PULSES_PER_MM_E=1
 
 STEPPER_MAX_ACCELERATION_MM_PER_S2=1
 
+## 轉角速度: 路徑最大允許偏差(mm)，及規劃器往前看的移動數
+JUNCTION_DEVIATION_MM=0.05
+PLANNER_LOOKAHEAD=8
+
+## G-code 程式: 預讀行數上限，未指定 F 時的速度
+GCODE_READ_AHEAD=64
+GCODE_DEFAULT_FEED_MM_PER_MIN=100
+
+## 填餡螺旋: 弦高誤差(mm)，每段最大角度(rad)
+SPIRAL_CHORD_TOLERANCE_MM=0.05
+SPIRAL_MAX_ANGLE_STEP=0.5
+
+## 圓弧 G2/G3: 起點與終點半徑最大允許差(steps)，超過時 I/J 與終點不符
+ARC_RADIUS_TOLERANCE_STEPS=2
+
+## 裝飾排序: 最佳化時間上限(s)，最佳化回合上限，每個圖案的候選鄰居數
+DECORATION_TIME_BUDGET_S=1.0
+DECORATION_MAX_PASSES=20
+DECORATION_NEIGHBOURS=8
+
+## S 曲線加減速: 最大加加速度(mm/s^3)，最大加速度(mm/s^2)，None 使用線性加減速的峰值
+SCURVE_JERK_MM_PER_S3_X=None
+SCURVE_JERK_MM_PER_S3_Y=None
+SCURVE_JERK_MM_PER_S3_Z=None
+SCURVE_JERK_MM_PER_S3_E=None
+SCURVE_ACCELERATION_MM_PER_S2_X=None
+SCURVE_ACCELERATION_MM_PER_S2_Y=None
+SCURVE_ACCELERATION_MM_PER_S2_Z=None
+SCURVE_ACCELERATION_MM_PER_S2_E=None
+
+## 規劃器使用的脈衝產生器: "coordinated" 各軸共用主軸加減速同時到達，"linear" 各軸獨立線性加減速，
+## "scurve" S 曲線(每段移動由靜止開始並停止)
+MOTION_GENERATOR="coordinated"
+
+## 步進記錄: ring buffer 筆數，每幾個脈衝記錄一筆
+STEP_TRACE_CAPACITY=65536
+STEP_TRACE_SAMPLE=1
+
+## 加減速 delaytime 表快取: 最多保留的表數
+RAMP_CACHE_SIZE=64
+
+## 機台設定檔 (JSON)，None 時由本檔常數產生，見 machine_profile.py
+MACHINE_PROFILE_FILE=None
+
+## asyncio 介面: 進度回報間隔(秒)
+ASYNC_PROGRESS_INTERVAL_S=0.1
+
 multiply_x=1
 multiply_y=1
 multiply_z=1
@@ -44,6 +102,14 @@ STEPPER_INVERTED_Y=False
 STEPPER_INVERTED_Z=False
 STEPPER_INVERTED_E=False
 
+## 各軸驅動器: 軸 -> (direction, step, 細分腳位, ENABLE, 驅動器型號)，沒有接線的軸刪掉
+AXIS_DRIVERS = {
+    'x': (direction, step, GPIO_pins, ENABLE, "A4988"),
+    'y': (direction_3, step_3, GPIO_pins_3, ENABLE_3, "A4988"),
+    'z': (direction_2, step_2, GPIO_pins_2, ENABLE_2, "A4988"),
+    'e': (direction_4, step_4, GPIO_pins_4, ENABLE_4, "A4988"),
+}
+
 ## 初速度
 delaytime_start_x=0.05
 delaytime_start_y=0.05
@@ -55,6 +121,36 @@ delaytime_start_e=0.05
 ##馬達速度極限
 MAX_VELOCITY_STEPDELAY=0.00035
 
+## 步進計時: 距離 deadline 超過此值(ns)用 sleep，之後改為 busy-wait
+STEP_SPIN_THRESHOLD_NS=200000
+## 步進脈衝高電位寬度(ns), A4988 至少 1us
+STEP_PULSE_WIDTH_NS=2000
+## 緊急停止: 等待中至少每隔此值(ns)檢查一次
+ESTOP_POLL_NS=1000000
+
+## 獨立步進行程: 環形緩衝筆數，綁定 CPU (None 不綁定)，SCHED_FIFO 優先權 (0 不使用)
+STEP_PROCESS_RING_SIZE=65536
+STEP_PROCESS_CPU=None
+STEP_PROCESS_FIFO_PRIORITY=0
+# 緩衝區空時執行行程每次等待的時間，不佔滿 CPU
+STEP_PROCESS_UNDERRUN_SLEEP_S=0.0001
+# 開始執行前至少先寫入的脈衝時間(秒)，或整段已寫完
+STEP_PROCESS_PREFILL_S=0.05
+
+## 已編譯工作快取: 目錄，總大小上限(bytes)，超過時刪除最久未用的
+JOB_CACHE_DIR='job_cache'
+JOB_CACHE_MAX_BYTES=256*1024*1024
+
+## 批次預先規劃訂單: 行程數(None 為 CPU 數)，每次交給行程的訂單數，最多同時規劃或等待執行的批次數(None 為行程數兩倍)
+BATCH_PLANNER_WORKERS=None
+BATCH_PLANNER_CHUNK_SIZE=2
+BATCH_PLANNER_MAX_PENDING=None
+
+## 細分模式: "Auto" 依速度切換細分，可用模式(細到粗)，細分後每個脈衝 delaytime 下限(s)
+STEPPER_STEPTYPE="Auto"
+MICROSTEP_MODES=('1/16', '1/8', '1/4', 'Half', 'Full')
+MICROSTEP_MIN_DELAY=0.0002
+
 ## 加減速最大允許值
 stepdelay_add_x=0.003
 stepdelay_add_y=0.003
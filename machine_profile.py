@@ -0,0 +1,325 @@
+import json
+
+from logging_config import *
+from coordinates import Coordinates
+from ramp_cache import ramp_table, profile_peaks
+
+AXES = ('x', 'y', 'z', 'e')
+DRIVER_TYPES = ('A4988',)
+# 規劃器的脈衝產生器，見 MotionPlanner
+GENERATORS = ('coordinated', 'linear', 'scurve')
+
+
+class ProfileException(Exception):
+    """ Invalid machine profile.
+    """
+    pass
+
+
+def delaytime_from_velocity(mm_per_step, velocity_mm_per_min):
+    """ Convert axis velocity to motor step delay.
+        delaytime=[(MM/Step)/Velocity*200-0.036]/400
+    """
+    return (mm_per_step / velocity_mm_per_min * 200 - 0.036) / 400
+
+
+def linear_ramp_peaks(mm_per_step, delaytime_start, stepdelay_add, max_velocity_delaytime):
+    """ Get peak acceleration and jerk of linear delay ramp from stop to
+        the top velocity, S-curve limits are not higher by default.
+    :return: Tuple of two values, acceleration in mm/s^2 and jerk in
+             mm/s^3.
+    """
+    table = ramp_table(delaytime_start, stepdelay_add, max_velocity_delaytime)
+    acceleration, jerk = profile_peaks(table.delays)
+    return max(acceleration, 1.0) * mm_per_step, max(jerk, 1.0) * mm_per_step
+
+
+def velocity_from_delaytime(mm_per_step, delaytime):
+    """ Convert motor step delay to axis velocity, inverse of
+        delaytime_from_velocity().
+    """
+    return 1 / (400 * delaytime + 0.036) * 200 * mm_per_step
+
+
+class MachineProfile(object):
+    """ Machine settings and limits derived from them. Per axis values are
+        tuples in X, Y, Z, E order, the same values are also kept as
+        Coordinates for vector math. Object is immutable and validated on
+        creation, so it can be shared by threads, and many profiles can be
+        used for planning at once, i.e. compiled jobs or comparison. But
+        hal has one driver registry and one GPIO backend for the process,
+        so pulses are made only for the profile given to
+        hal.configure_drivers(), one machine runs at a time.
+    """
+    __slots__ = ('name', 'mm_per_step', 'delaytime_start', 'stepdelay_add',
+                 'max_velocity_delaytime', 'inverted', 'table_size_mm', 'drivers',
+                 'generator', 'scurve_jerk', 'scurve_acceleration',
+                 'max_velocity_mm_per_min', 'max_acceleration', 'junction_deviation',
+                 'steps_per_mm', 'min_velocity', 'max_velocity',
+                 'mm_per_step_vector', 'delaytime_start_vector',
+                 'stepdelay_add_vector', 'table_size_vector')
+
+    def __init__(self, mm_per_step, delaytime_start, stepdelay_add,
+                 max_velocity_delaytime, inverted=(False, False, False, False),
+                 table_size_mm=(0, 0, 0, 0), drivers=None, name='default',
+                 generator=MOTION_GENERATOR, scurve_jerk=None, scurve_acceleration=None,
+                 max_velocity_mm_per_min=None, max_acceleration=STEPPER_MAX_ACCELERATION_MM_PER_S2,
+                 junction_deviation=JUNCTION_DEVIATION_MM):
+        """ Create object.
+        :param mm_per_step: four values, mm per motor step.
+        :param delaytime_start: four values, step delay from stop.
+        :param stepdelay_add: four values, step delay change per step.
+        :param max_velocity_delaytime: four values, the shortest step delay.
+        :param inverted: four booleans, reverse axis direction.
+        :param table_size_mm: four values, working area, 0 is not limited.
+        :param drivers: dict with axis name as key and tuple
+                        (direction_pin, step_pin, mode_pins, enable_pin,
+                        motor_type) as value, axises without driver are
+                        not connected.
+        :param name: profile name for messages.
+        :param generator: pulse generator of planned movements, one of
+                          GENERATORS.
+        :param scurve_jerk: four values, S-curve jerk limit in mm/s^3,
+                            peak jerk of linear ramp for None values.
+        :param scurve_acceleration: four values, S-curve acceleration limit
+                                    in mm/s^2, peak acceleration of linear
+                                    ramp for None values.
+        :param max_velocity_mm_per_min: four values, velocity limit of
+                                        automatic velocity adjustment and
+                                        safe_zero(), velocity of
+                                        max_velocity_delaytime for None or
+                                        0 values.
+        :param max_acceleration: acceleration in mm/s^2 for junction
+                                 velocity.
+        :param junction_deviation: allowed path deviation in mm at
+                                   junction of two movements.
+        """
+        _set = object.__setattr__
+        _set(self, 'name', name)
+        for key, value in (('mm_per_step', mm_per_step), ('delaytime_start', delaytime_start),
+                           ('stepdelay_add', stepdelay_add),
+                           ('max_velocity_delaytime', max_velocity_delaytime),
+                           ('table_size_mm', table_size_mm)):
+            value = tuple(float(v) for v in value)
+            if len(value) != 4:
+                raise ProfileException("{}: {} needs four values".format(name, key))
+            _set(self, key, value)
+        _set(self, 'inverted', tuple(bool(v) for v in inverted))
+        _set(self, 'generator', generator)
+        _set(self, 'max_acceleration', float(max_acceleration))
+        _set(self, 'junction_deviation', float(junction_deviation))
+        # S 曲線限制預設不超過線性加減速的峰值
+        peaks = [linear_ramp_peaks(*values) for values in
+                 zip(self.mm_per_step, self.delaytime_start, self.stepdelay_add,
+                     self.max_velocity_delaytime)]
+        for key, value, k in (('scurve_acceleration', scurve_acceleration, 0),
+                              ('scurve_jerk', scurve_jerk, 1)):
+            value = value or (None, None, None, None)
+            if len(value) != 4:
+                raise ProfileException("{}: {} needs four values".format(name, key))
+            _set(self, key, tuple(peaks[i][k] if v is None else float(v)
+                                  for i, v in enumerate(value)))
+        value = max_velocity_mm_per_min or (None, None, None, None)
+        if len(value) != 4:
+            raise ProfileException("{}: max_velocity_mm_per_min needs four values".format(name))
+        _set(self, 'max_velocity_mm_per_min', tuple(
+            float(v) if v else velocity_from_delaytime(m, d)
+            for v, m, d in zip(value, self.mm_per_step, self.max_velocity_delaytime)))
+        drivers = drivers or {}
+        _set(self, 'drivers', tuple(
+            (axis, (d[0], d[1], tuple(d[2]), d[3], d[4]))
+            for axis, d in sorted(drivers.items(), key=lambda i: AXES.index(i[0])
+                                  if i[0] in AXES else -1)))
+        self._validate()
+        _set(self, 'steps_per_mm', tuple(1.0 / m for m in self.mm_per_step))
+        _set(self, 'min_velocity', tuple(velocity_from_delaytime(m, d) for m, d in
+                                         zip(self.mm_per_step, self.delaytime_start)))
+        _set(self, 'max_velocity', tuple(velocity_from_delaytime(m, d) for m, d in
+                                         zip(self.mm_per_step, self.max_velocity_delaytime)))
+        _set(self, 'mm_per_step_vector', Coordinates(*self.mm_per_step))
+        _set(self, 'delaytime_start_vector', Coordinates(*self.delaytime_start))
+        _set(self, 'stepdelay_add_vector', Coordinates(*self.stepdelay_add))
+        _set(self, 'table_size_vector', Coordinates(*self.table_size_mm))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MachineProfile object is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("MachineProfile object is immutable")
+
+    def __repr__(self):
+        return "MachineProfile({})".format(self.name)
+
+    def _validate(self):
+        if self.generator not in GENERATORS:
+            raise ProfileException("{}: unknown generator '{}'".format(self.name, self.generator))
+        if self.max_acceleration <= 0:
+            raise ProfileException("{}: max_acceleration must be positive".format(self.name))
+        if self.junction_deviation < 0:
+            raise ProfileException("{}: junction_deviation can not be negative".format(self.name))
+        for i, axis in enumerate(AXES):
+            def fail(message):
+                raise ProfileException("{}: axis {} {}".format(self.name, axis, message))
+            if self.mm_per_step[i] <= 0:
+                fail("mm_per_step must be positive")
+            if self.stepdelay_add[i] <= 0:
+                fail("stepdelay_add must be positive")
+            if not 0 < self.max_velocity_delaytime[i] <= self.delaytime_start[i]:
+                fail("needs 0 < max_velocity_delaytime <= delaytime_start")
+            if self.table_size_mm[i] < 0:
+                fail("table_size_mm can not be negative")
+            if self.scurve_jerk[i] <= 0:
+                fail("scurve_jerk must be positive")
+            if self.scurve_acceleration[i] <= 0:
+                fail("scurve_acceleration must be positive")
+            if self.max_velocity_mm_per_min[i] < 0:
+                fail("max_velocity_mm_per_min can not be negative")
+        pins = {}
+        for axis, (direction_pin, step_pin, mode_pins, enable_pin, motor_type) in self.drivers:
+            if axis not in AXES:
+                raise ProfileException("{}: unknown axis '{}'".format(self.name, axis))
+            if motor_type not in DRIVER_TYPES:
+                raise ProfileException("{}: axis {} unknown driver '{}'".format(
+                    self.name, axis, motor_type))
+            # ENABLE pin can be shared by several drivers
+            for pin in (direction_pin, step_pin) + tuple(mode_pins):
+                if pin in pins:
+                    raise ProfileException("{}: pin {} is used by axis {} and {}".format(
+                        self.name, pin, pins[pin], axis))
+                pins[pin] = axis
+
+    def driver_map(self):
+        """ Get drivers in AXIS_DRIVERS format.
+        :return: dict with axis name as key and driver tuple as value.
+        """
+        return dict(self.drivers)
+
+    def to_dict(self):
+        """ Get profile as dict in load_profile() file format.
+        """
+        axes = {}
+        drivers = self.driver_map()
+        for i, axis in enumerate(AXES):
+            a = {'mm_per_step': self.mm_per_step[i],
+                 'delaytime_start': self.delaytime_start[i],
+                 'stepdelay_add': self.stepdelay_add[i],
+                 'max_velocity_delaytime': self.max_velocity_delaytime[i],
+                 'inverted': self.inverted[i],
+                 'table_size_mm': self.table_size_mm[i],
+                 'scurve_jerk': self.scurve_jerk[i],
+                 'scurve_acceleration': self.scurve_acceleration[i],
+                 'max_velocity_mm_per_min': self.max_velocity_mm_per_min[i]}
+            if axis in drivers:
+                d = drivers[axis]
+                a['driver'] = {'direction': d[0], 'step': d[1], 'mode_pins': list(d[2]),
+                               'enable': d[3], 'type': d[4]}
+            axes[axis] = a
+        return {'name': self.name, 'generator': self.generator,
+                'max_acceleration': self.max_acceleration,
+                'junction_deviation': self.junction_deviation, 'axes': axes}
+
+    @classmethod
+    def from_dict(cls, data, name=None):
+        """ Create profile from dict, see to_dict().
+        """
+        name = data.get('name', name or 'profile')
+        axes = data.get('axes', {})
+        values = dict((key, []) for key in ('mm_per_step', 'delaytime_start', 'stepdelay_add',
+                                            'max_velocity_delaytime', 'inverted',
+                                            'table_size_mm', 'scurve_jerk',
+                                            'scurve_acceleration', 'max_velocity_mm_per_min'))
+        drivers = {}
+        for axis in AXES:
+            if axis not in axes:
+                raise ProfileException("{}: axis {} is missing".format(name, axis))
+            a = axes[axis]
+            for key in values:
+                if key in ('inverted', 'table_size_mm'):
+                    values[key].append(a.get(key, 0))
+                elif key in ('scurve_jerk', 'scurve_acceleration', 'max_velocity_mm_per_min'):
+                    values[key].append(a.get(key))
+                elif key not in a:
+                    raise ProfileException("{}: axis {} has no {}".format(name, axis, key))
+                else:
+                    values[key].append(a[key])
+            d = a.get('driver')
+            if d is not None:
+                try:
+                    drivers[axis] = (d['direction'], d['step'], tuple(d['mode_pins']),
+                                     d['enable'], d.get('type', 'A4988'))
+                except KeyError as e:
+                    raise ProfileException("{}: axis {} driver has no {}".format(name, axis, e))
+        unknown = set(axes) - set(AXES)
+        if unknown:
+            raise ProfileException("{}: unknown axis {}".format(name, ', '.join(sorted(unknown))))
+        return cls(drivers=drivers, name=name,
+                   generator=data.get('generator', MOTION_GENERATOR),
+                   max_acceleration=data.get('max_acceleration', STEPPER_MAX_ACCELERATION_MM_PER_S2),
+                   junction_deviation=data.get('junction_deviation', JUNCTION_DEVIATION_MM),
+                   **values)
+
+    @classmethod
+    def from_config(cls):
+        """ Create profile from logging_config module constants.
+        """
+        return cls((mm_per_step_x, mm_per_step_y, mm_per_step_z, mm_per_step_e),
+                   (delaytime_start_x, delaytime_start_y, delaytime_start_z, delaytime_start_e),
+                   (stepdelay_add_x, stepdelay_add_y, stepdelay_add_z, stepdelay_add_e),
+                   (MAX_VELOCITY_DELAYTIME_X, MAX_VELOCITY_DELAYTIME_Y,
+                    MAX_VELOCITY_DELAYTIME_Z, MAX_VELOCITY_DELAYTIME_E),
+                   (STEPPER_INVERTED_X, STEPPER_INVERTED_Y, STEPPER_INVERTED_Z, STEPPER_INVERTED_E),
+                   (TABLE_SIZE_X_MM, TABLE_SIZE_Y_MM, TABLE_SIZE_Z_MM, TABLE_SIZE_E_MM),
+                   AXIS_DRIVERS, 'logging_config', MOTION_GENERATOR,
+                   (SCURVE_JERK_MM_PER_S3_X, SCURVE_JERK_MM_PER_S3_Y,
+                    SCURVE_JERK_MM_PER_S3_Z, SCURVE_JERK_MM_PER_S3_E),
+                   (SCURVE_ACCELERATION_MM_PER_S2_X, SCURVE_ACCELERATION_MM_PER_S2_Y,
+                    SCURVE_ACCELERATION_MM_PER_S2_Z, SCURVE_ACCELERATION_MM_PER_S2_E),
+                   (MAX_VELOCITY_MM_PER_MIN_X, MAX_VELOCITY_MM_PER_MIN_Y,
+                    MAX_VELOCITY_MM_PER_MIN_Z, MAX_VELOCITY_MM_PER_MIN_E),
+                   STEPPER_MAX_ACCELERATION_MM_PER_S2, JUNCTION_DEVIATION_MM)
+
+
+def load_profile(path):
+    """ Load and validate profile from JSON file.
+    :param path: file name.
+    :return: MachineProfile object.
+    """
+    with open(path) as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise ProfileException("{}: {}".format(path, e))
+    return MachineProfile.from_dict(data, path)
+
+
+def save_profile(profile, path):
+    """ Save profile to JSON file.
+    """
+    with open(path, 'w') as f:
+        json.dump(profile.to_dict(), f, indent=2, sort_keys=True)
+
+
+_profile = None
+
+
+def set_profile(profile):
+    """ Select default machine profile.
+    :param profile: MachineProfile object.
+    """
+    global _profile
+    _profile = profile
+
+
+def get_profile():
+    """ Get default machine profile. It is loaded once from
+        MACHINE_PROFILE_FILE, or made from logging_config constants if file
+        is not set.
+    :return: MachineProfile object.
+    """
+    global _profile
+    if _profile is None:
+        if MACHINE_PROFILE_FILE:
+            _profile = load_profile(MACHINE_PROFILE_FILE)
+        else:
+            _profile = MachineProfile.from_config()
+    return _profile
@@ -12,4 +12,5 @@ machine = GMachine()
 _position=Coordinates(100,1,200,1)
 _velocity=Coordinates(100,10,10,10)
 
-res=machine.do_command('G0',_position,_velocity)
\ No newline at end of file
+res=machine.do_command('G0',_position,_velocity)
+machine.flush()
\ No newline at end of file
@@ -0,0 +1,216 @@
+import logging
+import math
+import threading
+
+from logging_config import *
+from coordinates import *
+from pulse import *
+from machine_profile import get_profile
+
+
+class PlannerSegment(object):
+    """ Linear movement waiting in planner queue.
+    """
+    def __init__(self, delta, velocity, profile, steps=None):
+        """ Create object.
+        :param delta: movement delta in mm, Coordinates object.
+        :param velocity: velocity for each axis, Coordinates object.
+        :param profile: MachineProfile object.
+        :param steps: four integers, movement in steps, converted from delta
+                      if None.
+        """
+        self.delta = delta
+        self.velocity = velocity
+        d = [delta.x, delta.y, delta.z, delta.e]
+        v = [velocity.x, velocity.y, velocity.z, velocity.e]
+        mm_per_step = profile.mm_per_step
+        self.steps = movement_steps(delta, profile, steps)
+        self.direction = [math.copysign(1, i) for i in d]
+        self.velocity_list = v
+        self.cruise_delaytime = [delaytime_from_velocity(mm_per_step[i], v[i])
+                                 for i in range(4)]
+        length = math.sqrt(delta.x ** 2 + delta.y ** 2 + delta.z ** 2)
+        if length > 0:
+            self.unit = (delta.x / length, delta.y / length, delta.z / length)
+        else:
+            self.unit = None
+        # nominal XYZ speed, axises which do not move are skipped
+        self.speed = math.sqrt(sum(v[i] ** 2 for i in range(3) if self.steps[i]))
+
+
+class MotionPlanner(object):
+    """ Queue between GMachine and hal which looks ahead over several
+        linear movements and calculates entry and exit step delay of each
+        axis at every junction, so machine does not stop between movements
+        unless geometry requires it. Junction velocity is limited by angle
+        between movements (junction deviation) and by acceleration ramp
+        available inside each movement. Pulse generator of movements is
+        chosen by profile.generator.
+        Queue belongs to the thread which adds movements, other threads
+        only request to drop it by cancel().
+    """
+    def __init__(self, execute, lookahead=PLANNER_LOOKAHEAD, profile=None):
+        """ Create object.
+        :param execute: function which runs planned PulseGenerator, i.e.
+                        hal.add_task.
+        :param lookahead: number of movements to look ahead.
+        :param profile: MachineProfile object, default profile if None.
+        """
+        self._execute = execute
+        self._lookahead = max(1, lookahead)
+        self._queue = []
+        self._profile = profile or get_profile()
+        self._start = self._profile.delaytime_start
+        self._add = self._profile.stepdelay_add
+        self._mm_per_step = self._profile.mm_per_step
+        # entry delay of the first queued movement, machine stays at start
+        self._entry = list(self._start)
+        self._cancelled = threading.Event()
+
+    def add(self, delta, velocity, steps=None):
+        """ Add linear movement. Movement runs when enough movements are
+            queued behind it or on flush().
+        :param delta: movement delta in mm, Coordinates object.
+        :param velocity: velocity for each axis, Coordinates object.
+        :param steps: four integers, movement in steps, they go to pulse
+                      generator unchanged, converted from delta if None.
+        """
+        self._check_cancel()
+        self._queue.append(PlannerSegment(delta, velocity, self._profile, steps))
+        while len(self._queue) > self._lookahead and not self._check_cancel():
+            self._release()
+
+    def flush(self):
+        """ Run all queued movements, machine stops after the last one.
+        """
+        while self._queue and not self._check_cancel():
+            self._release()
+
+    def clear(self):
+        """ Drop queued movements, i.e. after machine was stopped. The next
+            movement starts from stop. Should be called by the thread which
+            adds movements, see cancel().
+        """
+        self._cancelled.clear()
+        self._queue = []
+        self._entry = list(self._start)
+
+    def cancel(self):
+        """ Request to drop queued movements, can be called from any
+            thread. Queue is cleared by the thread which adds movements
+            before it runs the next one, so movement which is released at
+            the moment is not broken.
+        """
+        self._cancelled.set()
+
+    def _check_cancel(self):
+        """ Clear queue if cancel() was called.
+        :return: True if queue was cleared.
+        """
+        if not self._cancelled.is_set():
+            return False
+        self.clear()
+        return True
+
+    def pending(self):
+        """ Get number of queued movements.
+        """
+        return len(self._queue)
+
+    def _junction_factor(self, a, b):
+        """ Velocity multiplier for junction between two movements, 1.0 if
+            movements are collinear, 0.0 if direction is reversed.
+        """
+        if a.unit is None or b.unit is None or not a.speed or not b.speed:
+            return 0.0
+        cos_theta = -(a.unit[0] * b.unit[0] + a.unit[1] * b.unit[1]
+                      + a.unit[2] * b.unit[2])
+        if cos_theta > 0.999999:
+            return 0.0
+        if cos_theta < -0.999999:
+            return 1.0
+        sin_theta_d2 = math.sqrt(0.5 * (1.0 - cos_theta))
+        profile = self._profile
+        v_mm_per_min = math.sqrt(profile.max_acceleration
+                                 * profile.junction_deviation * sin_theta_d2
+                                 / (1.0 - sin_theta_d2)) * SECONDS_IN_MINUTE
+        return min(1.0, v_mm_per_min / min(a.speed, b.speed))
+
+    def _junction_delaytime(self, a, b, k, axis):
+        """ Nominal step delay of axis between movements a and b.
+        """
+        start = self._start[axis]
+        if not a.steps[axis] or not b.steps[axis] \
+                or a.direction[axis] != b.direction[axis] or k <= 0:
+            return start
+        v = min(a.velocity_list[axis], b.velocity_list[axis]) * k
+        d = delaytime_from_velocity(self._mm_per_step[axis], v)
+        return min(start, max(d, a.cruise_delaytime[axis],
+                              b.cruise_delaytime[axis]))
+
+    def _plan(self):
+        """ Calculate exit delay of every queued movement.
+        :return: list of four lists, exit delays of each axis.
+        """
+        q = self._queue
+        factors = [self._junction_factor(q[i], q[i + 1])
+                   for i in range(len(q) - 1)]
+        result = []
+        for axis in range(4):
+            add = self._add[axis]
+            start = self._start[axis]
+            j = [self._junction_delaytime(q[i], q[i + 1], factors[i], axis)
+                 for i in range(len(q) - 1)]
+            # the last queued movement has to stop
+            j.append(start)
+            # backward pass: possible to brake to the next junction
+            for i in range(len(q) - 2, -1, -1):
+                j[i] = max(j[i], j[i + 1] - max(q[i + 1].steps[axis] - 1, 0) * add)
+            # forward pass: possible to accelerate from previous junction
+            entry = self._entry[axis]
+            for i in range(len(q)):
+                j[i] = min(start, max(j[i], entry - max(q[i].steps[axis] - 1, 0) * add))
+                entry = j[i]
+            result.append(j)
+        return result
+
+    def _coordinated(self, segment, exit_delaytime):
+        """ Build movement where all axises arrive together. Each axis
+            runs steps / dominant steps of dominant axis velocity, so
+            dominant axis delay at junction is chosen so that no axis is
+            faster then its planned junction delay.
+        :return: Tuple of PulseGeneratorCoordinated object and list of
+                 four exit delays which axises really have.
+        """
+        steps = segment.steps
+        n = max(steps)
+        entry = max(self._entry[i] * steps[i] / n for i in range(4) if steps[i])
+        exit = max(exit_delaytime[i] * steps[i] / n for i in range(4) if steps[i])
+        gen = PulseGeneratorCoordinated(segment.delta, segment.velocity, entry, exit,
+                                        self._profile, steps)
+        exit = gen.exit_delaytime
+        # 沒有移動或比起始速度慢的軸，下一段可由起始 delay 開始
+        return gen, [min(self._start[i], exit * n / steps[i]) if steps[i] else self._start[i]
+                     for i in range(4)]
+
+    def _release(self):
+        """ Run the first queued movement.
+        """
+        exits = self._plan()
+        segment = self._queue.pop(0)
+        exit_delaytime = [exits[axis][0] for axis in range(4)]
+        logging.debug("planner entry {} exit {}".format(self._entry, exit_delaytime))
+        if self._profile.generator == 'coordinated':
+            gen, exit_delaytime = self._coordinated(segment, exit_delaytime)
+        elif self._profile.generator == 'scurve':
+            # S 曲線表由靜止開始並停止，轉角不混合
+            exit_delaytime = list(self._start)
+            gen = PulseGeneratorSCurve(segment.delta, segment.velocity,
+                                       profile=self._profile, steps=segment.steps)
+        else:
+            gen = PulseGeneratorLinear(segment.delta, segment.velocity,
+                                       Coordinates(*self._entry),
+                                       Coordinates(*exit_delaytime), self._profile,
+                                       segment.steps)
+        self._entry = exit_delaytime
+        self._execute(gen)
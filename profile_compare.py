@@ -0,0 +1,70 @@
+""" Compare linear delay ramp with jerk limited S-curve profile. For each
+    moving axis S-curve is built with the same peak jerk and peak
+    acceleration which linear ramp has, so motor load is not higher, and
+    total movement times are printed.
+"""
+import numpy as np
+
+from logging_config import *
+from coordinates import *
+from pulse import PulseGeneratorLinear, PulseGeneratorSCurve
+from ramp_cache import profile_peaks
+from machine_profile import get_profile
+
+
+AXES = ('x', 'y', 'z', 'e')
+
+
+def compare_profiles(delta_mm, velocity_mm_per_min, jerk_mm_per_s3=None,
+                     acceleration_mm_per_s2=None):
+    """ Plan movement with both profiles.
+    :param delta_mm: movement delta in mm, Coordinates object.
+    :param velocity_mm_per_min: velocity for each axis, Coordinates.
+    :param jerk_mm_per_s3: S-curve jerk for each axis, Coordinates, peak
+                           jerk of linear ramp if None.
+    :param acceleration_mm_per_s2: S-curve acceleration for each axis,
+                                   Coordinates, peak acceleration of linear
+                                   ramp if None.
+    :return: list of dicts, one for each moving axis.
+    """
+    linear = PulseGeneratorLinear(delta_mm, velocity_mm_per_min)
+    mm_per_step = get_profile().mm_per_step
+    linear_delays = [np.array([linear.step_delay(axis, k) for k in range(linear.steps[axis])])
+                     for axis in range(4)]
+    peaks = [profile_peaks(d) for d in linear_delays]
+    if jerk_mm_per_s3 is None:
+        jerk_mm_per_s3 = Coordinates(*[max(p[1], 1.0) * m for p, m in zip(peaks, mm_per_step)])
+    if acceleration_mm_per_s2 is None:
+        acceleration_mm_per_s2 = Coordinates(*[max(p[0], 1.0) * m for p, m in zip(peaks, mm_per_step)])
+    scurve = PulseGeneratorSCurve(delta_mm, velocity_mm_per_min,
+                                  jerk_mm_per_s3, acceleration_mm_per_s2)
+    result = []
+    for axis in range(4):
+        if not linear.steps[axis]:
+            continue
+        s_acc, s_jerk = profile_peaks(scurve.delay_tables[axis])
+        result.append({'axis': AXES[axis],
+                       'steps': linear.steps[axis],
+                       'linear_time_s': linear.axis_time_s(axis),
+                       'scurve_time_s': scurve.axis_time_s(axis),
+                       'linear_peak_acceleration': peaks[axis][0],
+                       'linear_peak_jerk': peaks[axis][1],
+                       'scurve_peak_acceleration': s_acc,
+                       'scurve_peak_jerk': s_jerk})
+    return result
+
+
+def main():
+    velocity = Coordinates(300, 300, 300, 300)
+    print("{:>4} {:>7} {:>10} {:>10} {:>10} {:>12} {:>12}".format(
+        'axis', 'steps', 'linear s', 'S-curve s', 'saved %', 'peak jerk', 'S jerk'))
+    for distance in (5, 20, 60, 200):
+        for r in compare_profiles(Coordinates(distance, 0, distance / 2.0, 0), velocity):
+            saved = 100.0 * (1.0 - r['scurve_time_s'] / r['linear_time_s'])
+            print("{:>4} {:>7} {:>10.4f} {:>10.4f} {:>10.1f} {:>12.4g} {:>12.4g}".format(
+                r['axis'], r['steps'], r['linear_time_s'], r['scurve_time_s'], saved,
+                r['linear_peak_jerk'], r['scurve_peak_jerk']))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,20 +2,43 @@ from __future__ import division
 import logging
 import math
 
+import numpy as np
+
 from logging_config import *
 from coordinates import *
+from ramp_cache import ramp_table
+from timeline import (ramp_delays, compile_linear, compile_scurve, compile_coordinated,
+                      compile_circular)
+from machine_profile import delaytime_from_velocity, velocity_from_delaytime, get_profile
 
 SECONDS_IN_MINUTE = 60.0
 
+
+def movement_steps(delta_mm, profile, steps=None):
+    """ Get number of steps of movement for each axis.
+    :param delta_mm: movement delta in mm, Coordinates object.
+    :param profile: MachineProfile object.
+    :param steps: four integers, movement in steps, used as they are if
+                  given, so step counts of GMachine are not converted to mm
+                  and back.
+    :return: list of four non negative integers.
+    """
+    if steps is not None:
+        return [abs(int(s)) for s in steps]
+    delta = (delta_mm.x, delta_mm.y, delta_mm.z, delta_mm.e)
+    return [int(round(abs(delta[i]) / profile.mm_per_step[i])) for i in range(4)]
+
 class PulseGenerator(object):
     
 
-    def __init__(self, delta):
+    def __init__(self, delta, profile=None):
         """ Create object. Do not create directly this object, inherit this
             class and implement interpolation function and related methods.
             All child have to call this method ( super().__init__() ).
             :param delta: overall movement delta in mm, uses for debug purpose.
+            :param profile: MachineProfile object, default profile if None.
         """
+        self._profile = profile or get_profile()
         self._iteration_x = 0
         self._iteration_y = 0
         self._iteration_z = 0
@@ -36,18 +59,10 @@ class PulseGenerator(object):
         if not self.AUTO_VELOCITY_ADJUSTMENT:
             return velocity_mm_sec
         k = 1.0
-        if velocity_mm_sec.x * SECONDS_IN_MINUTE > MAX_VELOCITY_MM_PER_MIN_X:
-            k = min(k, MAX_VELOCITY_MM_PER_MIN_X
-                    / velocity_mm_sec.x / SECONDS_IN_MINUTE)
-        if velocity_mm_sec.y * SECONDS_IN_MINUTE > MAX_VELOCITY_MM_PER_MIN_Y:
-            k = min(k, MAX_VELOCITY_MM_PER_MIN_Y
-                    / velocity_mm_sec.y / SECONDS_IN_MINUTE)
-        if velocity_mm_sec.z * SECONDS_IN_MINUTE > MAX_VELOCITY_MM_PER_MIN_Z:
-            k = min(k, MAX_VELOCITY_MM_PER_MIN_Z
-                    / velocity_mm_sec.z / SECONDS_IN_MINUTE)
-        if velocity_mm_sec.e * SECONDS_IN_MINUTE > MAX_VELOCITY_MM_PER_MIN_E:
-            k = min(k, MAX_VELOCITY_MM_PER_MIN_E
-                    / velocity_mm_sec.e / SECONDS_IN_MINUTE)
+        velocity = (velocity_mm_sec.x, velocity_mm_sec.y, velocity_mm_sec.z, velocity_mm_sec.e)
+        for v, limit in zip(velocity, self._profile.max_velocity_mm_per_min):
+            if v * SECONDS_IN_MINUTE > limit:
+                k = min(k, limit / v / SECONDS_IN_MINUTE)
         if k != 1.0:
             logging.warning("Out of speed, multiply velocity by {}".format(k))
         return velocity_mm_sec * k
@@ -151,13 +166,14 @@ Even if whole movement is accelerated, this value should be calculated as top ve
         if direction != self._iteration_direction:
             self._iteration_direction = direction
             dir_x, dir_y, dir_z, dir_e = direction
-            if STEPPER_INVERTED_X:
+            inverted_x, inverted_y, inverted_z, inverted_e = self._profile.inverted
+            if inverted_x:
                 dir_x = -dir_x
-            if STEPPER_INVERTED_Y:
+            if inverted_y:
                 dir_y = -dir_y
-            if STEPPER_INVERTED_Z:
+            if inverted_z:
                 dir_z = -dir_z
-            if STEPPER_INVERTED_E:
+            if inverted_e:
                 dir_e = -dir_e
             return True, dir_x, dir_y, dir_z, dir_e
         # check condition to stop
@@ -218,29 +234,71 @@ Even if whole movement is accelerated, this value should be calculated as top ve
         _, _, v = self._get_movement_parameters()
         return v * SECONDS_IN_MINUTE
 
+    def timeline(self):
+        """ Compile movement to PulseTimeline, hal axis workers run it.
+            This method have to be reimplemented in child classes.
+        :return: PulseTimeline object.
+        """
+        raise NotImplementedError
+
+
+def ramp_time_s(n, start, end, add, target):
+    """ Time of n pulses which start with delay start, accelerate by add
+        per pulse up to target delay and brake to delay end, the same
+        ramp PulseGeneratorLinear.step_delay() describes.
+    :return: time in seconds.
+    """
+    if n <= 0:
+        return 0.0
+    if add <= 0:
+        return 2.0 * n * max(start, end, target)
+    # pulses before crossing point follow acceleration ramp, after it
+    # braking ramp counted from the last pulse
+    k = (start - end) / (2.0 * add) + (n - 1) / 2.0
+    m = min(n, max(0, int(math.floor(k)) + 1))
+    return 2.0 * (ramp_table(start, add, target).sum(m)
+                  + ramp_table(end, add, target).sum(n - m))
+
 
 class PulseGeneratorLinear(PulseGenerator): #在Gmachine中
-    def __init__(self, delta_mm, velocity_mm_per_min):  #個軸獨立計算，step固定，計算速度
-        print('PulseGeneratorLinear')
-        super(PulseGeneratorLinear, self).__init__(delta_mm)
-        distance_mm = abs(delta_mm)  #type: Coordinates
-        _distance_mm = [distance_mm.x, distance_mm.y, distance_mm.z, distance_mm.e]
+    def __init__(self, delta_mm, velocity_mm_per_min, entry_delaytime=None, exit_delaytime=None, profile=None,
+                 steps=None):  #個軸獨立計算，step固定，計算速度
+        """ Create linear movement.
+        :param delta_mm: movement delta in mm, Coordinates object.
+        :param velocity_mm_per_min: velocity for each axis, Coordinates.
+        :param entry_delaytime: step delay of the first pulse for each axis,
+                                delaytime_start if None, i.e. from stop.
+        :param exit_delaytime: step delay of the last pulse for each axis,
+                               delaytime_start if None, i.e. to stop.
+        :param profile: MachineProfile object, default profile if None.
+        :param steps: four integers, movement in steps, see movement_steps().
+        """
+        super(PulseGeneratorLinear, self).__init__(delta_mm, profile)
+        profile = self._profile
+        # 每軸總步數 (逐步脈衝時間用)
+        self.steps = movement_steps(delta_mm, profile, steps)
         
         # 計算目標delaytime => delaytime=[(MM/Step)/Velocity*200-0.036]/400
-        self.max_velocity_delaytime = (Coordinates(mm_per_step_x, mm_per_step_y, mm_per_step_z, mm_per_step_e)/(velocity_mm_per_min)*Coordinates(200,200,200,200)-Coordinates(0.036,0.036,0.036,0.036))/Coordinates(400,400,400,400)  #前方mm_per_step_x要調整，為速度轉速放大比
+        self.max_velocity_delaytime = (profile.mm_per_step_vector/(velocity_mm_per_min)*Coordinates(200,200,200,200)-Coordinates(0.036,0.036,0.036,0.036))/Coordinates(400,400,400,400)  #前方mm_per_step_x要調整，為速度轉速放大比
         
-        self.delaytime_start = Coordinates(delaytime_start_x, delaytime_start_y, delaytime_start_z, delaytime_start_e )
+        self.delaytime_start = profile.delaytime_start_vector
+        if exit_delaytime is None:
+            exit_delaytime = self.delaytime_start
+        if entry_delaytime is not None:
+            self.delaytime_start = entry_delaytime
+        # 等速 delaytime (下方距離不足時 max_velocity_delaytime 會被調整)
+        _cruise_delaytime = [self.max_velocity_delaytime.x, self.max_velocity_delaytime.y,
+                             self.max_velocity_delaytime.z, self.max_velocity_delaytime.e]
         
         
-        stepdelay_add = Coordinates(stepdelay_add_x, stepdelay_add_y, stepdelay_add_z, stepdelay_add_e)
+        stepdelay_add = profile.stepdelay_add_vector
         # 計算加減速所需步數 =>  (最大速度delay-初速delay)/加速度delay_add
         self.acc_steps = math.ceil((self.delaytime_start-self.max_velocity_delaytime)/(stepdelay_add))
         
         #等速移動所需步數
         self.linear_steps = [0,0,0,0]
         
-        mm_per_step = Coordinates(mm_per_step_x, mm_per_step_y, mm_per_step_z, mm_per_step_e)
-        _mm_per_step = [mm_per_step_x, mm_per_step_y, mm_per_step_z, mm_per_step_e]
+        _mm_per_step = profile.mm_per_step
         
         '''print('剛開始acc_steps',self.acc_steps.x,',max_velocity_delaytime',self.max_velocity_delaytime.x)
         print('所需距離',self.acc_steps.x*mm_per_step.x*2,'總距離',distance_mm.x)
@@ -249,34 +307,43 @@ class PulseGeneratorLinear(PulseGenerator): #在Gmachine中
         _max_velocity_mm_per_sec=[0,0,0,0]
         #########各軸獨立判斷
         # check if there is enough space to accelerate and brake, adjust velocity
-        for i,j in enumerate(self.acc_steps*mm_per_step*Coordinates(2,2,2,2) > distance_mm):
-            if j and i==0:  ###如果距離不夠加速到最快，一半距離用來加速，另一半減速
-                print("x not enough space")
-                self.acc_steps.x=int(distance_mm.x/mm_per_step_x/2)
+        _acc_steps = [self.acc_steps.x, self.acc_steps.y, self.acc_steps.z, self.acc_steps.e]
+        _max_velocity_delaytime = list(_cruise_delaytime)
+        _delaytime_start = [self.delaytime_start.x, self.delaytime_start.y, self.delaytime_start.z, self.delaytime_start.e]
+        _stepdelay_add = [stepdelay_add.x, stepdelay_add.y, stepdelay_add.z, stepdelay_add.e]
+        for i in range(4):
+            if _acc_steps[i] * 2 > self.steps[i]:  ###如果距離不夠加速到最快，一半距離用來加速，另一半減速
+                _acc_steps[i] = self.steps[i] // 2
                 # 計算最大速度及其delaytime
-                self.max_velocity_delaytime.x = self.delaytime_start.x - (self.acc_steps.x * stepdelay_add.x)
-                _max_velocity_mm_per_sec[i] = 1 / (400 * self.max_velocity_delaytime.x + 0.036) * 200 * mm_per_step_x
-            elif j and i==1:
-                self.acc_steps.y=int(distance_mm.y/mm_per_step_y/2)
-                self.max_velocity_delaytime.y = self.delaytime_start.y - (self.acc_steps.y * stepdelay_add.y)
-                _max_velocity_mm_per_sec[i] = 1 / (400 * self.max_velocity_delaytime.y + 0.036) * 200 * mm_per_step_y
-            elif j and i==2:
-                self.acc_steps.z=int(distance_mm.z/mm_per_step_z/2)
-                self.max_velocity_delaytime.z = self.delaytime_start.z - (self.acc_steps.z * stepdelay_add.z)
-                _max_velocity_mm_per_sec[i] = 1 / (400 * self.max_velocity_delaytime.z + 0.036) * 200 * mm_per_step_z
-            elif j and i==3:
-                self.acc_steps.e=int(distance_mm.e/mm_per_step_e/2)
-                self.max_velocity_delaytime.e = self.delaytime_start.e - (self.acc_steps.e * stepdelay_add.e)
-                _max_velocity_mm_per_sec[i] = 1 / (400 * self.max_velocity_delaytime.e + 0.036) * 200 * mm_per_step_e
+                _max_velocity_delaytime[i] = _delaytime_start[i] - (_acc_steps[i] * _stepdelay_add[i])
+                _max_velocity_mm_per_sec[i] = velocity_from_delaytime(_mm_per_step[i], _max_velocity_delaytime[i])
             else:
                 # calculate linear time => 線性步數 = (全部步數-加速步數*2)
-                self._acc_steps = [self.acc_steps.x, self.acc_steps.y, self.acc_steps.z, self.acc_steps.e]
-                self.total_steps = math.floor(_distance_mm[i]/_mm_per_step[i])
-                self.linear_steps[i] = self.total_steps-self._acc_steps[i]*2
+                self.total_steps = self.steps[i]
+                self.linear_steps[i] = self.total_steps-_acc_steps[i]*2
+        self._acc_steps = _acc_steps
+        self.acc_steps = Coordinates(*_acc_steps)
+        self.max_velocity_delaytime = Coordinates(*_max_velocity_delaytime)
         
         self._linear_steps=Coordinates(self.linear_steps[0], self.linear_steps[1], self.linear_steps[2], self.linear_steps[3])
             
         self._direction = (math.copysign(1, delta_mm.x),math.copysign(1, delta_mm.y),math.copysign(1, delta_mm.z),math.copysign(1, delta_mm.e))#方向 (後面的 +- 乘以前面的1)
+
+        # 每軸加減速參數 (逐步脈衝時間用)
+        self._delaytime_start = [self.delaytime_start.x, self.delaytime_start.y,
+                                 self.delaytime_start.z, self.delaytime_start.e]
+        self._delaytime_end = [exit_delaytime.x, exit_delaytime.y,
+                               exit_delaytime.z, exit_delaytime.e]
+        self._stepdelay_add = [stepdelay_add.x, stepdelay_add.y,
+                               stepdelay_add.z, stepdelay_add.e]
+        self._target_delaytime = _cruise_delaytime
+        # 加減速 delaytime 表，相同速度的移動共用
+        self._entry_ramps = [ramp_table(self._delaytime_start[i], self._stepdelay_add[i],
+                                        self._target_delaytime[i]) for i in range(4)]
+        self._exit_ramps = [ramp_table(self._delaytime_end[i], self._stepdelay_add[i],
+                                       self._target_delaytime[i]) for i in range(4)]
+        self._pulse_index = [0, 0, 0, 0]
+        self._pulse_time = [0.0, 0.0, 0.0, 0.0]
         
     
         '''self.linear_time_s = (linear_distance_mm                     
@@ -292,4 +359,500 @@ class PulseGeneratorLinear(PulseGenerator): #在Gmachine中
         return (self.acc_steps,
                 self.delaytime_start,
                 self.max_velocity_delaytime,
-                self.linear_steps)
\ No newline at end of file
+                self.linear_steps)
+
+    def step_delay(self, axis, k):
+        """ Get delay of the k-th pulse of axis. motor_go sleeps this time
+            after rising edge and once again after falling edge. Delay
+            decreases by stepdelay_add from entry delay to
+            max_velocity_delaytime and increases the same way to exit delay
+            while braking.
+        :param axis: axis index, 0..3 for X, Y, Z, E.
+        :param k: pulse number.
+        :return: delay in seconds.
+        """
+        d = self._entry_ramps[axis].delay(k)
+        d_end = self._exit_ramps[axis].delay(self.steps[axis] - 1 - k)
+        if d_end > d:
+            d = d_end
+        target = self._target_delaytime[axis]
+        return d if d > target else target
+
+    def axis_time_s(self, axis):
+        """ Get movement time of one axis.
+        :param axis: axis index, 0..3 for X, Y, Z, E.
+        :return: time in seconds.
+        """
+        return ramp_time_s(self.steps[axis], self._delaytime_start[axis],
+                           self._delaytime_end[axis], self._stepdelay_add[axis],
+                           self._target_delaytime[axis])
+
+    def total_time_s(self):
+        """ Get total time for movement, axes run in parallel.
+        :return: time in seconds.
+        """
+        return max(self.axis_time_s(i) for i in range(4))
+
+    def timeline(self):
+        """ Compile movement to per axis pulse times and step delays, the
+            same schedule iteration produces.
+        :return: PulseTimeline object.
+        """
+        return compile_linear(self)
+
+    def __iter__(self):
+        """ Get iterator. Pulses are produced by the same delay ramp which
+            motor_go executes.
+        :return: iterable object.
+        """
+        self._iteration_x = 0
+        self._iteration_y = 0
+        self._iteration_z = 0
+        self._iteration_e = 0
+        self._iteration_direction = None
+        self._pulse_index = [0, 0, 0, 0]
+        self._pulse_time = [0.0, 0.0, 0.0, 0.0]
+        return self
+
+    def _to_accelerated_time(self, pt_s):
+        """ Times from _interpolation_function already include ramp.
+        """
+        return pt_s
+
+    def _interpolation_function(self, ix, iy, iz, ie):
+        """ Get times of next pulses, see super class for details.
+        """
+        t = [None, None, None, None]
+        for axis, i in enumerate((ix, iy, iz, ie)):
+            if i >= self.steps[axis]:
+                continue
+            while self._pulse_index[axis] < i:
+                self._pulse_time[axis] += 2.0 * self.step_delay(
+                    axis, self._pulse_index[axis])
+                self._pulse_index[axis] += 1
+            t[axis] = self._pulse_time[axis]
+        return self._direction, tuple(t)
+
+
+def _scurve_phase_times(v0, v1, jerk, acceleration):
+    """ Durations of jerk and constant acceleration phases of S-curve from
+        velocity v0 to v1.
+    :return: Tuple of two values, time of each jerk phase and time of
+             constant acceleration phase in seconds.
+    """
+    dv = v1 - v0
+    if acceleration is None or dv * jerk <= acceleration ** 2:
+        return math.sqrt(dv / jerk), 0.0
+    tj = acceleration / jerk
+    return tj, dv / acceleration - tj
+
+
+def _scurve_distance(v0, v1, jerk, acceleration):
+    """ Distance of S-curve acceleration from v0 to v1, the profile is
+        symmetric, so average velocity is (v0 + v1) / 2.
+    """
+    tj, ta = _scurve_phase_times(v0, v1, jerk, acceleration)
+    return (v0 + v1) / 2.0 * (2.0 * tj + ta)
+
+
+def _scurve_position(t, v0, jerk, tj, ta):
+    """ Position and velocity during S-curve acceleration.
+    :param t: array of times from acceleration start.
+    :return: Tuple of two arrays, position and velocity.
+    """
+    a = jerk * tj
+    v1 = v0 + a * tj / 2.0
+    s1 = v0 * tj + jerk * tj ** 3 / 6.0
+    v2 = v1 + a * ta
+    s2 = s1 + v1 * ta + a * ta ** 2 / 2.0
+    t1 = np.minimum(t, tj)
+    t2 = np.clip(t - tj, 0.0, ta)
+    t3 = np.clip(t - tj - ta, 0.0, tj)
+    s = np.where(t <= tj, v0 * t1 + jerk * t1 ** 3 / 6.0,
+                 np.where(t <= tj + ta, s1 + v1 * t2 + a * t2 ** 2 / 2.0,
+                          s2 + v2 * t3 + a * t3 ** 2 / 2.0 - jerk * t3 ** 3 / 6.0))
+    v = np.where(t <= tj, v0 + jerk * t1 ** 2 / 2.0,
+                 np.where(t <= tj + ta, v1 + a * t2,
+                          v2 + a * t3 - jerk * t3 ** 2 / 2.0))
+    return s, v
+
+
+def scurve_delays(n, v0, v1, jerk, acceleration=None):
+    """ Step delays of jerk limited movement, which starts and stops with
+        velocity v0 and cruises with velocity v1. If there is no space to
+        reach v1, the highest cruise velocity which fits is used.
+    :param n: number of steps.
+    :param v0: start and stop velocity in steps per second.
+    :param v1: cruise velocity in steps per second.
+    :param jerk: maximum jerk in steps per second^3.
+    :param acceleration: maximum acceleration in steps per second^2, not
+                         limited if None.
+    :return: float64 array of n delays, half of each pulse period as
+             motor_go sleeps it.
+    """
+    if n <= 0:
+        return np.zeros(0, dtype=np.float64)
+    if jerk <= 0 or (acceleration is not None and acceleration <= 0):
+        raise ValueError("jerk and acceleration must be positive")
+    if v1 <= v0:
+        return np.full(n, 0.5 / v1, dtype=np.float64)
+    if 2.0 * _scurve_distance(v0, v1, jerk, acceleration) > n:
+        lo, hi = v0, v1
+        for _ in range(60):
+            mid = (lo + hi) / 2.0
+            if 2.0 * _scurve_distance(v0, mid, jerk, acceleration) > n:
+                hi = mid
+            else:
+                lo = mid
+        v1 = lo
+    tj, ta = _scurve_phase_times(v0, v1, jerk, acceleration)
+    t_acc = 2.0 * tj + ta
+    s_acc = _scurve_distance(v0, v1, jerk, acceleration)
+    t_total = 2.0 * t_acc + (n - 2.0 * s_acc) / v1
+
+    def time_at(s):
+        # invert position of acceleration on dense grid, then refine
+        grid = np.linspace(0.0, t_acc, max(256, 32 * int(math.ceil(s_acc))))
+        t = np.interp(s, _scurve_position(grid, v0, jerk, tj, ta)[0], grid)
+        for _ in range(3):
+            p, v = _scurve_position(t, v0, jerk, tj, ta)
+            t = np.clip(t - (p - s) / v, 0.0, t_acc)
+        return t
+
+    k = np.arange(n + 1, dtype=np.float64)
+    t = t_acc + (k - s_acc) / v1
+    acc = k <= s_acc
+    t[acc] = time_at(k[acc])
+    brake = k >= n - s_acc
+    t[brake] = t_total - time_at(n - k[brake])
+    return np.diff(t) / 2.0
+
+
+class PulseGeneratorSCurve(PulseGeneratorLinear):
+    """ Linear movement with jerk limited S-curve velocity profile instead
+        of linear delay ramp. Each axis gets precomputed step delay table,
+        it starts and stops with delaytime_start velocity like
+        PulseGeneratorLinear does.
+    """
+    def __init__(self, delta_mm, velocity_mm_per_min, jerk_mm_per_s3=None,
+                 acceleration_mm_per_s2=None, profile=None, steps=None):
+        """ Create S-curve movement.
+        :param delta_mm: movement delta in mm, Coordinates object.
+        :param velocity_mm_per_min: velocity for each axis, Coordinates.
+        :param jerk_mm_per_s3: maximum jerk for each axis, Coordinates,
+                               profile.scurve_jerk if None.
+        :param acceleration_mm_per_s2: maximum acceleration for each axis,
+                                       Coordinates,
+                                       profile.scurve_acceleration if None.
+        :param profile: MachineProfile object, default profile if None.
+        :param steps: four integers, movement in steps, see movement_steps().
+        """
+        super(PulseGeneratorSCurve, self).__init__(delta_mm, velocity_mm_per_min,
+                                                   profile=profile, steps=steps)
+        if jerk_mm_per_s3 is None:
+            jerk_mm_per_s3 = Coordinates(*self._profile.scurve_jerk)
+        if acceleration_mm_per_s2 is None:
+            acceleration_mm_per_s2 = Coordinates(*self._profile.scurve_acceleration)
+        mm_per_step = self._profile.mm_per_step
+        jerk = (jerk_mm_per_s3.x, jerk_mm_per_s3.y, jerk_mm_per_s3.z, jerk_mm_per_s3.e)
+        acceleration = (acceleration_mm_per_s2.x, acceleration_mm_per_s2.y,
+                        acceleration_mm_per_s2.z, acceleration_mm_per_s2.e)
+        self.delay_tables = [
+            scurve_delays(self.steps[i], 0.5 / self._delaytime_start[i],
+                          0.5 / self._target_delaytime[i],
+                          jerk[i] / mm_per_step[i], acceleration[i] / mm_per_step[i])
+            for i in range(4)]
+
+    def step_delay(self, axis, k):
+        """ Get delay of the k-th pulse of axis from delay table.
+        """
+        return float(self.delay_tables[axis][k])
+
+    def axis_time_s(self, axis):
+        """ Get movement time of one axis.
+        """
+        return 2.0 * float(self.delay_tables[axis].sum())
+
+    def timeline(self):
+        """ Compile movement from delay tables, see
+            PulseGeneratorLinear.timeline().
+        """
+        return compile_scurve(self)
+
+
+class PulseGeneratorCoordinated(PulseGenerator):
+    """ Linear movement where all axises arrive together. Dominant axis,
+        the one with the most steps, follows the delay ramp, other axises
+        are time-scaled to it and step on dominant axis pulses like
+        Bresenham line, so head moves along straight line. Cruise delay is
+        chosen so that no axis runs faster then its velocity allows.
+    """
+    def __init__(self, delta_mm, velocity_mm_per_min, entry_delaytime=None, exit_delaytime=None,
+                 profile=None, steps=None):
+        """ Create object.
+        :param delta_mm: movement delta in mm, Coordinates object.
+        :param velocity_mm_per_min: maximum velocity for each axis,
+                                    Coordinates.
+        :param entry_delaytime: step delay of the first pulse of dominant
+                                axis, its delaytime_start if None.
+        :param exit_delaytime: step delay of the last pulse of dominant
+                               axis, its delaytime_start if None.
+        :param profile: MachineProfile object, default profile if None.
+        :param steps: four integers, movement in steps, see movement_steps().
+        """
+        super(PulseGeneratorCoordinated, self).__init__(delta_mm, profile)
+        profile = self._profile
+        mm_per_step = profile.mm_per_step
+        fastest = profile.max_velocity_delaytime
+        start = profile.delaytime_start
+        adds = profile.stepdelay_add
+        delta = (delta_mm.x, delta_mm.y, delta_mm.z, delta_mm.e)
+        velocity = (velocity_mm_per_min.x, velocity_mm_per_min.y,
+                    velocity_mm_per_min.z, velocity_mm_per_min.e)
+        self.steps = movement_steps(delta_mm, profile, steps)
+        self._direction = tuple(math.copysign(1, d) for d in delta)
+        n = max(self.steps)
+        self.dominant_axis = self.steps.index(n)
+        # axis i runs n_i / n times slower then dominant axis
+        target = 0.0
+        for i in range(4):
+            if self.steps[i]:
+                d = max(delaytime_from_velocity(mm_per_step[i], velocity[i]), fastest[i])
+                target = max(target, d * self.steps[i] / n)
+        self.cruise_delaytime = target
+        axis = self.dominant_axis
+        entry = start[axis] if entry_delaytime is None else entry_delaytime
+        exit = start[axis] if exit_delaytime is None else exit_delaytime
+        delays = ramp_delays(n, entry, exit, adds[axis], target)
+        # dominant axis delay of the last pulse, it can be longer then
+        # exit_delaytime if movement is too short to accelerate
+        self.exit_delaytime = float(delays[-1])
+        ticks = np.empty(n + 1, dtype=np.float64)
+        ticks[0] = 0.0
+        np.cumsum(2.0 * delays, out=ticks[1:])
+        self._total_time_s = float(ticks[-1])
+
+        self._times = []
+        self._delays = []
+        self._dirs = []
+        for i in range(4):
+            m = self.steps[i]
+            # pulse j brings axis to position j + 1, the same moment
+            # dominant axis reaches (j + 1) * n / m
+            j = np.arange(1, m + 1, dtype=np.int64)
+            tick = (j * n + m - 1) // m - 1 if m else j
+            times = ticks[tick]
+            self._times.append(times)
+            self._delays.append(np.diff(np.append(times, ticks[-1])) / 2.0)
+            self._dirs.append(np.full(m, self._direction[i]))
+        self._start_direction = self._direction
+
+    def total_time_s(self):
+        """ Get total time for movement, all axises finish together.
+        :return: time in seconds.
+        """
+        return self._total_time_s
+
+    def timeline(self):
+        """ Compile movement, see PulseGeneratorLinear.timeline().
+        """
+        return compile_coordinated(self)
+
+    def __iter__(self):
+        """ Get iterator.
+        :return: iterable object.
+        """
+        self._iteration_x = 0
+        self._iteration_y = 0
+        self._iteration_z = 0
+        self._iteration_e = 0
+        self._iteration_direction = None
+        return self
+
+    def _to_accelerated_time(self, pt_s):
+        """ Times from _interpolation_function already include ramp.
+        """
+        return pt_s
+
+    def _interpolation_function(self, ix, iy, iz, ie):
+        """ Get times of next pulses, see super class for details.
+        """
+        t = [None, None, None, None]
+        for axis, i in enumerate((ix, iy, iz, ie)):
+            if i < self.steps[axis]:
+                t[axis] = float(self._times[axis][i])
+        return self._direction, tuple(t)
+
+
+class PulseGeneratorCircular(PulseGenerator):
+    """ Circular movement in XY plane (G2/G3). Arc is walked directly on
+        step grid with integer midpoint algorithm: every path step moves X,
+        Y or both by one step, whichever keeps x^2 + y^2 closest to R^2.
+        Path steps follow one tangential ramp, so whole circle is one
+        movement with constant tangential speed. Z and E move linearly
+        along the arc.
+    """
+    def __init__(self, delta_mm, center_mm, clockwise, velocity_mm_per_min, profile=None,
+                 steps=None):
+        """ Create object.
+        :param delta_mm: movement delta in mm, Coordinates object.
+        :param center_mm: arc center relative to start position (I, J) in
+                          mm, Coordinates object, only X and Y are used.
+        :param clockwise: True for G2, False for G3.
+        :param velocity_mm_per_min: tangential velocity.
+        :param profile: MachineProfile object, default profile if None.
+        :param steps: four integers, movement in steps, converted from
+                      delta_mm if None.
+        """
+        super(PulseGeneratorCircular, self).__init__(delta_mm, profile)
+        mm_per_step_x, mm_per_step_y, mm_per_step_z, mm_per_step_e = self._profile.mm_per_step
+        if mm_per_step_x != mm_per_step_y:
+            raise ValueError("circular movement needs equal X and Y mm_per_step")
+        self.clockwise = clockwise
+        # start and end relative to center, in steps
+        if steps is None:
+            steps = [int(round(d / mm)) for d, mm in
+                     zip((delta_mm.x, delta_mm.y, delta_mm.z, delta_mm.e), self._profile.mm_per_step)]
+        x = -int(round(center_mm.x / mm_per_step_x))
+        y = -int(round(center_mm.y / mm_per_step_y))
+        ex = x + int(steps[0])
+        ey = y + int(steps[1])
+        # 起點和終點要在同一個圓上，否則最後一段會變成直線
+        if abs(math.hypot(x, y) - math.hypot(ex, ey)) > ARC_RADIUS_TOLERANCE_STEPS:
+            raise ValueError("arc end point is not on the circle, radius {:.1f} and {:.1f} "
+                             "steps".format(math.hypot(x, y), math.hypot(ex, ey)))
+        path = self._arc_steps(x, y, ex, ey, clockwise)
+        self.path_steps = len(path)
+
+        # 切線方向加減速: 每個路徑步的 delaytime
+        n = len(path)
+        start = self._profile.delaytime_start[0]
+        add = self._profile.stepdelay_add[0]
+        target = delaytime_from_velocity(mm_per_step_x, velocity_mm_per_min)
+        ramp = ramp_table(start, add, target)
+        t = 0.0
+        path_time = []
+        half_period = []
+        for k in range(n):
+            d = max(ramp.delay(k), ramp.delay(n - 1 - k), target)
+            if path[k][0] and path[k][1]:
+                d *= math.sqrt(2.0)
+            path_time.append(t)
+            half_period.append(d)
+            t += 2.0 * d
+        self._total_time_s = t
+
+        self._times = [[], [], [], []]
+        self._delays = [[], [], [], []]
+        self._dirs = [[], [], [], []]
+        for k in range(n):
+            for axis in (0, 1):
+                s = path[k][axis]
+                if s:
+                    self._times[axis].append(path_time[k])
+                    self._delays[axis].append(half_period[k])
+                    self._dirs[axis].append(float(s))
+        # Z and E are spread evenly over path steps
+        for axis in (2, 3):
+            d = steps[axis]
+            m = abs(int(d))
+            if m and not n:
+                raise ValueError("Z and E can not move without arc")
+            for j in range(m):
+                k = int((j + 0.5) * n / m)
+                self._times[axis].append(path_time[k])
+                self._delays[axis].append(half_period[k])
+                self._dirs[axis].append(math.copysign(1, d))
+        self.steps = [len(i) for i in self._times]
+        self._start_direction = tuple(
+            self._dirs[axis][0] if self._dirs[axis] else 1.0
+            for axis in range(4))
+
+    @staticmethod
+    def _arc_steps(x, y, ex, ey, clockwise):
+        """ Walk arc from (x, y) to (ex, ey) around (0, 0) on step grid.
+        :return: list of (dx, dy) steps.
+        """
+        r2 = x * x + y * y
+        a0 = math.atan2(y, x)
+        a1 = math.atan2(ey, ex)
+        sweep = (a0 - a1) if clockwise else (a1 - a0)
+        sweep %= 2.0 * math.pi
+        path = []
+        if r2:
+            eps = 0.5 / math.sqrt(r2)
+            if sweep < eps:
+                sweep = 2.0 * math.pi
+            walked = 0.0
+            while walked < sweep - eps:
+                # tangent direction
+                if clockwise:
+                    tx, ty = y, -x
+                else:
+                    tx, ty = -y, x
+                sx = (tx > 0) - (tx < 0)
+                sy = (ty > 0) - (ty < 0)
+                best = None
+                for cx, cy in ((sx, 0), (0, sy), (sx, sy)):
+                    if not cx and not cy:
+                        continue
+                    nx, ny = x + cx, y + cy
+                    err = abs(nx * nx + ny * ny - r2)
+                    if best is None or err < best[0]:
+                        best = (err, cx, cy)
+                _, cx, cy = best
+                walked += abs(math.atan2(x * (y + cy) - y * (x + cx),
+                                         x * (x + cx) + y * (y + cy)))
+                x += cx
+                y += cy
+                path.append((cx, cy))
+        # end point may be off the rasterized circle, reach it exactly
+        while x != ex or y != ey:
+            cx = (ex > x) - (ex < x)
+            cy = (ey > y) - (ey < y)
+            x += cx
+            y += cy
+            path.append((cx, cy))
+        return path
+
+    def total_time_s(self):
+        """ Get total time for movement.
+        :return: time in seconds.
+        """
+        return self._total_time_s
+
+    def timeline(self):
+        """ Compile movement, see PulseGeneratorLinear.timeline(). Axises
+            may change direction inside arc.
+        """
+        return compile_circular(self)
+
+    def __iter__(self):
+        """ Get iterator.
+        :return: iterable object.
+        """
+        self._iteration_x = 0
+        self._iteration_y = 0
+        self._iteration_z = 0
+        self._iteration_e = 0
+        self._iteration_direction = None
+        return self
+
+    def _to_accelerated_time(self, pt_s):
+        """ Times from _interpolation_function already include ramp.
+        """
+        return pt_s
+
+    def _interpolation_function(self, ix, iy, iz, ie):
+        """ Get times of next pulses, see super class for details.
+            Direction of each axis is the direction of its next pulse.
+        """
+        t = [None, None, None, None]
+        direction = list(self._start_direction)
+        for axis, i in enumerate((ix, iy, iz, ie)):
+            if i < self.steps[axis]:
+                t[axis] = self._times[axis][i]
+                direction[axis] = self._dirs[axis][i]
+            elif self.steps[axis]:
+                direction[axis] = self._dirs[axis][-1]
+        return tuple(direction), tuple(t)
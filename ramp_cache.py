@@ -0,0 +1,148 @@
+import array
+import collections
+import threading
+
+import numpy as np
+
+from logging_config import *
+
+
+class RampTable(object):
+    """ Precomputed acceleration ramp: delays start - r * add for every
+        pulse r while delay is greater then target, and prefix sums of
+        them. Pulses after the table run with floor delay.
+    """
+    __slots__ = ('start', 'add', 'target', 'floor', 'delays', 'prefix')
+
+    def __init__(self, start, add, target):
+        """ Create object.
+        :param start: delay of the first pulse.
+        :param add: delay decrement per pulse.
+        :param target: delay at top speed.
+        """
+        self.start = start
+        self.add = add
+        self.target = target
+        self.delays = array.array('d')
+        self.prefix = array.array('d', [0.0])
+        if add > 0:
+            self.floor = target
+            r = 0
+            d = start
+            total = 0.0
+            while d > target:
+                self.delays.append(d)
+                total += d
+                self.prefix.append(total)
+                r += 1
+                d = start - r * add
+        else:
+            self.floor = max(start, target)
+
+    def __len__(self):
+        return len(self.delays)
+
+    def delay(self, r):
+        """ Get delay of pulse r of the ramp.
+        """
+        if r < len(self.delays):
+            return self.delays[r]
+        return self.floor
+
+    def sum(self, n):
+        """ Get sum of delays of the first n pulses.
+        """
+        if n <= 0:
+            return 0.0
+        m = len(self.delays)
+        if n <= m:
+            return self.prefix[n]
+        return self.prefix[m] + (n - m) * self.floor
+
+
+def profile_peaks(delays):
+    """ Get peak acceleration and jerk of step delay table. Velocity of
+        each pulse is one step per pulse period and is taken in the middle
+        of the period.
+    :param delays: array of step delays.
+    :return: Tuple of two values, peak acceleration in steps per second^2
+             and peak jerk in steps per second^3.
+    """
+    d = np.asarray(delays, dtype=np.float64)
+    if len(d) < 3:
+        return 0.0, 0.0
+    t = np.cumsum(2.0 * d) - d
+    v = 0.5 / d
+    a = np.diff(v) / np.diff(t)
+    ta = (t[1:] + t[:-1]) / 2.0
+    j = np.diff(a) / np.diff(ta)
+    return float(np.abs(a).max()), float(np.abs(j).max())
+
+
+class RampCache(object):
+    """ Bounded LRU cache of RampTable objects shared by all generators and
+        executors, moves with the same feed rate and axis settings reuse
+        one table. Thread safe, motor workers use it too.
+    """
+    def __init__(self, maxsize=RAMP_CACHE_SIZE):
+        """ Create object.
+        :param maxsize: maximum number of tables.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._tables = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, start, add, target):
+        """ Get ramp table, create it if it is not cached.
+        :param start: delay of the first pulse.
+        :param add: delay decrement per pulse.
+        :param target: delay at top speed.
+        :return: RampTable object.
+        """
+        key = (start, add, target)
+        with self._lock:
+            table = self._tables.get(key)
+            if table is not None:
+                self._tables.move_to_end(key)
+                self.hits += 1
+                return table
+            self.misses += 1
+        table = RampTable(start, add, target)
+        with self._lock:
+            self._tables[key] = table
+            while len(self._tables) > self.maxsize:
+                self._tables.popitem(last=False)
+        return table
+
+    def clear(self):
+        """ Remove all tables and reset statistics.
+        """
+        with self._lock:
+            self._tables.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ Get cache statistics.
+        :return: dict with hits, misses, size and maxsize.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._tables), 'maxsize': self.maxsize}
+
+
+_cache = RampCache()
+
+
+def ramp_table(start, add, target):
+    """ Get ramp table from the shared cache, see RampCache.get().
+    """
+    return _cache.get(start, add, target)
+
+
+def ramp_cache():
+    """ Get the shared RampCache object.
+    """
+    return _cache
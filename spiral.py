@@ -0,0 +1,102 @@
+import math
+
+import numpy as np
+
+from logging_config import *
+from coordinates import *
+from pulse import SECONDS_IN_MINUTE
+from machine_profile import get_profile
+
+
+def axis_velocity_limits(profile=None):
+    """ Get velocity range which GMachine accepts for each axis.
+    :param profile: MachineProfile object, default profile if None.
+    :return: Tuple of two arrays, minimum and maximum velocity in mm/min
+             for X, Y, Z and E.
+    """
+    profile = profile or get_profile()
+    vmin = np.array(profile.min_velocity)
+    vmax = np.array(profile.max_velocity)
+    return vmin, vmax
+
+
+def spiral_angles(radius, pitch, tolerance):
+    """ Sample angles of Archimedean spiral r = pitch * theta / 2pi so
+        that chord between neighbour samples deviates from the curve not
+        more then tolerance. Samples get denser where radius is small.
+    :param radius: final radius in mm.
+    :param pitch: distance between turns in mm.
+    :param tolerance: maximum chord error in mm.
+    :return: array of angles in radians, from 0 to the final angle.
+    """
+    theta_end = 2.0 * math.pi * radius / pitch
+    b = pitch / (2.0 * math.pi)
+    # angle step with sagitta r * (1 - cos(step / 2)) == tolerance
+    def step(r):
+        c = np.clip(1.0 - tolerance / np.maximum(r, 1e-12), -1.0, 1.0)
+        return np.minimum(2.0 * np.arccos(c), SPIRAL_MAX_ANGLE_STEP)
+
+    finest = float(step(np.array([radius]))[0])
+    theta = np.linspace(0.0, theta_end, int(math.ceil(theta_end / finest * 4)) + 2)
+    # number of segments needed up to each fine angle, then invert it
+    need = np.empty_like(theta)
+    need[0] = 0.0
+    np.cumsum(np.diff(theta) / step(b * theta[:-1]), out=need[1:])
+    count = int(math.ceil(need[-1]))
+    return np.interp(np.linspace(0.0, need[-1], count + 1), need, theta)
+
+
+class SpiralPath(object):
+    """ Filling path, spiral from center to cake radius. Nozzle moves with
+        constant surface speed, so extrusion per millimeter of path is
+        constant and the center is not over-extruded.
+    """
+    def __init__(self, center, radius, pitch, extrusion_rate,
+                 surface_speed=None, tolerance=SPIRAL_CHORD_TOLERANCE_MM, profile=None):
+        """ Create path.
+        :param center: Coordinates of cake center, Z is kept, E is start
+                       extruder position.
+        :param radius: cake radius in mm.
+        :param pitch: distance between spiral turns in mm.
+        :param extrusion_rate: extruder velocity in mm per second.
+        :param surface_speed: nozzle speed in mm/min, the fastest speed of
+                              slower of X and Y axises if None.
+        :param tolerance: maximum chord error in mm.
+        :param profile: MachineProfile object, default profile if None.
+        """
+        vmin, vmax = axis_velocity_limits(profile)
+        if surface_speed is None:
+            surface_speed = float(min(vmax[0], vmax[1]))
+        self.surface_speed = surface_speed
+        theta = spiral_angles(radius, pitch, tolerance)
+        r = pitch / (2.0 * math.pi) * theta
+        x = center.x + r * np.cos(theta)
+        y = center.y + r * np.sin(theta)
+        d = np.hypot(np.diff(x), np.diff(y))
+        length = np.concatenate(([0.0], np.cumsum(d)))
+        e_per_mm = extrusion_rate * SECONDS_IN_MINUTE / surface_speed
+        self.points = CoordinateArray.from_axes(x, y, center.z,
+                                                center.e + length * e_per_mm)
+        # per axis velocity of each segment for the same surface speed
+        delta = np.abs(self.points.diff().data)
+        t_min = np.maximum(d, 1e-12) / surface_speed
+        self.feeds = np.clip(delta / t_min[:, None], vmin, vmax)
+
+    def __len__(self):
+        return len(self.points) - 1
+
+    def length(self):
+        """ Get path length in mm.
+        """
+        d = self.points.diff()
+        return float(np.hypot(d.x, d.y).sum())
+
+    def commands(self):
+        """ Iterate movements.
+        :return: generator of tuples (target Coordinates, velocity
+                 Coordinates) for each segment.
+        """
+        points = self.points.data.tolist()
+        feeds = self.feeds.tolist()
+        for i in range(len(feeds)):
+            yield Coordinates(*points[i + 1]), Coordinates(*feeds[i])
@@ -0,0 +1,467 @@
+""" Optional real-time step process. Planner process converts pulses to
+    compact records in shared memory ring buffer, dedicated executor
+    process drains it with MergedStepExecutor. Executor process can be
+    pinned to an isolated core, run under SCHED_FIFO, with garbage collector
+    disabled and memory locked, so planning, logging and G-code handling do
+    not cause jitter of step pulses. Like arcs on MergedStepExecutor, all
+    movements run in full steps, Auto microstepping needs axis workers.
+"""
+import ctypes
+import gc
+import logging
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+
+from logging_config import *
+import hal
+from hal_backend import RPiBackend
+from executor import MergedStepExecutor
+
+# record flags, low four bits are axises
+RECORD_DIRECTION = 0x80
+RECORD_END = 0x40
+RECORD_AXES = 0x0f
+
+# header fields, int64 each
+_HEAD = 0           # records written, by planner
+_TAIL = 1           # records read, by executor
+_UNDERRUNS = 2      # times executor needed record and ring was empty
+_LOW_FILL = 3       # the lowest fill seen by executor while planner writes
+_PULSES = 4         # pulses made on all axises
+_STOP = 5           # emergency stop request
+_STATE = 6          # executor state, see STATE_*
+_MAX_LATENESS = 7   # the worst pulse lateness in ns
+_STREAMS = 8        # finished streams
+_POSITION = 9       # four fields, position of each axis in steps
+_STALL_NS = 13      # total time executor waited for records while running
+_EXIT = 14          # exit request
+_PRODUCING = 15     # planner is writing stream, end record is not written
+_WRITTEN_NS = 16    # time of the last pulse record of stream, by planner
+_HEADER_FIELDS = 17
+
+STATE_STARTING = 0
+STATE_IDLE = 1
+STATE_RUNNING = 2
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+
+class StepProcessException(Exception):
+    """ Step process failed or is not running.
+    """
+    pass
+
+
+class PulseRing(object):
+    """ Single producer single consumer ring of step records in shared
+        memory. Each record is time in ns (int64), flags (uint8) and
+        sequence number (int64): for pulse record low bits are axises which
+        step, for direction record (RECORD_DIRECTION) low bits are axises
+        which move forward.
+        Counters are never wrapped, index of record is counter % capacity.
+        Python has no memory barrier, so _HEAD alone does not tell that
+        time and flags of a record are visible in the other process.
+        Producer writes sequence number, counter + 1, after the record and
+        consumer reads record only when it sees its sequence number, see
+        published().
+    """
+    def __init__(self, capacity=STEP_PROCESS_RING_SIZE, name=None):
+        """ Create new ring or attach to existing one.
+        :param capacity: number of records.
+        :param name: shared memory name to attach, new memory if None.
+        """
+        size = 8 * _HEADER_FIELDS + 17 * capacity
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.shm.buf[:size] = bytes(size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.capacity = capacity
+        self.header = self.times = self.seqs = self.flags = None
+        buf = self.shm.buf
+        h = 8 * _HEADER_FIELDS
+        try:
+            if self.shm.size < size:
+                raise StepProcessException("shared memory {} is smaller then ring of {} records".format(
+                    self.name, capacity))
+            self.header = buf[:h].cast('q')
+            self.times = buf[h:h + 8 * capacity].cast('q')
+            self.seqs = buf[h + 8 * capacity:h + 16 * capacity].cast('q')
+            self.flags = buf[h + 16 * capacity:h + 17 * capacity].cast('B')
+        except Exception:
+            self.close(unlink=name is None)
+            raise
+
+    def fill(self):
+        """ Get number of records waiting in ring.
+        """
+        return self.header[_HEAD] - self.header[_TAIL]
+
+    def published(self, counter):
+        """ Check that record is completely written.
+        :param counter: record counter, not wrapped.
+        :return: True if time and flags of record can be read.
+        """
+        return self.seqs[counter % self.capacity] == counter + 1
+
+    def close(self, unlink=False):
+        """ Detach from shared memory.
+        :param unlink: also free memory, should be done by creator.
+        """
+        # views have to be released before memory is closed
+        for view in (self.header, self.times, self.seqs, self.flags):
+            if view is not None:
+                view.release()
+        self.header = self.times = self.seqs = self.flags = None
+        try:
+            self.shm.close()
+        finally:
+            if unlink:
+                self.shm.unlink()
+
+
+def _realtime_setup(cpu, fifo_priority, lock_memory):
+    """ Prepare executor process for real-time work, failed steps are
+        logged and skipped.
+    """
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (AttributeError, OSError) as e:
+            logging.warning("step process: can not pin to cpu {}: {}".format(cpu, e))
+    if fifo_priority and cpu is None:
+        # 沒有獨立核心時 SCHED_FIFO 會讓規劃行程等不到 CPU
+        logging.warning("step process: SCHED_FIFO needs dedicated cpu, normal scheduling is used")
+    elif fifo_priority:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(fifo_priority))
+        except (AttributeError, OSError) as e:
+            logging.warning("step process: can not set SCHED_FIFO: {}".format(e))
+    if lock_memory:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        except (AttributeError, OSError) as e:
+            logging.warning("step process: can not lock memory: {}".format(e))
+    # 執行中不做 GC，避免停頓
+    gc.collect()
+    gc.freeze()
+    gc.disable()
+
+
+def _wait_prefill(ring, prefill_ns):
+    """ Wait until pulses of prefill_ns are written ahead, stream is
+        complete or ring is full.
+    """
+    header = ring.header
+    tail = header[_TAIL]
+    while header[_WRITTEN_NS] < prefill_ns and not header[_STOP]:
+        head = header[_HEAD]
+        if head - tail >= ring.capacity:
+            break
+        if head > tail and ring.published(head - 1) \
+                and ring.flags[(head - 1) % ring.capacity] & RECORD_END:
+            # the whole stream is shorter then prefill
+            break
+        time.sleep(0.0005)
+
+
+def _read_stream(ring, gpio, ended):
+    """ Generator of pulses in PulseGenerator.next() format from ring until
+        end record. Time spent waiting for records is added to the rest of
+        stream, so pulses after underrun keep their spacing.
+    :param ended: list, its first item is set to True when end record is
+                  read.
+    """
+    header = ring.header
+    times = ring.times
+    flags = ring.flags
+    capacity = ring.capacity
+    estop = hal.get_emergency_stop()
+    tail = header[_TAIL]
+    low = header[_LOW_FILL]
+    shift = 0
+    published = ring.published
+    while True:
+        if not published(tail):
+            # underrun, pulses wait for planner
+            header[_UNDERRUNS] += 1
+            t = gpio.now_ns()
+            while not published(tail):
+                if header[_STOP]:
+                    hal.emergency_stop()
+                    return
+                time.sleep(STEP_PROCESS_UNDERRUN_SLEEP_S)
+            stall = gpio.now_ns() - t
+            shift += stall
+            header[_STALL_NS] += stall
+            continue
+        head = header[_HEAD]
+        if head - tail < low and header[_PRODUCING]:
+            low = head - tail
+            header[_LOW_FILL] = low
+        if header[_STOP] and not estop.active:
+            hal.emergency_stop()
+        i = tail % capacity
+        f = flags[i]
+        t = times[i]
+        tail += 1
+        header[_TAIL] = tail
+        if f & RECORD_END:
+            ended[0] = True
+            return
+        if f & RECORD_DIRECTION:
+            yield (True, 1 if f & 1 else -1, 1 if f & 2 else -1,
+                   1 if f & 4 else -1, 1 if f & 8 else -1)
+        else:
+            t = (t + shift) / 1e9
+            yield (False, t if f & 1 else None, t if f & 2 else None,
+                   t if f & 4 else None, t if f & 8 else None)
+
+
+def _step_process_main(name, capacity, pin_map, mode_pins, backend_class, cpu,
+                       fifo_priority, lock_memory, prefill_ns):
+    """ Executor process.
+    """
+    ring = PulseRing(capacity, name)
+    header = ring.header
+    gpio = backend_class()
+    hal.set_backend(gpio)
+    executor = MergedStepExecutor(pin_map, gpio, mode_pins=mode_pins)
+    _realtime_setup(cpu, fifo_priority, lock_memory)
+    header[_STATE] = STATE_IDLE
+    try:
+        while not header[_EXIT]:
+            if header[_HEAD] == header[_TAIL]:
+                time.sleep(0.001)
+                continue
+            if not header[_STOP] and hal.emergency_stopped():
+                hal.reset_emergency_stop()
+            header[_STATE] = STATE_RUNNING
+            header[_LOW_FILL] = capacity
+            ended = [False]
+            _wait_prefill(ring, prefill_ns)
+            header[_PULSES] += executor.run(_read_stream(ring, gpio, ended))
+            if executor.lateness_ns:
+                header[_MAX_LATENESS] = max(header[_MAX_LATENESS], max(executor.lateness_ns))
+            for i in range(4):
+                header[_POSITION + i] = executor.position[i]
+            # after emergency stop the rest of stream is dropped
+            while not ended[0] and not header[_EXIT]:
+                tail = header[_TAIL]
+                if not ring.published(tail):
+                    time.sleep(0.001)
+                    continue
+                ended[0] = bool(ring.flags[tail % capacity] & RECORD_END)
+                header[_TAIL] = tail + 1
+            header[_STREAMS] += 1
+            header[_STATE] = STATE_IDLE
+    finally:
+        gpio.cleanup()
+        ring.close()
+
+
+class StepProcess(object):
+    """ Executor process fed by shared memory ring buffer, optional mode of
+        GMachine. Movements are written to ring by add_task(), which blocks
+        only when ring is full, executor process runs pulses of consecutive
+        movements as one stream until join().
+    """
+    def __init__(self, capacity=STEP_PROCESS_RING_SIZE, cpu=STEP_PROCESS_CPU,
+                 fifo_priority=STEP_PROCESS_FIFO_PRIORITY, lock_memory=True,
+                 prefill_s=STEP_PROCESS_PREFILL_S, backend_class=RPiBackend, pin_map=None):
+        """ Create object and start executor process.
+        :param capacity: number of records in ring.
+        :param cpu: core for executor process, not pinned if None.
+        :param fifo_priority: SCHED_FIFO priority, normal scheduling if 0
+                              or None. It is used only with cpu, process
+                              which never yields must not share core with
+                              planner.
+        :param lock_memory: lock executor memory with mlockall().
+        :param prefill_s: pulses of this time are written before stream
+                          starts, unless stream is shorter or ring is
+                          full.
+        :param backend_class: HALBackend class, it is created in executor
+                              process.
+        :param pin_map: pins in MergedStepExecutor format, hal driver
+                        registry if None, mode pins of registry are set to
+                        full step in this case.
+        """
+        self.ring = PulseRing(capacity)
+        self._offset_ns = 0
+        self._direction = None
+        self._streams = 0
+        self._running = False
+        self._stop_pending = False
+        mode_pins = []
+        if pin_map is None:
+            pin_map = hal.pin_map()
+            mode_pins = hal.mode_pins()
+        # 子行程不繼承規劃行程的執行緒
+        context = multiprocessing.get_context('spawn')
+        self.process = context.Process(
+            target=_step_process_main, name='step-process',
+            args=(self.ring.name, capacity, pin_map, mode_pins, backend_class, cpu,
+                  fifo_priority, lock_memory, int(prefill_s * 1e9)))
+        self.process.daemon = True
+        try:
+            self.process.start()
+            while self.ring.header[_STATE] == STATE_STARTING:
+                self._check_alive()
+                time.sleep(0.001)
+        except BaseException:
+            if self.process.is_alive():
+                self.process.terminate()
+            self.ring.close(unlink=True)
+            raise
+
+    def _check_alive(self):
+        if not self.process.is_alive():
+            raise StepProcessException("step process exited with code {}".format(
+                self.process.exitcode))
+
+    def _put(self, t, f):
+        """ Write one record, wait while ring is full.
+        """
+        ring = self.ring
+        header = ring.header
+        head = header[_HEAD]
+        while head - header[_TAIL] >= ring.capacity:
+            self._check_alive()
+            time.sleep(0.0005)
+        i = head % ring.capacity
+        ring.times[i] = t
+        ring.flags[i] = f
+        # 序號最後寫入，讀取端看到序號才讀這筆
+        ring.seqs[i] = head + 1
+        header[_HEAD] = head + 1
+        if not f & (RECORD_DIRECTION | RECORD_END):
+            header[_WRITTEN_NS] = t
+
+    def add_task(self, gen):
+        """ Write movement to ring, the same interface as hal.add_task().
+            Movement continues the stream after previous one.
+        :param gen: PulseGenerator object.
+        """
+        if hal.emergency_stopped():
+            self.emergency_stop()
+            logging.warning("emergency stop is active, movement is dropped")
+            return
+        self._running = True
+        self.ring.header[_PRODUCING] = 1
+        put = self._put
+        offset = self._offset_ns
+        last = 0
+        for pulse in gen:
+            if pulse[0]:
+                f = RECORD_DIRECTION
+                for i in range(4):
+                    if pulse[i + 1] > 0:
+                        f |= 1 << i
+                if f != self._direction:
+                    self._direction = f
+                    put(0, f)
+                continue
+            f = 0
+            for i in range(4):
+                t = pulse[i + 1]
+                if t is not None:
+                    f |= 1 << i
+                    last = t
+            put(offset + int(round(last * 1e9)), f)
+        # the same spacing of movements as on axis workers, see JobRecorder
+        end = gen.total_time_s() if hasattr(gen, 'total_time_s') else last
+        self._offset_ns = offset + int(round(max(end, last) * 1e9))
+
+    def join(self):
+        """ End stream and wait until executor process made all pulses.
+        """
+        header = self.ring.header
+        if self._running:
+            self._running = False
+            header[_PRODUCING] = 0
+            self._put(0, RECORD_END)
+            header[_WRITTEN_NS] = 0
+            self._streams += 1
+            self._offset_ns = 0
+            self._direction = None
+            while header[_STREAMS] < self._streams:
+                self._check_alive()
+                if hal.emergency_stopped() and not header[_STOP]:
+                    self.emergency_stop()
+                time.sleep(0.001)
+        if self._stop_pending and not hal.emergency_stopped():
+            self._stop_pending = False
+            header[_STOP] = 0
+
+    def stop(self):
+        """ Stop running stream, movements written before the next join()
+            are dropped.
+        """
+        self._stop_pending = True
+        self.ring.header[_STOP] = 1
+
+    def emergency_stop(self):
+        """ Ask executor process to stop before the next pulse, see
+            hal.emergency_stop(). Movements are dropped until
+            reset_emergency_stop().
+        """
+        self.ring.header[_STOP] = 1
+
+    def reset_emergency_stop(self):
+        self._stop_pending = False
+        self.ring.header[_STOP] = 0
+
+    def positions(self):
+        """ Get steps made by executor process, as MergedStepExecutor
+            position, after join().
+        :return: list of four integers.
+        """
+        header = self.ring.header
+        return [header[_POSITION + i] for i in range(4)]
+
+    def metrics(self):
+        """ Get ring and executor counters.
+        :return: dict with capacity, current fill, the lowest fill of the
+                 last stream, number of underruns, time waited for records,
+                 pulses made and the worst pulse lateness.
+        """
+        header = self.ring.header
+        return {'capacity': self.ring.capacity,
+                'fill': self.ring.fill(),
+                'low_fill': header[_LOW_FILL],
+                'underruns': header[_UNDERRUNS],
+                'stall_ms': header[_STALL_NS] / 1e6,
+                'pulses': header[_PULSES],
+                'max_lateness_us': header[_MAX_LATENESS] / 1e3,
+                'streams': header[_STREAMS]}
+
+    def close(self):
+        """ Finish stream, stop executor process and free shared memory.
+            Memory is freed even if executor process failed.
+        """
+        if self.ring.header is None:
+            return
+        try:
+            if self.process.is_alive():
+                self.join()
+                self.ring.header[_EXIT] = 1
+                self.process.join(5)
+        finally:
+            if self.process.is_alive():
+                self.process.terminate()
+            self.ring.close(unlink=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None:
+            # pulses of failed job are not made
+            self.stop()
+        self.close()
@@ -0,0 +1,147 @@
+import array
+import struct
+import sys
+import threading
+
+from logging_config import *
+
+TRACE_MAGIC = b'STRC'
+TRACE_VERSION = 1
+# magic, version, capacity, number of records in file, records lost
+_HEADER = struct.Struct('<4sIIQQ')
+
+
+class StepTrace(object):
+    """ Ring buffer of step pulses for offline jitter analysis. Arrays are
+        allocated once, when buffer is full the oldest records are
+        overwritten. Step loops check `enabled` before record(), so disabled
+        trace costs one attribute read per pulse.
+    """
+    def __init__(self, capacity=STEP_TRACE_CAPACITY, sample=STEP_TRACE_SAMPLE):
+        """ Create object.
+        :param capacity: number of records kept.
+        :param sample: record every n-th pulse.
+        """
+        self.capacity = capacity
+        self.sample = sample
+        self.enabled = False
+        self.time_ns = array.array('q', bytes(8 * capacity))
+        self.planned_ns = array.array('q', bytes(8 * capacity))
+        self.actual_ns = array.array('q', bytes(8 * capacity))
+        self.axis = array.array('b', bytes(capacity))
+        self._lock = threading.Lock()
+        self._head = 0
+        self._skip = 1
+        self.recorded = 0
+
+    def enable(self, sample=None):
+        """ Start recording.
+        :param sample: record every n-th pulse, keep current if None.
+        """
+        if sample is not None:
+            self.sample = max(1, int(sample))
+        self._skip = 1
+        self.enabled = True
+
+    def disable(self):
+        """ Stop recording, records are kept.
+        """
+        self.enabled = False
+
+    def clear(self):
+        with self._lock:
+            self._head = 0
+            self._skip = 1
+            self.recorded = 0
+
+    def record(self, axis, t_ns, planned_ns, actual_ns):
+        """ Record one pulse.
+        :param axis: axis index, 0..3 for X, Y, Z, E, -1 if unknown.
+        :param t_ns: time of rising edge in ns.
+        :param planned_ns: planned time from previous rising edge in ns.
+        :param actual_ns: measured time from previous rising edge in ns.
+        """
+        with self._lock:
+            self._skip -= 1
+            if self._skip > 0:
+                return
+            self._skip = self.sample
+            i = self._head
+            self.time_ns[i] = t_ns
+            self.planned_ns[i] = planned_ns
+            self.actual_ns[i] = actual_ns
+            self.axis[i] = axis
+            i += 1
+            self._head = 0 if i == self.capacity else i
+            self.recorded += 1
+
+    def __len__(self):
+        return min(self.recorded, self.capacity)
+
+    def lost(self):
+        """ Get number of records overwritten by newer ones.
+        """
+        return max(0, self.recorded - self.capacity)
+
+    def _ordered(self, a):
+        n = len(self)
+        if n < self.capacity:
+            return a[:n]
+        return a[self._head:] + a[:self._head]
+
+    def records(self):
+        """ Get records from the oldest.
+        :return: list of tuples (axis, time_ns, planned_ns, actual_ns).
+        """
+        with self._lock:
+            return list(zip(self._ordered(self.axis), self._ordered(self.time_ns),
+                            self._ordered(self.planned_ns), self._ordered(self.actual_ns)))
+
+    def dump(self, path):
+        """ Write records to binary file: header and then columns of axis
+            (int8), time, planned and actual delay (int64 ns), all little
+            endian, from the oldest record. Use load() to read it.
+        :param path: file name.
+        :return: number of written records.
+        """
+        with self._lock:
+            columns = [self._ordered(self.axis), self._ordered(self.time_ns),
+                       self._ordered(self.planned_ns), self._ordered(self.actual_ns)]
+            n = len(self)
+            lost = self.lost()
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, self.capacity, n, lost))
+            for c in columns:
+                if sys.byteorder != 'little':
+                    c.byteswap()
+                c.tofile(f)
+        return n
+
+
+def load(path):
+    """ Read file written by StepTrace.dump().
+    :param path: file name.
+    :return: Tuple of dict with axis, time_ns, planned_ns and actual_ns
+             arrays and number of lost records.
+    """
+    with open(path, 'rb') as f:
+        magic, version, _, n, lost = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError("not a step trace file: {}".format(path))
+        result = {}
+        for name, code in (('axis', 'b'), ('time_ns', 'q'), ('planned_ns', 'q'), ('actual_ns', 'q')):
+            a = array.array(code)
+            a.fromfile(f, n)
+            if sys.byteorder != 'little':
+                a.byteswap()
+            result[name] = a
+    return result, lost
+
+
+_trace = StepTrace()
+
+
+def get_trace():
+    """ Get step trace shared by all step loops.
+    """
+    return _trace
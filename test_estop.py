@@ -0,0 +1,78 @@
+""" Emergency stop on simulated GPIO. Stop comes in the middle of a wait
+    of step loop, like real stop button, and is checked against simulated
+    clock: step loop ends within ESTOP_POLL_NS, no step is made after stop
+    and machine position is the position of simulated axises.
+
+    python -m pytest -q test_estop.py
+"""
+import pytest
+
+from logging_config import *
+from coordinates import Coordinates
+import hal
+from hal_backend import StopBackend
+from gmachine import GMachine
+
+VELOCITY = Coordinates(300, 300, 300, 300)
+STOP_FRACTIONS = (0.05, 0.2, 0.35, 0.5, 0.65, 0.8, 0.95)
+
+
+def _linear(m):
+    """ X only movement, it runs on one axis worker thread.
+    """
+    m.do_command('G1', Coordinates(40, 0, 0, 0), VELOCITY)
+    m.flush()
+    m.join()
+
+
+def _arc(m):
+    """ Half circle, it runs on merged executor.
+    """
+    m.do_command('G2', Coordinates(20, 0, 0, 0), VELOCITY, {'I': 10, 'J': 0})
+    m.join()
+
+
+def _run(command, backend):
+    """ Run command on new machine with backend.
+    :return: GMachine object.
+    """
+    hal.configure_drivers()
+    hal.use_simulation(backend)
+    m = GMachine()
+    command(m)
+    return m
+
+
+def _duration(command):
+    """ Get machine time of command without stop.
+    """
+    backend = StopBackend(float('inf'), hal.emergency_stop)
+    _run(command, backend)
+    return backend.elapsed_s()
+
+
+@pytest.fixture(autouse=True)
+def _reset():
+    hal.reset_emergency_stop()
+    yield
+    hal.reset_emergency_stop()
+    hal.shutdown()
+
+
+@pytest.mark.parametrize('fraction', STOP_FRACTIONS)
+@pytest.mark.parametrize('command', (_linear, _arc), ids=('worker', 'merged'))
+def test_emergency_stop(command, fraction):
+    backend = StopBackend(fraction * _duration(command), hal.emergency_stop)
+    m = _run(command, backend)
+    assert backend.triggered
+    stop_s = hal.get_emergency_stop().time_ns / 1e9
+    # step loop ends within one wait slice, stop time is kept in ns
+    latency = backend.elapsed_s() - stop_s
+    assert -1e-9 <= latency <= ESTOP_POLL_NS / 1e9 + 1e-9
+    step_pins = set(d.step_pin for d in hal.drivers().values())
+    late = [e for e in backend.edges() if e[1] in step_pins and e[2] and e[0] > stop_s]
+    assert late == []
+    m.sync_position()
+    simulated = backend.positions()
+    assert dict(zip(hal.AXES, m._steps)) == dict((axis, simulated.get(axis, 0)) for axis in hal.AXES)
+    assert any(m._steps)
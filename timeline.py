@@ -0,0 +1,184 @@
+import numpy as np
+
+from logging_config import *
+from ramp_cache import ramp_table
+
+
+AXES = ('x', 'y', 'z', 'e')
+
+
+class PulseTimeline(object):
+    """ Whole movement compiled to arrays. Each axis has array of pulse
+        times in seconds from movement start, array of step delays (half of
+        pulse period, as motor_go sleeps it) and array of step directions,
+        +1 forward, -1 reverse, so direction changes inside movement are
+        expressed by this array too.
+    """
+    def __init__(self, times, delays, directions, start_direction=None):
+        """ Create object.
+        :param times: list of four float64 arrays with pulse times.
+        :param delays: list of four float64 arrays with step delays.
+        :param directions: list of four int8 arrays with step directions.
+        :param start_direction: direction of each axis before first pulse,
+                                uses for axises without pulses.
+        """
+        self.times = times
+        self.delays = delays
+        self.directions = directions
+        if start_direction is None:
+            start_direction = tuple(float(d[0]) if len(d) else 1.0
+                                    for d in directions)
+        self.start_direction = start_direction
+
+    def steps(self):
+        """ Get number of pulses for each axis.
+        :return: Tuple of four integers.
+        """
+        return tuple(len(t) for t in self.times)
+
+    def total_time_s(self):
+        """ Get total time for movement.
+        :return: time in seconds.
+        """
+        total = 0.0
+        for t, d in zip(self.times, self.delays):
+            if len(t):
+                total = max(total, t[-1] + 2.0 * d[-1])
+        return total
+
+    def position_delta(self):
+        """ Get signed movement in steps for each axis.
+        :return: Tuple of four integers.
+        """
+        return tuple(int(d.sum(dtype=np.int64)) for d in self.directions)
+
+    def merged(self):
+        """ Merge all axises to one time ordered stream.
+        :return: Tuple of two values, array of unique pulse times and
+                 boolean array of shape (len(times), 4) which tells which
+                 axises should pulse at this time.
+        """
+        t = np.unique(np.concatenate(self.times))
+        mask = np.zeros((len(t), 4), dtype=bool)
+        for axis, at in enumerate(self.times):
+            mask[np.searchsorted(t, at), axis] = True
+        return t, mask
+
+    def iter_pulses(self):
+        """ Iterate pulses in the same format as PulseGenerator.next() does.
+        :return: generator of tuples, see PulseGenerator.next().
+        """
+        t, mask = self.merged()
+        # index of the next pulse of each axis at each tick
+        pending = np.cumsum(mask, axis=0) - mask
+        direction = self.start_direction
+        if not len(t):
+            yield (True,) + direction
+        for n in range(len(t)):
+            d = tuple(float(self.directions[a][pending[n, a]])
+                      if pending[n, a] < len(self.directions[a])
+                      else direction[a] for a in range(4))
+            if n == 0 or d != direction:
+                direction = d
+                yield (True,) + d
+            tn = float(t[n])
+            yield (False,) + tuple(tn if mask[n, a] else None
+                                   for a in range(4))
+
+
+def ramp_delays(n, start, end, add, target):
+    """ Step delays of acceleration and braking ramps, the same which
+        PulseGeneratorLinear.step_delay() returns for each pulse. Ramps
+        are copied from shared ramp tables.
+    """
+    entry = ramp_table(start, add, target)
+    exit = ramp_table(end, add, target)
+    d = np.full(n, max(entry.floor, exit.floor, target), dtype=np.float64)
+    m = min(n, len(entry))
+    if m:
+        np.maximum(d[:m], np.frombuffer(entry.delays, dtype=np.float64, count=m), out=d[:m])
+    m = min(n, len(exit))
+    if m:
+        np.maximum(d[n - m:], np.frombuffer(exit.delays, dtype=np.float64, count=m)[::-1],
+                   out=d[n - m:])
+    return d
+
+
+def _pulse_times(delays):
+    """ Pulse times from step delays, each pulse lasts two delays.
+    """
+    t = np.empty(len(delays), dtype=np.float64)
+    if len(delays):
+        t[0] = 0.0
+        np.cumsum(2.0 * delays[:-1], out=t[1:])
+    return t
+
+
+def _compile_delays(gen, delays):
+    """ Build PulseTimeline of movement along one line from per axis step
+        delays.
+    """
+    inverted = gen._profile.inverted
+    times, directions, start = [], [], []
+    for axis in range(4):
+        direction = gen._direction[axis]
+        if inverted[axis]:
+            direction = -direction
+        start.append(direction)
+        times.append(_pulse_times(delays[axis]))
+        directions.append(np.full(len(delays[axis]), direction, dtype=np.int8))
+    return PulseTimeline(times, list(delays), directions, tuple(start))
+
+
+def compile_linear(gen):
+    """ Compile PulseGeneratorLinear movement to PulseTimeline in one
+        vectorized pass instead of iterating it pulse by pulse.
+    :param gen: PulseGeneratorLinear object.
+    :return: PulseTimeline object.
+    """
+    delays = [ramp_delays(gen.steps[axis], gen._delaytime_start[axis],
+                           gen._delaytime_end[axis],
+                           gen._stepdelay_add[axis],
+                           gen._target_delaytime[axis])
+              for axis in range(4)]
+    return _compile_delays(gen, delays)
+
+
+def compile_scurve(gen):
+    """ Convert PulseGeneratorSCurve movement to PulseTimeline, delays are
+        already precomputed by generator.
+    :param gen: PulseGeneratorSCurve object.
+    :return: PulseTimeline object.
+    """
+    return _compile_delays(gen, gen.delay_tables)
+
+
+def _compile_paths(gen):
+    """ Build PulseTimeline from per axis pulse times, delays and
+        directions which generator has precomputed.
+    """
+    inverted = gen._profile.inverted
+    times, delays, directions, start = [], [], [], []
+    for axis in range(4):
+        sign = -1 if inverted[axis] else 1
+        times.append(np.array(gen._times[axis], dtype=np.float64))
+        delays.append(np.array(gen._delays[axis], dtype=np.float64))
+        directions.append(np.array(gen._dirs[axis], dtype=np.int8) * sign)
+        start.append(gen._start_direction[axis] * sign)
+    return PulseTimeline(times, delays, directions, tuple(start))
+
+
+def compile_circular(gen):
+    """ Convert PulseGeneratorCircular movement to PulseTimeline.
+    :param gen: PulseGeneratorCircular object.
+    :return: PulseTimeline object.
+    """
+    return _compile_paths(gen)
+
+
+def compile_coordinated(gen):
+    """ Convert PulseGeneratorCoordinated movement to PulseTimeline.
+    :param gen: PulseGeneratorCoordinated object.
+    :return: PulseTimeline object.
+    """
+    return _compile_paths(gen)